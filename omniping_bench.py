@@ -0,0 +1,441 @@
+'''
+Offline benchmark of the test engine against local stand-in targets.
+HTTP and HTTPS (self-signed) servers are started on loopback in a separate
+process with a configurable response delay and error codes, PING tests
+target addresses in 127.0.0.0/8 (or any prefix routed to a dummy interface)
+and TCP tests connect to the HTTP server's port.
+Each size is run for a number of back to back rounds with run_once and
+one JSON line of results is written per size, e.g.
+
+    python3 omniping_bench.py --sizes 10,100,1000,10000 --output bench.jsonl
+
+With --baseline the same PING tests are also run on their own first, so
+the ICMP RTT and jitter with and without the HTTP(S) load can be compared
+'''
+import argparse
+import asyncio
+from datetime import datetime
+import gc
+import ipaddress
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from omniping_history import percentile
+from omniping_http import OmniPingHttpPool
+from omniping_pacing import OmniPingPacer
+from omniping_state import OmniPingTestState
+from omniping_tester import OmniPingTester
+from omniping_timeouts import OmniPingTimeouts
+
+BENCH_VERSION = 2
+
+
+def raise_fd_limit():
+    '''
+    Thousands of concurrent HTTP tests need more than the usual 1024 descriptors
+    '''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def make_certificate(path):
+    '''
+    Generate a throw away self-signed certificate with openssl,
+    returns (cert, key) or None if openssl isn't available
+    '''
+    cert = os.path.join(path, 'cert.pem')
+    key = os.path.join(path, 'key.pem')
+    try:
+        subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+             '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+            check=True, capture_output=True
+            )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return cert, key
+
+
+async def handle_client(reader, writer):
+    '''
+    Minimal keep-alive HTTP/1.1 responder.
+    /?delay=<ms>&status=<code> sets the response delay and status code
+    '''
+    try:
+        while True:
+            request = await reader.readuntil(b'\r\n\r\n')
+            method, target = request.split(b' ', 2)[:2]
+            query = parse_qs(urlsplit(target.decode()).query)
+            delay = float(query.get('delay', ['0'])[0])
+            status = int(query.get('status', ['200'])[0])
+            if delay:
+                await asyncio.sleep(delay / 1000)
+            body = b'' if method == b'HEAD' else b'ok'
+            writer.write(
+                f'HTTP/1.1 {status} Bench\r\nContent-Length: 2\r\n'
+                f'Connection: keep-alive\r\n\r\n'.encode() + body
+                )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def target_main(conn, certificate):
+    '''
+    Entry point of the stand-in target process, sends back the
+    (http_port, https_port) and serves until the pipe closes
+    '''
+    raise_fd_limit()
+
+    async def serve():
+        http = await asyncio.start_server(handle_client, '127.0.0.1', 0, backlog=4096)
+        https = None
+        if certificate:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*certificate)
+            https = await asyncio.start_server(handle_client, '127.0.0.1', 0,
+                                               ssl=context, backlog=4096)
+        conn.send((
+            http.sockets[0].getsockname()[1],
+            https.sockets[0].getsockname()[1] if https else None,
+            ))
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        loop.add_reader(conn.fileno(), lambda: done.done() or done.set_result(None))
+        await done
+
+    asyncio.run(serve())
+
+
+class OmniPingBench():
+    '''
+    Builds the test lists, drives the tester and collects the measurements
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.ports = (None, None)
+
+    def ping_hosts(self):
+        '''
+        Endless supply of addresses from the ping prefix
+        '''
+        network = ipaddress.ip_network(self.args.ping_prefix)
+        while True:
+            for address in network.hosts():
+                yield str(address)
+
+    def make_tests(self, size, mix=None):
+        '''
+        Test configurations for size tests dealt out according to the mix
+        (default the --mix given). Every error_every'th HTTP(S) test asks for
+        the error status instead
+        '''
+        http_port, https_port = self.ports
+        kinds = []
+        for kind, weight in (mix or self.args.mix).items():
+            if kind == 'HTTPS' and https_port is None:
+                continue
+            kinds += [kind] * weight
+        hosts = self.ping_hosts()
+        tests = []
+        for num in range(size):
+            kind = kinds[num % len(kinds)]
+            test = {'desc': f'bench {num}', 'test': kind, 'active': True,
+                    'interval': self.args.interval, 'reuse': self.args.reuse,
+                    'tls': self.args.tls}
+            if kind == 'PING':
+                test['host'] = next(hosts)
+            elif kind == 'TCP':
+                test['host'] = f'127.0.0.1:{http_port}'
+            else:
+                status = 200
+                if self.args.error_every and num % self.args.error_every == 0:
+                    status = self.args.error_status
+                port = http_port if kind == 'HTTP' else https_port
+                test['host'] = f'127.0.0.1:{port}/?delay={self.args.delay:g}&status={status}'
+            tests.append(test)
+        return tests
+
+    def measure(self, tests):
+        '''
+        Warm up round then timed rounds of a list of tests, returns the
+        report, round durations, RTTs by test type, the PING RTTs of each
+        test in order, wall time, parent and worker CPU time and tester stats
+        '''
+        report = {'started': False, 'time': False, 'count': 0, 'duration': 0}
+        report['tests'] = [
+            OmniPingTestState(test, pos, self.args.interval, ['reuse', 'tls'])
+            for pos, test in enumerate(tests)
+        ]
+        samples = {}
+        pings = {}
+
+        def on_result(test, rtt, code):
+            if rtt is not None:
+                samples.setdefault(test.test, []).append(rtt)
+                if test.test == 'PING':
+                    pings.setdefault(test.pos, []).append(rtt)
+
+        tester = OmniPingTester(
+                    interval=self.args.interval,
+                    http_pool_size=self.args.pool,
+                    dispatch=self.args.dispatch,
+                    max_concurrency=self.args.max_concurrency,
+                    http_workers=self.args.http_workers,
+                    timeouts=self.args.timeouts,
+                    timeout_floor=self.args.timeout_floor,
+                    )
+        tester.start(on_result=on_result)
+        try:
+            tester.run_once(report)
+            samples.clear()
+            pings.clear()
+            for test in report['tests']:
+                test.total = test.total_successes = test.total_timeouts = 0
+            gc.collect()
+
+            durations = []
+            worker_start = self.worker_cpu(tester)
+            cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+            for _ in range(self.args.rounds):
+                round_start = time.perf_counter()
+                tester.run_once(report)
+                durations.append(time.perf_counter() - round_start)
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            worker_cpu = self.worker_cpu(tester) - worker_start
+            stats = tester.stats()
+        finally:
+            tester.stop()
+        return report, durations, samples, pings, wall, cpu, worker_cpu, stats
+
+    @staticmethod
+    def worker_cpu(tester):
+        '''
+        CPU time (seconds) used so far by the tester's HTTP worker processes,
+        which the tester's own process_time doesn't include
+        '''
+        if not tester.workers:
+            return 0.0
+        tester.loop.run(tester.workers.refresh_stats(), 5)
+        return tester.workers.stats().get('cpu_sec', 0.0)
+
+    def icmp_stats(self, pings):
+        '''
+        ICMP RTTs and jitter, the jitter being the difference between
+        each PING test's successive RTTs (as RTP measures it, RFC 3550)
+        '''
+        jitter = []
+        for rtts in pings.values():
+            jitter += [abs(rtt - last) for last, rtt in zip(rtts, rtts[1:])]
+        rtts = [rtt for test_rtts in pings.values() for rtt in test_rtts]
+        return {'rtt_ms': self.summary(rtts), 'jitter_ms': self.summary(jitter)}
+
+    def baseline(self, size):
+        '''
+        The same number of PING tests run on their own, compared with the
+        ICMP results of the mix (mix less baseline, so positive is worse)
+        '''
+        count = sum(1 for test in self.make_tests(size) if test['test'] == 'PING')
+        if not count:
+            return None
+        _, _, _, alone, _, cpu, _, _ = self.measure(self.make_tests(count, {'PING': 1}))
+        return {'tests': count, 'cpu_sec': round(cpu, 3), **self.icmp_stats(alone)}
+
+    def run_size(self, size):
+        '''
+        Timed rounds of one test count, preceded by the PING only
+        baseline if asked for
+        '''
+        baseline = self.baseline(size) if self.args.baseline else None
+        tests = self.make_tests(size)
+        report, durations, samples, pings, wall, cpu, worker_cpu, stats = self.measure(tests)
+
+        probes = sum(test.total for test in report['tests'])
+        successes = sum(test.total_successes for test in report['tests'])
+        overruns = [max(0.0, duration - self.args.interval) for duration in durations]
+        result = {}
+        result['bench_version'] = BENCH_VERSION
+        result['time'] = datetime.now().isoformat(timespec='seconds')
+        result['python'] = platform.python_version()
+        result['platform'] = platform.platform()
+        result['size'] = size
+        result['mix'] = {kind: sum(1 for test in tests if test['test'] == kind)
+                         for kind in self.args.mix}
+        result['interval'] = self.args.interval
+        result['dispatch'] = self.args.dispatch
+        result['max_concurrency'] = self.args.max_concurrency
+        result['http_workers'] = self.args.http_workers
+        result['timeouts'] = self.args.timeouts
+        result['rounds'] = self.args.rounds
+        result['probes'] = probes
+        result['success_percent'] = round(successes / probes * 100, 2) if probes else 0.0
+        result['rounds_per_sec'] = round(self.args.rounds / wall, 3)
+        result['probes_per_sec'] = round(probes / wall, 1)
+        result['cpu_sec'] = round(cpu + worker_cpu, 3)
+        result['parent_cpu_sec'] = round(cpu, 3)
+        result['worker_cpu_sec'] = round(worker_cpu, 3)
+        result['cpu_us_per_probe'] = round((cpu + worker_cpu) / probes * 1e6, 1) if probes else None
+        result['round_ms'] = self.summary([duration * 1000 for duration in durations])
+        result['overrun_ms'] = self.summary([overrun * 1000 for overrun in overruns])
+        result['overrun_rounds'] = sum(1 for overrun in overruns if overrun > 0)
+        result['rss_kb'] = self.rss_kb()
+        result['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['rtt_error_ms'] = {}
+        for kind, rtts in samples.items():
+            expected = 0.0 if kind in ('PING', 'TCP') else self.args.delay
+            result['rtt_error_ms'][kind] = self.summary([rtt - expected for rtt in rtts])
+        result['timed_out'] = sum(test.total_timeouts for test in report['tests'])
+        result['icmp'] = self.icmp_stats(pings)
+        if baseline:
+            result['ping_baseline'] = baseline
+            result['icmp_vs_baseline_ms'] = {
+                measure: {
+                    key: round(result['icmp'][measure][key] - baseline[measure][key], 3)
+                    for key in ('mean', 'p50', 'p95', 'max')
+                    if key in result['icmp'][measure] and key in baseline[measure]
+                }
+                for measure in ('rtt_ms', 'jitter_ms')
+            }
+        result['http_pool'] = stats['http_pool']
+        return result
+
+    @staticmethod
+    def summary(values):
+        '''
+        count, mean and percentiles of a list of measurements
+        '''
+        ordered = sorted(value for value in values if not math.isnan(value))
+        if not ordered:
+            return {'count': 0}
+        return {
+            'count': len(ordered),
+            'mean': round(sum(ordered) / len(ordered), 3),
+            'p50': round(percentile(ordered, 50), 3),
+            'p95': round(percentile(ordered, 95), 3),
+            'max': round(ordered[-1], 3),
+        }
+
+    @staticmethod
+    def rss_kb():
+        '''
+        Current resident set size, Linux only
+        '''
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def run(self):
+        '''
+        Start the targets and run every size, yields a result per size
+        '''
+        raise_fd_limit()
+        context = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory() as path:
+            certificate = make_certificate(path) if 'HTTPS' in self.args.mix else None
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=target_main, args=(child_conn, certificate),
+                                      name='omniping-bench-targets', daemon=True)
+            process.start()
+            child_conn.close()
+            try:
+                self.ports = parent_conn.recv()
+                if 'HTTPS' in self.args.mix and self.ports[1] is None:
+                    print('[EE] openssl unavailable, HTTPS tests skipped', file=sys.stderr)
+                for size in self.args.sizes:
+                    yield self.run_size(size)
+            finally:
+                parent_conn.close()
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+
+
+def parse_mix(text):
+    '''
+    ping=1,http=1,https=1 -> {'PING': 1, 'HTTP': 1, 'HTTPS': 1}
+    '''
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip().upper()
+        if kind not in ('PING', 'HTTP', 'HTTPS', 'TCP'):
+            raise argparse.ArgumentTypeError(f'Unknown test type {kind}')
+        mix[kind] = int(weight or 1)
+    return {kind: weight for kind, weight in mix.items() if weight > 0}
+
+
+def main(argv=None):
+    '''
+    Parse the arguments and write a JSON line per size
+    '''
+    parser = argparse.ArgumentParser(description='OmniPing offline engine benchmark')
+    parser.add_argument('--sizes', default='10,100,1000',
+                        type=lambda text: [int(size) for size in text.split(',')],
+                        help='comma separated test counts (default 10,100,1000)')
+    parser.add_argument('--mix', default='ping=1,http=1,https=1', type=parse_mix,
+                        help='test type weights, ping/http/https/tcp (default ping=1,http=1,https=1)')
+    parser.add_argument('--rounds', default=5, type=int, help='timed rounds per size')
+    parser.add_argument('--baseline', action='store_true',
+                        help='also run each size\'s PING tests on their own and compare '
+                             'the ICMP RTT and jitter with those under the mix')
+    parser.add_argument('--interval', default=2.0, type=float,
+                        help='test interval, rounds over this count as overruns')
+    parser.add_argument('--delay', default=10.0, type=float,
+                        help='stand-in server response delay in ms')
+    parser.add_argument('--error-every', default=10, type=int,
+                        help='every Nth HTTP(S) test gets the error status (0 for none)')
+    parser.add_argument('--error-status', default=404, type=int)
+    parser.add_argument('--reuse', default='fresh', choices=OmniPingHttpPool.reuse_policies)
+    parser.add_argument('--tls', default='resume', choices=['resume', 'full'],
+                        help='resume TLS sessions or make full handshakes')
+    parser.add_argument('--http-workers', default=0, type=int,
+                        help='worker processes for the HTTP(S) tests (0 for the tester loop)')
+    parser.add_argument('--timeouts', default='fixed', choices=OmniPingTimeouts.modes,
+                        help='fixed timeouts or ones adapting to each test RTT')
+    parser.add_argument('--timeout-floor', default=0.1, type=float,
+                        help='shortest adaptive timeout in seconds')
+    parser.add_argument('--dispatch', default='burst', choices=OmniPingPacer.modes,
+                        help='how test start times are spread across the interval')
+    parser.add_argument('--max-concurrency', default=0, type=int,
+                        help='cap on tests running at once (0 for none)')
+    parser.add_argument('--pool', default=4, type=int, help='keep-alive client pool size')
+    parser.add_argument('--ping-prefix', default='127.0.0.0/16',
+                        help='PING target prefix, e.g. a subnet on a dummy interface')
+    parser.add_argument('--output', help='append JSON lines to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for result in OmniPingBench(args).run():
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            print(f"[II] {result['size']} tests: {result['rounds_per_sec']} rounds/s "
+                  f"{result['cpu_us_per_probe']} us cpu/probe "
+                  f"({result['parent_cpu_sec']}s parent {result['worker_cpu_sec']}s workers) "
+                  f"{result['overrun_rounds']}/{result['rounds']} overran", file=sys.stderr)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+'''
+Headless command line mode: runs the tests in hosts.json, or those given
+on the command line, without the web server and writes a JSON line per
+result to stdout (or a file). The exit code is 1 if more tests failed
+than allowed, so it can gate a CI pipeline or a change window, e.g.
+
+    python3 omniping_cli.py "192.168.1.1 ; gateway ; PING ; count=5" --rounds 3
+    python3 omniping_cli.py --hosts hosts.json --duration 600 --output results.jsonl
+'''
+import argparse
+from datetime import datetime
+import json
+import os
+import sys
+import time
+
+from omniping_config import OmniPingConfig
+from omniping_loop import log_stderr
+from omniping_state import OmniPingTestState
+from omniping_tester import OmniPingTester
+from omniping_timeouts import OmniPingTimeouts
+
+# hosts.json settings handed to the tester as they are
+TESTER_SETTINGS = (
+    'http_pool_size', 'http_idle_timeout', 'http_workers', 'dns_ttl', 'dns_negative_ttl',
+    'dispatch', 'dispatch_seed', 'max_concurrency', 'subnet_rate',
+    'timeouts', 'timeout_floor', 'timeout_ceiling',
+)
+
+
+def parse_test(spec):
+    '''
+    A test in the setup page's syntax, "host ; description ; type"
+    optionally followed by "; name=value name=value ..."
+    '''
+    fields = [field.strip() for field in spec.split(';')]
+    if len(fields) not in (3, 4):
+        raise ValueError(f'Expected "host ; description ; type [; options]" - {spec}')
+    test = {'host': fields[0], 'desc': fields[1], 'test': fields[2].upper(), 'active': True}
+    if len(fields) == 4:
+        for option in fields[3].split():
+            name, _, value = option.partition('=')
+            test[name.lower()] = value
+    return test
+
+
+class OmniPingCli():
+    '''
+    Runs the tests on a tester of its own and writes each result
+    as it arrives, either for a number of rounds (each test once a
+    round, a round every interval) or scheduled for a duration
+    '''
+
+    def __init__(self, args, config, tests):
+        self.args = args
+        self.config = config
+        self.output = sys.stdout
+        self.results = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.report = {'started': False, 'time': False, 'count': 0, 'duration': 0}
+        self.report['tests'] = [
+            OmniPingTestState(test, pos, config['interval'], OmniPingConfig.test_options)
+            for pos, test in enumerate(tests)
+        ]
+
+    def on_result(self, test, rtt, code):
+        '''
+        Write a result, called on the tester's loop thread
+        '''
+        result = {}
+        result['time'] = datetime.now().isoformat(timespec='milliseconds')
+        result['round'] = self.report['count']
+        result['pos'] = test.pos
+        result['host'] = test.host
+        result['desc'] = test.desc
+        result['test'] = test.test
+        result['status'] = test.status
+        result['good'] = test.good
+        result['rtt'] = None if rtt is None else round(rtt, 3)
+        result['code'] = code
+        result['dns'] = None if test.dns is None else round(test.dns, 3)
+        result['timeout'] = None if test.timeout is None else round(test.timeout * 1000, 1)
+        if test.burst is not None:
+            result['burst'] = test.burst
+        if test.timings is not None:
+            result['timings'] = test.timings
+        self.output.write(json.dumps(result) + '\n')
+        self.output.flush()
+        self.results += 1
+        if not test.good:
+            self.failures += 1
+            if test.status == 'Time Out':
+                self.timeouts += 1
+
+    def make_tester(self):
+        '''
+        A tester set up as hosts.json says, with the command line's overrides
+        '''
+        tester_kwargs = {key: self.config[key] for key in TESTER_SETTINGS}
+        if self.args.timeouts:
+            tester_kwargs['timeouts'] = self.args.timeouts
+        return OmniPingTester(interval=self.config['interval'], log=log_stderr, **tester_kwargs)
+
+    def run(self):
+        '''
+        Run the tests until the rounds are done or the duration is up
+        '''
+        tester = self.make_tester()
+        deadline = None
+        if self.args.duration:
+            deadline = time.monotonic() + self.args.duration
+        try:
+            if self.args.rounds or not deadline:
+                tester.start(on_result=self.on_result)
+                rounds = self.args.rounds or 1
+                for num in range(rounds):
+                    start = time.monotonic()
+                    tester.run_once(self.report)
+                    pause = max(self.config['interval'] - (time.monotonic() - start), 0)
+                    if num + 1 == rounds or (deadline and time.monotonic() + pause >= deadline):
+                        break
+                    time.sleep(pause)
+            else:
+                tester.start(self.report, on_result=self.on_result)
+                time.sleep(max(deadline - time.monotonic(), 0))
+        except KeyboardInterrupt:
+            log_stderr('[II] Interrupted')
+        finally:
+            tester.stop()
+
+    def exit_code(self):
+        '''
+        1 if more results failed than allowed
+        '''
+        return 1 if self.failures > self.args.allowed_failures else 0
+
+
+def main(argv=None):
+    '''
+    Parse the arguments, run the tests and exit with the result
+    '''
+    parser = argparse.ArgumentParser(
+                description='Run OmniPing tests without the web interface, '
+                            'writing a JSON line per result')
+    parser.add_argument('tests', nargs='*',
+                        help='tests as "host ; description ; type [; name=value ...]", '
+                             'run instead of those in hosts.json')
+    parser.add_argument('--hosts', help='hosts.json to read settings and tests from '
+                                        '(default ./hosts.json if no tests are given)')
+    parser.add_argument('--rounds', type=int, default=0,
+                        help='run every test this many times, a round each interval '
+                             '(default 1 unless --duration is given)')
+    parser.add_argument('--duration', type=float, default=0,
+                        help='seconds to run for, each test at its own interval')
+    parser.add_argument('--interval', type=float, help='seconds between rounds')
+    parser.add_argument('--timeouts', choices=OmniPingTimeouts.modes,
+                        help='fixed timeouts or ones adapting to each test RTT')
+    parser.add_argument('--allowed-failures', type=int, default=0,
+                        help='failed results allowed before exiting with 1 (default 0)')
+    parser.add_argument('--output', help='append the JSON lines to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    host_file = args.hosts
+    if host_file is None and not args.tests and os.path.exists('hosts.json'):
+        host_file = 'hosts.json'
+    config = OmniPingConfig.defaults()
+    if host_file:
+        try:
+            config = OmniPingConfig.read_config(host_file)
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            parser.error(f'Unable to read {host_file} - {e}')
+    checker = OmniPingConfig()
+    for message in checker.check_settings(config):
+        parser.error(f'{message} in {host_file}')
+    if args.interval:
+        config['interval'] = args.interval
+
+    tests = []
+    if args.tests:
+        for spec in args.tests:
+            try:
+                test = parse_test(spec)
+            except ValueError as e:
+                parser.error(str(e))
+            if not checker.is_valid_test(test):
+                parser.error(f'Invalid Test - {spec}')
+            tests.append(test)
+    elif host_file:
+        tests = [test for test in config['tests'] if test.get('active')]
+        for test in tests:
+            if not checker.is_valid_test(test):
+                parser.error(f'Invalid Test in {host_file} - {test.get("host")}')
+    if not tests:
+        parser.error('No active tests to run')
+
+    cli = OmniPingCli(args, config, tests)
+    if args.output:
+        cli.output = open(args.output, 'a')
+    try:
+        cli.run()
+    finally:
+        if args.output:
+            cli.output.close()
+    log_stderr(f'[II] {cli.results} results, {cli.failures} failed '
+               f'({cli.timeouts} timed out)')
+    return cli.exit_code()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+'''
+The hosts.json configuration: its defaults and the validation of the
+tests in it, without the web server so the CLI can use it too
+'''
+import copy
+import json
+import re
+from urllib.parse import urlsplit
+
+
+class OmniPingConfig():
+    '''
+    Defaults and validation of the configuration and tests,
+    see OmniPingSetUp for the setup page built on it
+    '''
+
+    default_config = {}
+    default_config['tests'] = [{
+            "active": False,
+            "desc": "Useful Description",
+            "host": "192.168.1.205",
+            "test": "PING"
+        },
+        {
+            "active": False,
+            "desc": "Useful Description",
+            "host": "10.255.255.6",
+            "test": "HTTP"
+        }]
+    default_config['heading'] = 'OmniPing'
+    default_config['colour'] = '#FFFFFF'
+    default_config['interval'] = 4.0
+    default_config['http_pool_size'] = 4
+    default_config['http_idle_timeout'] = 60.0
+    default_config['http_workers'] = 0
+    # Samples and 1m/5m/1h rollup buckets kept per test. They are allocated
+    # as they fill, once full the defaults take about 95KB a test (18 bytes
+    # a sample, 32 a bucket), so lower them for many thousands of tests
+    default_config['history_size'] = 1800
+    default_config['rollup_sizes'] = [720, 864, 336]
+    default_config['event_log_size'] = 10000
+    default_config['dns_ttl'] = 60.0
+    default_config['dns_negative_ttl'] = 10.0
+    default_config['shards'] = 0
+    default_config['dispatch'] = 'burst'
+    default_config['dispatch_seed'] = None
+    default_config['max_concurrency'] = 0
+    default_config['subnet_rate'] = 0.0
+    default_config['timeouts'] = 'fixed'
+    default_config['timeout_floor'] = 0.1
+    default_config['timeout_ceiling'] = 2.0
+    default_config['stream_clients'] = 4
+    default_config['stream_queue'] = 256
+    # Journal every result to disk (in journal/ beside hosts.json) so the
+    # counters and history survive a restart, off unless asked for
+    default_config['journal'] = False
+    default_config['journal_segment_size'] = 4194304
+    default_config['journal_max_size'] = 67108864
+
+    colour_re = r'^\s*(#[0-9a-f]{6})\s*$'
+    desc_re = r'^\s?([0-9a-z\-\_\'\. #]+)\s?$'
+    host_re = r'^\s?([0-9a-z\.:\/]+)\s?$'
+    host_http_re = r'^\s?([0-9a-z\.:\/]+)\s?$'
+    host_ping_re = r'^\s?([0-9a-z\.]+)\s?$'
+    host_tcp_re = r'^\s?([0-9a-z\.]+):([0-9]{1,5})\s?$'
+
+    # Optional per test settings: name -> (type, minimum, maximum)
+    # or a list of the acceptable (lower case) values
+    test_options = {}
+    test_options['interval'] = (float, 1, 1000)
+    test_options['reuse'] = ['fresh', 'keepalive']
+    test_options['resolve'] = ['cached', 'always']
+    test_options['count'] = (int, 1, 100)
+    test_options['spacing'] = (float, 0.01, 10)
+    test_options['size'] = (int, 0, 65507)
+    test_options['fetch'] = ['body', 'headers', 'head']
+    test_options['tls'] = ['resume', 'full']
+
+    # The engine settings, checked the same way when hosts.json is read
+    setting_options = {}
+    setting_options['interval'] = (float, 1, 1000)
+    setting_options['http_pool_size'] = (int, 1, 1000)
+    setting_options['http_idle_timeout'] = (float, 0, 86400)
+    setting_options['http_workers'] = (int, 0, 256)
+    setting_options['history_size'] = (int, 1, 10000000)
+    setting_options['event_log_size'] = (int, 1, 10000000)
+    setting_options['dns_ttl'] = (float, 0, 86400)
+    setting_options['dns_negative_ttl'] = (float, 0, 86400)
+    setting_options['shards'] = (int, 0, 256)
+    setting_options['dispatch'] = ['burst', 'spread', 'jitter']
+    setting_options['max_concurrency'] = (int, 0, 1000000)
+    setting_options['subnet_rate'] = (float, 0, 1000000)
+    setting_options['timeouts'] = ['fixed', 'adaptive']
+    setting_options['timeout_floor'] = (float, 0.001, 60)
+    setting_options['timeout_ceiling'] = (float, 0.001, 60)
+    setting_options['stream_clients'] = (int, 0, 10000)
+    setting_options['stream_queue'] = (int, 1, 1000000)
+    setting_options['journal_segment_size'] = (int, 65536, 2 ** 31)
+    setting_options['journal_max_size'] = (int, 65536, 2 ** 40)
+
+    @classmethod
+    def defaults(cls):
+        '''
+        A copy of the default configuration, deep so its lists
+        aren't shared with default_config
+        '''
+        return copy.deepcopy(cls.default_config)
+
+    @staticmethod
+    def read_file(host_file):
+        '''
+        Only what is in a hosts.json file, without the defaults
+        '''
+        with open(host_file, 'r') as tests_file:
+            return json.load(tests_file)
+
+    @classmethod
+    def read_config(cls, host_file):
+        '''
+        The configuration in a hosts.json file over the defaults
+        '''
+        config = cls.defaults()
+        config.update(cls.read_file(host_file))
+        return config
+
+    def is_valid_test(self, test):
+        '''
+        Validate parameters of each test dictionary
+        '''
+        if not isinstance(test, dict):
+            return False
+        valid_keys = ['host', 'desc', 'test', 'active']
+        for key in valid_keys:
+            if key not in test.keys():
+                return False
+            if key != 'active' and not isinstance(test[key], str):
+                return False
+
+        if test.get('test', '').upper() not in ['PING', 'HTTP', 'HTTPS', 'TCP']:
+            return False
+
+        host_match = re.match(self.host_http_re, test.get('host', '%'), re.IGNORECASE)
+
+        if test.get('test', '').upper() in ['PING']:
+            host_match = re.match(self.host_ping_re, test.get('host', '%'), re.IGNORECASE)
+
+        if test.get('test', '').upper() in ['TCP']:
+            host_match = re.match(self.host_tcp_re, test.get('host', '%'), re.IGNORECASE)
+            if host_match and not 0 < int(host_match.group(2)) < 65536:
+                return False
+
+        if not host_match:
+            return False
+
+        desc_match = re.match(self.desc_re, test.get('desc', '%'), re.IGNORECASE)
+        if not desc_match:
+            return False
+
+        if not isinstance(test['active'], bool):
+            return False
+
+        for key in test.keys():
+            if key in valid_keys:
+                continue
+            value = self.check_option(key, test[key])
+            if value is None:
+                return False
+            test[key] = value
+        return True
+
+    def check_option(self, key, value):
+        '''
+        Validate an optional test setting returning
+        the converted value or None if invalid
+        '''
+        option = self.test_options.get(key)
+        if option is None:
+            return None
+        return self.check_value(option, value)
+
+    @staticmethod
+    def check_value(option, value):
+        '''
+        Convert a value to an option's type, None if it isn't
+        one of its values or is outside its range
+        '''
+        if isinstance(option, list):
+            value = str(value).lower()
+            return value if value in option else None
+        value_type, minimum, maximum = option
+        try:
+            value = value_type(value)
+        except (TypeError, ValueError):
+            return None
+        if isinstance(value, bool) or not minimum <= value <= maximum:
+            return None
+        return value
+
+    def check_settings(self, config):
+        '''
+        Validate and convert the engine settings in a configuration,
+        putting invalid ones back to their defaults. Returns a message
+        for each one that was
+        '''
+        messages = []
+        for key, option in self.setting_options.items():
+            value = self.check_value(option, config.get(key))
+            if value is None:
+                value = self.default_config[key]
+                messages.append(f'Invalid {key} - {config.get(key)!r} using {value!r}')
+            config[key] = value
+        sizes = config.get('rollup_sizes')
+        option = (int, 0, 10000000)
+        if (not isinstance(sizes, list) or len(sizes) != len(self.default_config['rollup_sizes'])
+                or any(self.check_value(option, size) is None for size in sizes)):
+            messages.append(f'Invalid rollup_sizes - {sizes!r} '
+                            f'using {self.default_config["rollup_sizes"]!r}')
+            config['rollup_sizes'] = list(self.default_config['rollup_sizes'])
+        else:
+            config['rollup_sizes'] = [int(size) for size in sizes]
+        if not isinstance(config.get('journal'), bool):
+            messages.append(f'Invalid journal - {config.get("journal")!r} using False')
+            config['journal'] = False
+        return messages
+
+    @staticmethod
+    def test_key(test):
+        '''
+        Stable identity of a test: type, host and port
+        '''
+        test_type = str(test.get('test', '')).upper()
+        host = str(test.get('host', '')).strip().lower()
+        port = ''
+        if test_type in ['HTTP', 'HTTPS', 'TCP']:
+            parts = urlsplit(f'//{host}')
+            try:
+                port = parts.port or (80 if test_type == 'HTTP' else 443)
+            except ValueError:
+                pass
+            host = parts.hostname or host
+        return f'{test_type}|{host}|{port}'
+
+    @classmethod
+    def make_keys(cls, tests):
+        '''
+        Keys of a list of tests, repeats of a key are numbered
+        '''
+        keys = []
+        seen = {}
+        for test in tests:
+            key = cls.test_key(test)
+            seen[key] = seen.get(key, 0) + 1
+            if seen[key] > 1:
+                key = f'{key}#{seen[key]}'
+            keys.append(key)
+        return keys
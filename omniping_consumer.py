@@ -0,0 +1,67 @@
+'''
+Runs the engine's bookkeeping (rendering, history, journal, streaming)
+on a thread of its own, so the tester's loop which times the probes
+only has to queue it up
+'''
+import queue
+import threading
+import time
+
+from omniping_loop import log_stderr
+
+
+class OmniPingConsumer():
+    '''
+    A thread calling the functions queued to it in the order they were
+    queued, so a round is only rendered after its results are recorded
+    '''
+
+    def __init__(self, name='omniping-consumer', log=log_stderr):
+        self.log = log
+        self.queue = queue.SimpleQueue()
+        self.handled = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, func, *args):
+        '''
+        Queue a call, safe from any thread
+        '''
+        self.queue.put((func, args))
+
+    def run(self):
+        '''
+        Thread body, make the queued calls until the process ends
+        '''
+        while True:
+            func, args = self.queue.get()
+            start = time.perf_counter()
+            try:
+                func(*args)
+            except Exception as e:
+                self.errors += 1
+                self.log(f'[EE] {func.__name__} failed - {e}')
+            finally:
+                self.busy += time.perf_counter() - start
+                self.handled += 1
+
+    def wait(self):
+        '''
+        Block until everything queued so far has been handled
+        '''
+        done = threading.Event()
+        self.put(done.set)
+        done.wait()
+
+    def stats(self):
+        '''
+        Backlog and work done returned with the engine stats
+        '''
+        return {
+            'backlog': self.queue.qsize(),
+            'handled': self.handled,
+            'errors': self.errors,
+            'busy': round(self.busy, 3),
+        }
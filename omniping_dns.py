@@ -0,0 +1,120 @@
+'''
+Asynchronous name resolution cache shared by all of the tests
+'''
+import asyncio
+import ipaddress
+import socket
+import time
+
+
+class OmniPingResolver():
+    '''
+    Caches getaddrinfo results so probes don't pay resolver latency
+    (or send resolver traffic) on every test.
+    The system resolver does not expose record TTLs so answers are kept
+    for ttl seconds and failures for negative_ttl seconds. Entries used
+    in the last quarter of their lifetime are refreshed in the background
+    while the cached answer continues to be served, concurrent lookups
+    of the same name share one query
+    '''
+
+    def __init__(self, ttl=60.0, negative_ttl=10.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = {}
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.refreshes = 0
+
+    @staticmethod
+    def literal(host):
+        '''
+        (family, address) if host is an IP address, otherwise None
+        '''
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return None
+        family = socket.AF_INET if address.version == 4 else socket.AF_INET6
+        return family, str(address)
+
+    async def resolve(self, host, fresh=False):
+        '''
+        Returns (family, address, dns_ms), dns_ms is 0 for cache hits.
+        fresh=True always queries the resolver (and updates the cache).
+        Raises socket.gaierror if the name doesn't resolve
+        '''
+        literal = self.literal(host)
+        if literal:
+            return literal[0], literal[1], 0.0
+
+        entry = self.cache.get(host)
+        now = time.monotonic()
+        if entry and not fresh and entry['expires'] > now:
+            if entry['error']:
+                self.negative_hits += 1
+                raise socket.gaierror(entry['error'])
+            self.hits += 1
+            if entry['expires'] - now < self.ttl / 4 and host not in self.inflight:
+                self.refreshes += 1
+                asyncio.ensure_future(self.lookup(host)).add_done_callback(self.consume)
+            return entry['family'], entry['address'], 0.0
+
+        self.misses += 1
+        start = time.perf_counter()
+        entry = await self.lookup(host)
+        dns_ms = (time.perf_counter() - start) * 1000
+        if entry['error']:
+            raise socket.gaierror(entry['error'])
+        return entry['family'], entry['address'], dns_ms
+
+    async def lookup(self, host):
+        '''
+        Query the resolver, sharing the query with concurrent callers
+        '''
+        if host not in self.inflight:
+            self.inflight[host] = asyncio.ensure_future(self.query(host))
+        return await asyncio.shield(self.inflight[host])
+
+    async def query(self, host):
+        '''
+        The actual getaddrinfo call, the result is cached here
+        '''
+        entry = {'family': None, 'address': None, 'error': None}
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            family, _, _, _, sockaddr = infos[0]
+            entry['family'] = family
+            entry['address'] = sockaddr[0]
+            entry['expires'] = time.monotonic() + self.ttl
+        except (socket.gaierror, UnicodeError) as err:
+            entry['error'] = str(err)
+            entry['expires'] = time.monotonic() + self.negative_ttl
+        finally:
+            self.inflight.pop(host, None)
+        self.cache[host] = entry
+        return entry
+
+    @staticmethod
+    def consume(task):
+        '''
+        Retrieve background refresh results so errors aren't reported as unhandled
+        '''
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        '''
+        Cache usage counts
+        '''
+        return {
+            'entries': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'refreshes': self.refreshes,
+            'ttl': self.ttl,
+            'negative_ttl': self.negative_ttl,
+        }
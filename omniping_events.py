@@ -0,0 +1,214 @@
+'''
+Log of the tests changing between good and bad results
+i.e. http://<omniping>/omniping/events?after=<seq>
+     http://<omniping>/omniping/events?since=2024-06-01T02:00&pos=3
+The web page doesn't read this, it is for scripts and other tools
+(transitions are also pushed to /omniping/stream as they happen)
+'''
+from bisect import bisect_right
+import threading
+import time
+
+import cherrypy
+
+from omniping_history import OmniPingRing
+from omniping_test_hist import OmniPingTestRange
+
+
+class OmniPingEvents(OmniPingRing):
+    '''
+    Fixed size ring of transitions, the oldest dropped once full.
+    Events are numbered in order so a client can ask for those after
+    the last one it has seen, found by position in the ring, or those
+    since a time by binary search. Each test's event numbers are kept
+    in order as well, as [numbers, start] with start moving past those
+    evicted, and the tests currently down in a dict, so no query has
+    to scan the whole log
+    '''
+
+    columns = ('times', 'events')
+
+    def __init__(self, size=10000):
+        super().__init__(max(1, int(size)))
+        self.events = [None] * self.capacity
+        self.seq = 0
+        self.states = {}
+        self.by_test = {}
+        self.down = {}
+        self.lock = threading.Lock()
+
+    def first_seq(self):
+        '''
+        Number of the oldest event held
+        '''
+        return self.seq - self.count + 1
+
+    def observe(self, test, stamp=None):
+        '''
+        Check a test's latest result for a transition, stamp is the (wall
+        clock) time of the result. The first result only counts if it's
+        bad, so a test failing from the start shows as down.
+        Returns the event or None
+        '''
+        stamp = time.time() if stamp is None else stamp
+        state = self.states.get(test.pos)
+        if state is not None and state[0] == test.good:
+            return None
+        self.states[test.pos] = (test.good, stamp, test.status)
+        if state is None and test.good:
+            return None
+        event = {}
+        event['time'] = stamp
+        event['pos'] = test.pos
+        event['host'] = test.host
+        event['desc'] = test.desc
+        event['test'] = test.test
+        event['state'] = 'up' if test.good else 'down'
+        event['status'] = test.status
+        event['previous'] = None if state is None else state[2]
+        event['duration'] = None if state is None else round(stamp - state[1], 3)
+        with self.lock:
+            self.append(event)
+            if test.good:
+                self.down.pop(test.pos, None)
+            else:
+                self.down[test.pos] = event
+        return event
+
+    def append(self, event):
+        '''
+        Number and store an event, lock held. The event it overwrites is
+        the oldest held so it is also the oldest in its test's list
+        '''
+        pos = self.pos
+        evicted = self.events[pos] if self.count == self.size else None
+        if evicted is not None:
+            held = self.by_test.get(evicted['pos'])
+            if held and held[1] < len(held[0]) and held[0][held[1]] == evicted['seq']:
+                held[1] += 1
+                if held[1] * 2 > len(held[0]):
+                    del held[0][:held[1]]
+                    held[1] = 0
+        self.seq += 1
+        event['seq'] = self.seq
+        self.events[pos] = event
+        self.times[pos] = event['time']
+        self.advance()
+        self.by_test.setdefault(event['pos'], [[], 0])[0].append(self.seq)
+
+    def after(self, seq=0, pos=None, limit=1000):
+        '''
+        Events numbered after seq, for one test or all of them, oldest first
+        '''
+        with self.lock:
+            first = self.first_seq()
+            if pos is None:
+                start = max(seq + 1 - first, 0)
+                return [self.events[self.index(logical)]
+                        for logical in range(start, min(self.count, start + limit))]
+            seqs, held = self.by_test.get(pos, ([], 0))
+            start = bisect_right(seqs, max(seq, first - 1), held)
+            return [self.events[self.index(num - first)] for num in seqs[start:start + limit]]
+
+    def since(self, stamp, pos=None, limit=1000):
+        '''
+        Events at or after a (wall clock) time, for one test or all of them
+        '''
+        with self.lock:
+            seq = self.first_seq() + self.first_since(stamp) - 1
+        return self.after(seq, pos, limit)
+
+    def currently_down(self, pos=None, now=None):
+        '''
+        The tests down now, each with the event that took it down
+        and how long ago that was, longest down first
+        '''
+        now = time.time() if now is None else now
+        with self.lock:
+            events = [
+                event for event in self.down.values() if pos is None or event['pos'] == pos
+            ]
+        down = []
+        for event in sorted(events, key=lambda event: event['time']):
+            test_down = dict(event)
+            test_down['down_for'] = round(now - event['time'], 3)
+            down.append(test_down)
+        return down
+
+    def remove(self, pos):
+        '''
+        Forget a removed test's state, its past events stay in the log
+        '''
+        with self.lock:
+            self.states.pop(pos, None)
+            self.down.pop(pos, None)
+
+    def clear(self):
+        '''
+        Empty the log, i.e. when the report is reset
+        '''
+        with self.lock:
+            self.events = [None] * self.capacity
+            self.pos = 0
+            self.count = 0
+            self.states = {}
+            self.by_test = {}
+            self.down = {}
+
+    def info(self):
+        '''
+        Latest event number and counts returned with the report, a
+        client only needs to fetch events when seq has moved on
+        '''
+        return {'seq': self.seq, 'held': self.count, 'down': len(self.down)}
+
+
+class OmniPingEventsQuery():
+    '''
+    Returns the transitions logged by the test engine
+    '''
+
+    exposed = True
+
+    def __init__(self, test_engine):
+        self.test_engine = test_engine
+
+    @cherrypy.tools.json_out()
+    def GET(self, pos=None, after=None, since=None, limit=1000):
+        '''
+        Handle Get Requests for events
+         - after: events numbered after this (i.e. the last seq seen)
+         - since: events from this time, epoch seconds, ISO 8601 or
+           seconds before now if zero or negative (default all held)
+         - pos: a single test's events (default all)
+         - limit: most events returned (default 1000)
+        The tests currently down are always included
+        '''
+        events = self.test_engine.events
+        try:
+            limit = max(1, int(limit))
+            if pos is not None:
+                pos = int(pos)
+            if after is not None:
+                after = int(after)
+            if since is not None:
+                since = OmniPingTestRange.parse_time(since, time.time())
+        except ValueError:
+            mess = 'Invalid event number, time, test position or limit'
+            cherrypy.log(f'[EE] {mess}')
+            raise cherrypy.HTTPError(400, f'{mess}')
+
+        if after is not None:
+            found = events.after(after, pos, limit)
+        elif since is not None:
+            found = events.since(since, pos, limit)
+        else:
+            found = events.after(0, pos, limit)
+
+        response = {}
+        response.update(events.info())
+        response['first'] = events.first_seq()
+        response['events'] = found
+        response['down'] = events.currently_down(pos)
+        response['message'] = f'Retrieved {len(found)} events'
+        return response
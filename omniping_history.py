@@ -0,0 +1,547 @@
+'''
+Fixed size, array backed history of each test's results,
+with rollups of it into 1 minute, 5 minute and 1 hour buckets
+'''
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+import math
+import time
+
+# Status codes stored alongside each sample. HTTP(S) results
+# store the HTTP response code, failures a negative code
+STATUS_CODES = {}
+STATUS_CODES['Good'] = 0
+STATUS_CODES['Time Out'] = -1
+STATUS_CODES['Unreachable'] = -2
+STATUS_CODES['Bad Address'] = -3
+STATUS_CODES['Redirect Loop'] = -4
+STATUS_CODES['Refused'] = -5
+FAILED_CODE = -9
+
+# Phases of an HTTP(S) test timed in ms, see OmniPingHttpPool.get
+HTTP_PHASES = ('dns', 'connect', 'tls', 'ttfb', 'download')
+
+# Rollup tiers (name, bucket seconds) and the default number of buckets
+# kept of each: 12 hours of minutes, 3 days of 5 minutes, 2 weeks of hours
+ROLLUP_TIERS = (('1m', 60), ('5m', 300), ('1h', 3600))
+ROLLUP_SIZES = (720, 864, 336)
+# RTT histogram the rollups' p95 is taken from: 10 log spaced bins
+# per decade from 0.01ms, so the p95 is within about 12% of the true one
+P95_BINS = 80
+EMPTY_BINS = array('I', bytes(4 * P95_BINS))
+P95_BASE = 0.01
+P95_PER_DECADE = 10
+
+
+def status_code(status):
+    '''
+    Map a status string onto the code stored in the history
+    '''
+    return STATUS_CODES.get(status, FAILED_CODE)
+
+
+def percentile(ordered, percent):
+    '''
+    Nearest rank percentile of an already sorted list
+    '''
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def window_stats(rtts, times):
+    '''
+    Aggregates over a window of samples: loss, min/avg/max, percentiles and
+    jitter (mean difference between consecutive successful RTTs), in ms
+    to 3 decimal places as phase_stats gives them.
+    rtts are NaN for failed samples, times are the samples' timestamps
+    '''
+    good = [rtt for rtt in rtts if rtt == rtt]
+    stats = {}
+    stats['count'] = len(rtts)
+    stats['lost'] = len(rtts) - len(good)
+    stats['loss_percent'] = 0.0
+    if rtts:
+        stats['loss_percent'] = round(stats['lost'] / len(rtts) * 100, 3)
+    stats['min'] = stats['avg'] = stats['max'] = stats['jitter'] = None
+    stats['p50'] = stats['p95'] = stats['p99'] = None
+    if good:
+        ordered = sorted(good)
+        stats['min'] = round(ordered[0], 3)
+        stats['max'] = round(ordered[-1], 3)
+        stats['avg'] = round(sum(good) / len(good), 3)
+        stats['p50'] = round(percentile(ordered, 50), 3)
+        stats['p95'] = round(percentile(ordered, 95), 3)
+        stats['p99'] = round(percentile(ordered, 99), 3)
+        if len(good) > 1:
+            diffs = [abs(good[pos] - good[pos - 1]) for pos in range(1, len(good))]
+            stats['jitter'] = round(sum(diffs) / len(diffs), 3)
+    if times:
+        stats['first'] = times[0]
+        stats['last'] = times[-1]
+    return stats
+
+
+def phase_stats(values):
+    '''
+    avg/p50/p95/max of one phase's timings, NaN where it wasn't measured
+    '''
+    ordered = sorted(value for value in values if value == value)
+    stats = {'count': len(ordered), 'avg': None, 'p50': None, 'p95': None, 'max': None}
+    if ordered:
+        stats['avg'] = round(sum(ordered) / len(ordered), 3)
+        stats['p50'] = round(percentile(ordered, 50), 3)
+        stats['p95'] = round(percentile(ordered, 95), 3)
+        stats['max'] = round(ordered[-1], 3)
+    return stats
+
+
+def rtt_bin(rtt):
+    '''
+    The p95 histogram bin of an RTT (ms)
+    '''
+    if rtt <= P95_BASE:
+        return 0
+    return min(int(math.log10(rtt / P95_BASE) * P95_PER_DECADE) + 1, P95_BINS - 1)
+
+
+def bin_value(num):
+    '''
+    The RTT (ms) in the (geometric) middle of a p95 histogram bin
+    '''
+    if num == 0:
+        return P95_BASE
+    return P95_BASE * 10 ** ((num - 0.5) / P95_PER_DECADE)
+
+
+def rollup_stats(points):
+    '''
+    count, loss and min/avg/max over a list of rollup points, the
+    average weighted by each bucket's successful samples
+    '''
+    stats = {}
+    stats['count'] = sum(point[1] for point in points)
+    stats['lost'] = sum(point[2] for point in points)
+    stats['loss_percent'] = 0.0
+    if stats['count']:
+        stats['loss_percent'] = round(stats['lost'] / stats['count'] * 100, 3)
+    good = [point for point in points if point[5] is not None]
+    stats['min'] = stats['avg'] = stats['max'] = None
+    if good:
+        weights = [point[1] - point[2] for point in good]
+        stats['min'] = min(point[4] for point in good)
+        stats['max'] = max(point[6] for point in good)
+        stats['avg'] = round(sum(point[5] * weight for point, weight in zip(good, weights)) /
+                             sum(weights), 3)
+    return stats
+
+
+def mos(avg, jitter, loss_percent):
+    '''
+    Mean opinion score (1 to 4.5) estimated from latency, jitter and
+    loss with the usual simplified E-model, as a rough guide to how
+    a voice call over the path would fare
+    '''
+    latency = avg + jitter * 2 + 10
+    if latency < 160:
+        rating = 93.2 - latency / 40
+    else:
+        rating = 93.2 - (latency - 120) / 10
+    rating = min(max(rating - loss_percent * 2.5, 0), 100)
+    return 1 + 0.035 * rating + 0.000007 * rating * (rating - 60) * (100 - rating)
+
+
+def burst_stats(rtts):
+    '''
+    Summary of one burst of pings: loss, min/avg/max/mdev (as the ping
+    command reports them), jitter and MOS. rtts are None for lost packets
+    '''
+    good = [rtt for rtt in rtts if rtt is not None]
+    stats = {}
+    stats['sent'] = len(rtts)
+    stats['received'] = len(good)
+    stats['loss_percent'] = 0.0
+    if rtts:
+        stats['loss_percent'] = round((len(rtts) - len(good)) / len(rtts) * 100, 3)
+    stats['min'] = stats['avg'] = stats['max'] = stats['mdev'] = None
+    stats['jitter'] = stats['mos'] = None
+    if good:
+        avg = sum(good) / len(good)
+        stats['min'] = round(min(good), 3)
+        stats['avg'] = round(avg, 3)
+        stats['max'] = round(max(good), 3)
+        variance = sum(rtt * rtt for rtt in good) / len(good) - avg * avg
+        stats['mdev'] = round(math.sqrt(max(variance, 0)), 3)
+        jitter = 0.0
+        if len(good) > 1:
+            diffs = [abs(good[pos] - good[pos - 1]) for pos in range(1, len(good))]
+            jitter = sum(diffs) / len(diffs)
+        stats['jitter'] = round(jitter, 3)
+        stats['mos'] = round(mos(avg, jitter, stats['loss_percent']), 2)
+    return stats
+
+
+class OmniPingRing():
+    '''
+    Time ordered ring buffer positions, shared by the history and
+    its rollups. Subclasses add their own arrays of values, named in
+    columns. The arrays start small and double as they fill until they
+    reach size, so a test only takes the memory its entries need
+    '''
+
+    columns = ('times',)
+    # Entries allocated to start with
+    initial = 32
+
+    def __init__(self, size):
+        self.size = size
+        self.capacity = min(size, self.initial)
+        self.times = array('d', bytes(8 * self.capacity))
+        self.pos = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def advance(self):
+        '''
+        Move the write position on once an entry is complete
+        '''
+        self.count = min(self.count + 1, self.size)
+        self.pos = (self.pos + 1) % self.size
+        if self.pos == self.capacity:
+            self.grow()
+
+    def grow(self):
+        '''
+        Double the arrays, up to size, as the write position reaches
+        their end (which it only can before the ring first wraps round).
+        They are extended in place so readers' references stay good
+        '''
+        self.capacity = min(self.capacity * 2, self.size)
+        for name in self.columns:
+            self.extend(getattr(self, name))
+
+    def extend(self, column):
+        '''
+        Lengthen an array (or list) to the capacity, the new entries
+        are overwritten before they are read
+        '''
+        if len(column) < self.capacity:
+            column.extend(column[:self.capacity - len(column)])
+
+    def oldest(self):
+        '''
+        Timestamp of the oldest entry still held, None if there isn't one
+        '''
+        if not self.count:
+            return None
+        return self.times[self.index(0)]
+
+    def index(self, logical):
+        '''
+        physical index of the n'th oldest sample
+        '''
+        return (self.pos - self.count + logical) % self.size
+
+    def first_since(self, since):
+        '''
+        Binary search for the oldest sample at or after since
+        '''
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.times[self.index(mid)] < since:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def window(self, seconds=None, now=None):
+        '''
+        physical indexes of the samples within the last n seconds (all if None)
+        '''
+        start = 0
+        if seconds is not None:
+            now = time.time() if now is None else now
+            start = self.first_since(now - seconds)
+        return [self.index(logical) for logical in range(start, self.count)]
+
+    def between(self, start, end):
+        '''
+        physical indexes of the entries from start up to (not including) end
+        '''
+        first, last = self.first_since(start), self.first_since(end)
+        return [self.index(logical) for logical in range(first, last)]
+
+
+class OmniPingRollup(OmniPingRing):
+    '''
+    Fixed size ring of buckets summarising the samples in each period
+    of a tier: count, lost, min/avg/max and p95 RTT (32 bytes a bucket).
+    Samples go into the open bucket, which is written to the ring once
+    a sample arrives for a later period. Periods without samples take
+    no space, so a stopped engine doesn't push out older buckets
+    '''
+
+    columns = ('times', 'counts', 'lost', 'mins', 'avgs', 'maxs', 'p95s')
+
+    def __init__(self, name, seconds, size):
+        super().__init__(size)
+        self.name = name
+        self.seconds = seconds
+        self.counts = array('I', bytes(4 * self.capacity))
+        self.lost = array('I', bytes(4 * self.capacity))
+        self.mins = array('f', bytes(4 * self.capacity))
+        self.avgs = array('f', bytes(4 * self.capacity))
+        self.maxs = array('f', bytes(4 * self.capacity))
+        self.p95s = array('f', bytes(4 * self.capacity))
+        self.bins = array('I', bytes(4 * P95_BINS))
+        self.start = None
+        self.reset()
+
+    def reset(self):
+        '''
+        Empty the open bucket
+        '''
+        self.open_count = 0
+        self.open_lost = 0
+        self.open_sum = 0.0
+        self.open_min = math.inf
+        self.open_max = -math.inf
+        self.bins[:] = EMPTY_BINS
+
+    def add(self, timestamp, rtt, rtt_bin_num):
+        '''
+        Count a sample (rtt NaN if it failed) in its p95 bin, one a
+        little out of order is counted in the open bucket
+        '''
+        start = timestamp - timestamp % self.seconds
+        if self.start is None:
+            self.start = start
+        elif start > self.start:
+            self.close()
+            self.start = start
+        self.open_count += 1
+        if rtt != rtt:
+            self.open_lost += 1
+            return
+        self.open_sum += rtt
+        self.open_min = min(self.open_min, rtt)
+        self.open_max = max(self.open_max, rtt)
+        self.bins[rtt_bin_num] += 1
+
+    def p95(self):
+        '''
+        p95 of the open bucket's RTTs from the histogram, kept within its min and max
+        '''
+        good = self.open_count - self.open_lost
+        if not good:
+            return math.nan
+        if good == 1:
+            return self.open_min
+        rank = max(1, math.ceil(0.95 * good))
+        num = bisect_left(list(accumulate(self.bins)), rank)
+        if num == P95_BINS:
+            return self.open_max
+        return min(max(bin_value(num), self.open_min), self.open_max)
+
+    def close(self):
+        '''
+        Write the open bucket to the ring
+        '''
+        pos = self.pos
+        good = self.open_count - self.open_lost
+        self.counts[pos] = self.open_count
+        self.lost[pos] = self.open_lost
+        self.mins[pos] = self.open_min if good else math.nan
+        self.avgs[pos] = self.open_sum / good if good else math.nan
+        self.maxs[pos] = self.open_max if good else math.nan
+        self.p95s[pos] = self.p95()
+        self.times[pos] = self.start
+        self.advance()
+        self.reset()
+
+    def oldest(self):
+        '''
+        Start of the oldest bucket held, open or not
+        '''
+        oldest = super().oldest()
+        return self.start if oldest is None else oldest
+
+    def points(self, start, end):
+        '''
+        [start, count, lost, loss %, min, avg, max, p95] of the buckets
+        starting from start up to end, the open one included
+        '''
+        def value(number):
+            return None if number != number else round(number, 3)
+
+        def point(stamp, count, lost, low, avg, high, p95):
+            return [stamp, count, lost, round(lost / count * 100, 3) if count else 0.0,
+                    value(low), value(avg), value(high), value(p95)]
+
+        result = [
+            point(self.times[idx], self.counts[idx], self.lost[idx], self.mins[idx],
+                  self.avgs[idx], self.maxs[idx], self.p95s[idx])
+            for idx in self.between(start - self.seconds, end)
+            if self.times[idx] + self.seconds > start
+        ]
+        if self.open_count and start - self.seconds < self.start < end:
+            good = self.open_count - self.open_lost
+            result.append(point(self.start, self.open_count, self.open_lost,
+                                self.open_min if good else math.nan,
+                                self.open_sum / good if good else math.nan,
+                                self.open_max if good else math.nan, self.p95()))
+        return result
+
+
+class OmniPingHistory(OmniPingRing):
+    '''
+    Ring buffer of (timestamp, rtt, status code) samples for one test.
+    Memory grows with the samples (18 bytes each) until size are held,
+    then stays fixed however long the engine runs. Failed samples store
+    a NaN RTT.
+    Tests that time the phases of their result (HTTP and HTTPS) have
+    a further float array per phase, allocated with the first one.
+    Every sample is also rolled up into each tier's buckets, rollup_sizes
+    being the number of buckets kept per tier (0 for none)
+    '''
+
+    # Columns of the points range() returns from the samples and the rollups
+    raw_columns = ['time', 'rtt', 'code']
+    rollup_columns = ['time', 'count', 'lost', 'loss_percent', 'min', 'avg', 'max', 'p95']
+    columns = ('times', 'rtts', 'codes')
+
+    def __init__(self, size=1800, rollup_sizes=ROLLUP_SIZES):
+        super().__init__(size)
+        self.rtts = array('d', [math.nan]) * self.capacity
+        self.codes = array('h', bytes(2 * self.capacity))
+        self.phases = None
+        self.rollups = [
+            OmniPingRollup(name, seconds, int(buckets))
+            for (name, seconds), buckets in zip(ROLLUP_TIERS, rollup_sizes) if buckets
+        ]
+
+    def grow(self):
+        '''
+        Grow the phase timings along with the samples
+        '''
+        super().grow()
+        if self.phases is not None:
+            for values in self.phases.values():
+                self.extend(values)
+
+    def append(self, rtt=None, code=0, timestamp=None, phases=None):
+        '''
+        O(1) append, overwriting the oldest sample once full.
+        The write position moves last so readers only see complete samples.
+        phases is a {phase: ms} dict of the result's timings, if any
+        '''
+        pos = self.pos
+        rtt = math.nan if rtt is None else rtt
+        timestamp = time.time() if timestamp is None else timestamp
+        self.rtts[pos] = rtt
+        self.codes[pos] = code
+        if phases is not None and self.phases is None:
+            self.phases = {phase: array('f', [math.nan]) * self.capacity for phase in HTTP_PHASES}
+        if self.phases is not None:
+            phases = phases or {}
+            for phase, values in self.phases.items():
+                value = phases.get(phase)
+                values[pos] = math.nan if value is None else value
+        self.times[pos] = timestamp
+        self.advance()
+        if self.rollups:
+            num = 0 if rtt != rtt else rtt_bin(rtt)
+            for rollup in self.rollups:
+                rollup.add(timestamp, rtt, num)
+
+    def tier(self, start, end, max_points=1000):
+        '''
+        The finest tier (None for the raw samples) that still holds
+        start and gives no more than max_points over the range,
+        otherwise the coarsest tier
+        '''
+        tiers = [None] + self.rollups
+        for tier in tiers:
+            ring = self if tier is None else tier
+            oldest = ring.oldest()
+            held = len(ring) < ring.size or (oldest is not None and oldest <= start)
+            if tier is None:
+                points = ring.first_since(end) - ring.first_since(start)
+            else:
+                points = (end - start) / tier.seconds
+            if held and points <= max_points:
+                return tier
+        return tiers[-1]
+
+    def range(self, start, end, tier='auto', max_points=1000):
+        '''
+        Points between two (wall clock) times from the given tier, by name
+        or 'raw', or the one tier() picks. Raw points are [time, rtt, code],
+        rollup points [time, count, lost, loss %, min, avg, max, p95].
+        Returns None for a tier that isn't kept
+        '''
+        if tier == 'auto':
+            rollup = self.tier(start, end, max_points)
+        elif tier == 'raw':
+            rollup = None
+        else:
+            rollup = next((rollup for rollup in self.rollups if rollup.name == tier), False)
+            if rollup is False:
+                return None
+        result = {}
+        if rollup is None:
+            indexes = self.between(start, end)
+            rtts = [self.rtts[idx] for idx in indexes]
+            result['tier'] = 'raw'
+            result['step'] = 0
+            result['columns'] = self.raw_columns
+            result['points'] = [
+                [self.times[idx], None if rtt != rtt else rtt, self.codes[idx]]
+                for idx, rtt in zip(indexes, rtts)
+            ]
+            result['summary'] = window_stats(rtts, [])
+            return result
+        points = rollup.points(start, end)
+        result['tier'] = rollup.name
+        result['step'] = rollup.seconds
+        result['columns'] = self.rollup_columns
+        result['points'] = points
+        result['summary'] = rollup_stats(points)
+        return result
+
+    def samples(self, seconds=None):
+        '''
+        Raw samples as [timestamp, rtt (None if failed), code] lists,
+        with a {phase: ms} dict added if the test times its phases
+        '''
+        result = []
+        for idx in self.window(seconds):
+            rtt = self.rtts[idx]
+            sample = [self.times[idx], None if rtt != rtt else rtt, self.codes[idx]]
+            if self.phases is not None:
+                sample.append({
+                    phase: None if values[idx] != values[idx] else round(values[idx], 3)
+                    for phase, values in self.phases.items()
+                })
+            result.append(sample)
+        return result
+
+    def stats(self, seconds=None):
+        '''
+        Aggregates over the window, see window_stats
+        '''
+        indexes = self.window(seconds)
+        rtts = [self.rtts[idx] for idx in indexes]
+        times = [self.times[indexes[0]], self.times[indexes[-1]]] if indexes else []
+        stats = window_stats(rtts, times)
+        if self.phases is not None:
+            stats['phases'] = {
+                phase: phase_stats([values[idx] for idx in indexes])
+                for phase, values in self.phases.items()
+            }
+        return stats
@@ -0,0 +1,327 @@
+'''
+Shared HTTP3 clients for the HTTP and HTTPS tests.
+Tests either get a fresh connection per probe (new source port and a full
+TCP/TLS handshake each time) or reuse a pooled keep-alive connection.
+Each request is timed by phase: TCP connect, TLS handshake, time to the
+response headers and the body download.
+Every HTTPS connection uses one shared SSL context which caches a TLS
+session per host, so repeat tests resume sessions rather than making a
+full handshake (unless the test asks for full handshakes)
+'''
+import asyncio
+import contextvars
+import itertools
+import socket
+import ssl
+import time
+
+import http3
+from http3.concurrency import AsyncioBackend, Reader, Writer
+from http3.dispatch.connection_pool import ConnectionPool
+from http3.exceptions import ConnectTimeout
+from http3.interfaces import Protocol
+
+# The timings dict of the request being made, so the backend
+# can add the connect and handshake times to it
+TIMINGS = contextvars.ContextVar('omniping_http_timings', default=None)
+# Whether the request being made may resume a cached TLS session
+RESUME = contextvars.ContextVar('omniping_http_resume', default=True)
+
+
+class OmniPingSSLContext(ssl.SSLContext):
+    '''
+    The one client context shared by every HTTPS test, certificates are
+    not verified, as before. The last connection to each host is kept so
+    the next one can resume its TLS session rather than make a full handshake.
+    ALPN offers HTTP/1.1 only: the unverified context http3 made before sent
+    no ALPN so the tests have always been HTTP/1.1, and the phase timings
+    and pool counts are per HTTP/1.1 connection. Offering it explicitly
+    still suits servers that insist on ALPN
+    '''
+
+    def __new__(cls):
+        context = super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.options |= ssl.OP_NO_COMPRESSION
+        if ssl.HAS_ALPN:
+            context.set_alpn_protocols(['http/1.1'])
+        context.sessions = {}
+        return context
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        '''
+        Called by asyncio for each new TLS connection, the cached session
+        is added unless the request has asked for a full handshake
+        '''
+        if session is None and not server_side and RESUME.get():
+            session = self.session(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def session(self, host):
+        '''
+        The host's cached session. The last connection's SSL object is
+        kept rather than its session as TLS 1.3 tickets only arrive once
+        the handshake is over, the session is taken from it when next needed
+        '''
+        cached = self.sessions.get(host)
+        if isinstance(cached, ssl.SSLObject):
+            cached = cached.session
+            self.sessions[host] = cached
+        return cached
+
+    def remember(self, host, ssl_object):
+        '''
+        Keep a new connection for the host's next session
+        '''
+        self.sessions[host] = ssl_object
+
+
+class OmniPingConnectionPool(ConnectionPool):
+    '''
+    HTTP3's connection pool with every connection given the shared
+    SSL context, otherwise each builds (and loads the CA store into) its own
+    '''
+
+    def __init__(self, ssl_context, **kwargs):
+        super().__init__(**kwargs)
+        self.ssl_context = ssl_context
+
+    async def acquire_connection(self, origin, allow_connection_reuse=True):
+        connection = await super().acquire_connection(origin, allow_connection_reuse)
+        connection.ssl.ssl_context = self.ssl_context
+        return connection
+
+
+class OmniPingBackend(AsyncioBackend):
+    '''
+    HTTP3's asyncio backend with connection and handshake counting,
+    names are resolved through the shared resolver cache (if set).
+    The TCP connect and TLS handshake are made as separate steps so
+    each can be timed
+    '''
+
+    def __init__(self, resolver=None):
+        super().__init__()
+        self.resolver = resolver
+        self.ssl_context = OmniPingSSLContext()
+        self.connections = 0
+        self.handshakes = 0
+        self.resumed = 0
+        self.full_handshakes = 0
+        self.full_handshake_ms = 0.0
+        self.resumed_handshake_ms = 0.0
+
+    async def connect(self, hostname, port, ssl_context, timeout):
+        '''
+        Every call here is a new TCP connection (and TLS handshake for HTTPS)
+        '''
+        self.connections += 1
+        if ssl_context is not None:
+            self.handshakes += 1
+            ssl_context = self.ssl_context
+        if self.resolver is None:
+            return await super().connect(hostname, port, ssl_context, timeout)
+
+        family, address, _ = await self.resolver.resolve(hostname)
+        server_hostname = hostname if ssl_context is not None else None
+        steps = {}
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            stream_reader, stream_writer = await asyncio.wait_for(
+                self.open_stream(sock, address, port, ssl_context, server_hostname, steps),
+                timeout.connect_timeout,
+            )
+        except asyncio.TimeoutError:
+            sock.close()
+            raise ConnectTimeout()
+        except BaseException:
+            sock.close()
+            raise
+        timings = TIMINGS.get()
+        if timings is not None:
+            timings.update(steps)
+
+        ident = 'http/1.1'
+        ssl_object = stream_writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            ident = ssl_object.selected_alpn_protocol()
+            self.count_handshake(ssl_object, steps['tls'])
+            self.ssl_context.remember(hostname, ssl_object)
+        reader = Reader(stream_reader=stream_reader, timeout=timeout)
+        writer = Writer(stream_writer=stream_writer, timeout=timeout)
+        protocol = Protocol.HTTP_2 if ident == 'h2' else Protocol.HTTP_11
+        return reader, writer, protocol
+
+    @staticmethod
+    async def open_stream(sock, address, port, ssl_context, server_hostname, steps):
+        '''
+        Connect the socket then wrap it in a stream, which is where
+        the TLS handshake happens, noting how long each step took
+        '''
+        start = time.perf_counter()
+        await asyncio.get_running_loop().sock_connect(sock, (address, port))
+        connected = time.perf_counter()
+        streams = await asyncio.open_connection(
+                    sock=sock,
+                    ssl=ssl_context,
+                    server_hostname=server_hostname
+                    )
+        steps['connect'] = (connected - start) * 1000
+        if ssl_context is not None:
+            steps['tls'] = (time.perf_counter() - connected) * 1000
+        steps['connected'] = time.perf_counter()
+        return streams
+
+    def count_handshake(self, ssl_object, handshake_ms):
+        '''
+        Tally completed handshakes and their cost, full and resumed apart
+        '''
+        if ssl_object.session_reused:
+            self.resumed += 1
+            self.resumed_handshake_ms += handshake_ms
+        else:
+            self.full_handshakes += 1
+            self.full_handshake_ms += handshake_ms
+
+
+def handshake_averages(stats):
+    '''
+    Add the average handshake times (ms) to pool stats, from the totals
+    so it also works for the summed stats of several shards
+    '''
+    full = stats.get('full_handshakes', 0)
+    resumed = stats.get('resumed', 0)
+    stats['full_handshake_avg_ms'] = None
+    stats['resumed_handshake_avg_ms'] = None
+    if full:
+        stats['full_handshake_avg_ms'] = round(stats['full_handshake_ms'] / full, 3)
+    if resumed:
+        stats['resumed_handshake_avg_ms'] = round(stats['resumed_handshake_ms'] / resumed, 3)
+    return stats
+
+
+class OmniPingHttpPool():
+    '''
+    Pool of shared keep-alive clients, created lazily and closed
+    again once they have been idle for idle_timeout seconds
+    '''
+
+    reuse_policies = ['fresh', 'keepalive']
+
+    def __init__(self, size=4, idle_timeout=60.0, resolver=None):
+        self.size = max(1, int(size))
+        self.idle_timeout = idle_timeout
+        self.backend = OmniPingBackend(resolver)
+        self.clients = [None] * self.size
+        self.last_used = [0.0] * self.size
+        self.next_client = itertools.cycle(range(self.size))
+        self.requests = 0
+        self.evicted = 0
+
+    def make_client(self):
+        '''
+        HTTPS tests do not verify certificates, as before
+        '''
+        dispatch = OmniPingConnectionPool(
+                        self.backend.ssl_context,
+                        verify=False,
+                        backend=self.backend
+                        )
+        return http3.AsyncClient(backend=self.backend, dispatch=dispatch)
+
+    async def get(self, url, timeout, reuse='fresh', fetch='body', timings=None, resume=True):
+        '''
+        GET the url honouring the test's connection reuse policy.
+        fetch is 'body' (GET the whole response), 'headers' (GET but stop
+        once the headers arrive) or 'head' (send a HEAD request).
+        If given timings is filled in with the phases in ms: connect and
+        tls (None on a reused connection), ttfb (request sent to headers
+        received), download (None unless the body is read) and total.
+        resume=False forces a full TLS handshake on new connections
+        '''
+        self.requests += 1
+        timings = {} if timings is None else timings
+        token = TIMINGS.set(timings)
+        resume_token = RESUME.set(resume)
+        try:
+            if reuse != 'keepalive':
+                client = self.make_client()
+                try:
+                    return await self.fetch(client, url, timeout, fetch, timings)
+                finally:
+                    await client.close()
+
+            pos = next(self.next_client)
+            if self.clients[pos] is None:
+                self.clients[pos] = self.make_client()
+            self.last_used[pos] = time.monotonic()
+            return await self.fetch(self.clients[pos], url, timeout, fetch, timings)
+        finally:
+            RESUME.reset(resume_token)
+            TIMINGS.reset(token)
+
+    @staticmethod
+    async def fetch(client, url, timeout, fetch, timings):
+        '''
+        Make the request, timing the headers and body separately
+        '''
+        start = time.perf_counter()
+        if fetch == 'head':
+            response = await client.head(url, timeout=timeout, stream=True)
+        else:
+            response = await client.get(url, timeout=timeout, stream=True)
+        headers = time.perf_counter()
+        try:
+            if fetch == 'body':
+                await response.read()
+        finally:
+            await response.close()
+        end = time.perf_counter()
+        timings.setdefault('connect', None)
+        timings.setdefault('tls', None)
+        timings['ttfb'] = (headers - timings.pop('connected', start)) * 1000
+        timings['download'] = (end - headers) * 1000 if fetch == 'body' else None
+        timings['total'] = (end - start) * 1000
+        return response
+
+    async def evict_idle(self):
+        '''
+        Close keep-alive clients not used within the idle timeout
+        '''
+        now = time.monotonic()
+        for pos, client in enumerate(self.clients):
+            if client is not None and now - self.last_used[pos] > self.idle_timeout:
+                self.clients[pos] = None
+                self.evicted += 1
+                await client.close()
+
+    async def close(self):
+        '''
+        Close all of the pooled clients
+        '''
+        for pos, client in enumerate(self.clients):
+            if client is not None:
+                self.clients[pos] = None
+                await client.close()
+
+    def stats(self):
+        '''
+        Pool usage and connection/handshake counts, handshakes are
+        those started, full and resumed those completed
+        '''
+        return handshake_averages({
+            'size': self.size,
+            'open_clients': sum(1 for client in self.clients if client is not None),
+            'idle_timeout': self.idle_timeout,
+            'evicted': self.evicted,
+            'requests': self.requests,
+            'connections': self.backend.connections,
+            'handshakes': self.backend.handshakes,
+            'full_handshakes': self.backend.full_handshakes,
+            'resumed': self.backend.resumed,
+            'full_handshake_ms': round(self.backend.full_handshake_ms, 3),
+            'resumed_handshake_ms': round(self.backend.resumed_handshake_ms, 3),
+            'tls_sessions': len(self.backend.ssl_context.sessions),
+        })
@@ -0,0 +1,294 @@
+'''
+Native asynchronous ICMP / ICMPv6 echo engine used by the PING tests.
+One socket per address family is shared by every PING test, replies are
+matched back to the waiting probe by sequence number (and identifier on
+raw sockets) from the asyncio loop's reader callback
+'''
+import asyncio
+import errno
+import os
+import socket
+import struct
+import time
+
+from omniping_dns import OmniPingResolver
+
+ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACH = 3
+ICMP_ECHO_REQUEST = 8
+ICMP_TIME_EXCEEDED = 11
+ICMP6_DEST_UNREACH = 1
+ICMP6_TIME_EXCEEDED = 3
+ICMP6_ECHO_REQUEST = 128
+ICMP6_ECHO_REPLY = 129
+
+# Not all of these are exported by the socket module on every Python version
+IP_RECVERR = getattr(socket, 'IP_RECVERR', 11)
+IPV6_RECVERR = getattr(socket, 'IPV6_RECVERR', 25)
+MSG_ERRQUEUE = getattr(socket, 'MSG_ERRQUEUE', 0x2000)
+
+UNREACH_ERRNOS = (errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ECONNREFUSED)
+
+
+class OmniPingIcmpUnavailable(PermissionError):
+    '''
+    Neither a datagram nor a raw ICMP socket could be opened, so the
+    ping command is needed rather than there being a problem with
+    one destination
+    '''
+
+
+def checksum(data):
+    '''
+    Standard internet checksum, only needed for raw IPv4 sockets
+    as the kernel fills it in for ICMP datagram and ICMPv6 sockets
+    '''
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class OmniPingIcmp():
+    '''
+    Shared ICMP echo engine.
+    Tries an unprivileged SOCK_DGRAM/IPPROTO_ICMP socket first and falls back
+    to a raw socket, sockets are opened lazily per address family.
+    ping() returns a (status, rtt_ms) tuple using the same status values
+    the ping command based tester used (Good / Time Out / Unreachable),
+    burst() sends several echo requests and returns each one's result
+    '''
+
+    def __init__(self, loop=None, payload_size=56):
+        self.loop = loop or asyncio.get_event_loop()
+        self.payload_size = payload_size
+        self.ident = os.getpid() & 0xFFFF
+        self.seq = 0
+        self.payloads = {}
+        self.sockets = {}
+        self.pending = {}
+        self.available = True
+
+    def open_socket(self, family):
+        '''
+        Open and register the shared socket for an address family
+        '''
+        if family in self.sockets:
+            return self.sockets[family]
+        proto = socket.IPPROTO_ICMP if family == socket.AF_INET else socket.IPPROTO_ICMPV6
+        for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                sock = socket.socket(family, sock_type, proto)
+            except OSError:
+                continue
+            sock.setblocking(False)
+            raw = sock_type == socket.SOCK_RAW
+            if not raw:
+                # ICMP errors for datagram sockets are only reported via the error queue
+                if family == socket.AF_INET:
+                    sock.setsockopt(socket.SOL_IP, IP_RECVERR, 1)
+                else:
+                    sock.setsockopt(socket.IPPROTO_IPV6, IPV6_RECVERR, 1)
+            self.loop.add_reader(sock.fileno(), self.on_readable, family)
+            self.sockets[family] = (sock, raw)
+            return self.sockets[family]
+        self.available = False
+        raise OmniPingIcmpUnavailable('Unable to open an ICMP socket (datagram or raw)')
+
+    def next_seq(self, family):
+        '''
+        Allocate a sequence number not currently awaiting a reply
+        '''
+        for _ in range(0x10000):
+            self.seq = (self.seq + 1) & 0xFFFF
+            if (family, self.seq) not in self.pending:
+                return self.seq
+        raise OSError('No free ICMP sequence numbers')
+
+    def make_packet(self, family, seq, size=None):
+        '''
+        Build an echo request, the payload is padding only as
+        timestamps are kept locally
+        '''
+        icmp_type = ICMP_ECHO_REQUEST if family == socket.AF_INET else ICMP6_ECHO_REQUEST
+        payload = self.payload(self.payload_size if size is None else size)
+        header = struct.pack('!BBHHH', icmp_type, 0, 0, self.ident, seq)
+        if family == socket.AF_INET:
+            header = struct.pack('!BBHHH', icmp_type, 0, checksum(header + payload),
+                                 self.ident, seq)
+        return header + payload
+
+    def payload(self, size):
+        '''
+        Padding of a given size, built once per size
+        '''
+        payload = self.payloads.get(size)
+        if payload is None:
+            payload = bytes(i & 0xFF for i in range(size))
+            self.payloads[size] = payload
+        return payload
+
+    async def resolve(self, host):
+        '''
+        Resolve a host to (family, address)
+        '''
+        literal = OmniPingResolver.literal(host)
+        if literal:
+            return literal
+        infos = await self.loop.getaddrinfo(host, None, type=socket.SOCK_DGRAM)
+        family, _, _, _, sockaddr = infos[0]
+        return family, sockaddr[0]
+
+    async def ping(self, host, timeout, size=None):
+        '''
+        Send a single echo request and wait up to timeout seconds for the reply
+        '''
+        try:
+            family, address = await self.resolve(host)
+        except socket.gaierror:
+            return 'Bad Address', None
+        sock, _ = self.open_socket(family)
+        return await self.echo(sock, family, address, timeout, size)
+
+    async def burst(self, host, count, spacing, timeout, size=None):
+        '''
+        Send count echo requests spacing seconds apart over the shared
+        socket, each waiting up to timeout seconds for its reply.
+        Returns (status, [(wall clock send time, status, rtt_ms), ...])
+        '''
+        try:
+            family, address = await self.resolve(host)
+        except socket.gaierror:
+            return 'Bad Address', []
+        sock, _ = self.open_socket(family)
+        start = self.loop.time()
+
+        async def probe(num):
+            delay = start + num * spacing - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent = time.time()
+            status, rtt = await self.echo(sock, family, address, timeout, size)
+            return sent, status, rtt
+
+        results = await asyncio.gather(*[probe(num) for num in range(count)])
+        statuses = [status for _, status, _ in results]
+        if 'Good' in statuses:
+            return 'Good', results
+        return statuses[0], results
+
+    async def echo(self, sock, family, address, timeout, size=None):
+        '''
+        Send one echo request to a resolved address and wait for the reply.
+        A send refused for this destination (i.e. EACCES for a broadcast
+        address) fails the probe, it says nothing about the socket
+        '''
+        seq = self.next_seq(family)
+        waiter = self.loop.create_future()
+        self.pending[(family, seq)] = [waiter, address, 0]
+        try:
+            packet = self.make_packet(family, seq, size)
+            self.pending[(family, seq)][2] = time.perf_counter_ns()
+            try:
+                sock.sendto(packet, (address, 0))
+            except OSError as err:
+                if err.errno in UNREACH_ERRNOS:
+                    return 'Unreachable', None
+                return 'Failed', None
+            try:
+                return await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                return 'Time Out', None
+        finally:
+            self.pending.pop((family, seq), None)
+
+    def complete(self, family, seq, status, ident=None, recv_ns=None):
+        '''
+        Resolve the waiting probe for a reply or error message
+        '''
+        if ident is not None and ident != self.ident:
+            return
+        entry = self.pending.get((family, seq))
+        if entry is None or entry[0].done():
+            return
+        rtt = None
+        if recv_ns is not None:
+            rtt = (recv_ns - entry[2]) / 1e6
+        entry[0].set_result((status, rtt))
+
+    def on_readable(self, family):
+        '''
+        Reader callback, drains the error queue (datagram sockets)
+        and then all queued replies
+        '''
+        sock, raw = self.sockets[family]
+        if not raw:
+            self.drain_error_queue(family, sock)
+        while True:
+            try:
+                data, _ = sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                if err.errno in UNREACH_ERRNOS:
+                    self.drain_error_queue(family, sock)
+                    continue
+                return
+            self.parse_message(family, data, raw, time.perf_counter_ns())
+
+    def drain_error_queue(self, family, sock):
+        '''
+        ICMP errors on datagram sockets return our original echo request
+        '''
+        while True:
+            try:
+                data, _, _, _ = sock.recvmsg(4096, 512, MSG_ERRQUEUE)
+            except OSError:
+                return
+            if len(data) >= 8:
+                _, _, _, _, seq = struct.unpack('!BBHHH', data[:8])
+                self.complete(family, seq, 'Unreachable')
+
+    def parse_message(self, family, data, raw, recv_ns):
+        '''
+        Match echo replies and, on raw sockets, embedded error messages
+        '''
+        if raw and family == socket.AF_INET:
+            data = data[(data[0] & 0x0F) * 4:]
+        if len(data) < 8:
+            return
+        icmp_type, _, _, ident, seq = struct.unpack('!BBHHH', data[:8])
+        if family == socket.AF_INET:
+            reply, errors = ICMP_ECHO_REPLY, (ICMP_DEST_UNREACH, ICMP_TIME_EXCEEDED)
+        else:
+            reply, errors = ICMP6_ECHO_REPLY, (ICMP6_DEST_UNREACH, ICMP6_TIME_EXCEEDED)
+
+        if icmp_type == reply:
+            self.complete(family, seq, 'Good', ident if raw else None, recv_ns)
+        elif raw and icmp_type in errors:
+            inner = data[8:]
+            if family == socket.AF_INET and inner:
+                inner = inner[(inner[0] & 0x0F) * 4:]
+            elif family == socket.AF_INET6:
+                inner = inner[40:]
+            if len(inner) >= 8:
+                _, _, _, ident, seq = struct.unpack('!BBHHH', inner[:8])
+                self.complete(family, seq, 'Unreachable', ident)
+
+    def close(self):
+        '''
+        Unregister and close the sockets and cancel any outstanding probes
+        '''
+        for sock, _ in self.sockets.values():
+            try:
+                self.loop.remove_reader(sock.fileno())
+            except (ValueError, RuntimeError):
+                pass
+            sock.close()
+        self.sockets = {}
+        for entry in self.pending.values():
+            if not entry[0].done():
+                entry[0].cancel()
+        self.pending = {}
@@ -0,0 +1,357 @@
+'''
+Append-only journal of every test result so counters and history
+survive a restart or crash.
+Results are fixed size binary records written to numbered segment files,
+a new segment is started once the current one reaches segment_size and
+the oldest are deleted to keep the journal under max_size. Queries read
+the segments through mmap, pulling single columns out with strided
+memoryviews rather than unpacking whole records
+'''
+from bisect import bisect_left
+from collections import Counter
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from omniping_history import STATUS_CODES, FAILED_CODE, window_stats
+from omniping_tester import OmniPingTester
+
+# time (wall clock), test key, test position, rtt ms (NaN failed), dns ms, status code,
+# padded to a multiple of 8 bytes so the column views stay aligned
+RECORD = struct.Struct('<dIIffh6x')
+# The header is padded to one record so the column views stay aligned
+MAGIC = b'OPJ2'
+HEADER = MAGIC + bytes(RECORD.size - len(MAGIC))
+SUFFIX = '.opj'
+# A failed result's NaN RTT as journalled, to tell failures apart
+# from the raw bits of the RTT column without reading each float
+NAN_BITS = struct.unpack('<I', struct.pack('<f', math.nan))[0]
+
+STATUS_NAMES = {code: status for status, code in STATUS_CODES.items()}
+STATUS_NAMES[FAILED_CODE] = 'Failed'
+
+
+def test_keys(states):
+    '''
+    {pos: key} of the engine's {setup key: test state}, the CRC of the
+    key the setup page matches tests up by, so results still match up
+    after tests are added, removed or reordered
+    '''
+    return {state.pos: zlib.crc32(key.encode()) for key, state in states.items()}
+
+
+class OmniPingSegment():
+    '''
+    Read only mmap of one segment with column views over its records
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.views = []
+        self.count = 0
+        self.map = None
+        with open(path, 'rb') as seg_file:
+            size = os.fstat(seg_file.fileno()).st_size
+            self.count = max(0, (size - len(HEADER)) // RECORD.size)
+            if self.count:
+                self.map = mmap.mmap(seg_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        if not self.count or self.map[:len(MAGIC)] != MAGIC:
+            self.count = 0
+            return self
+        records = self.view(memoryview(self.map)[len(HEADER):len(HEADER) + self.count * RECORD.size])
+        self.times = self.view(self.view(records.cast('d'))[0::4])
+        self.keys = self.view(self.view(records.cast('I'))[2::8])
+        self.rtts = self.view(self.view(records.cast('f'))[4::8])
+        self.rtt_bits = self.view(self.view(records.cast('I'))[4::8])
+        self.codes = self.view(self.view(records.cast('h'))[12::16])
+        return self
+
+    def view(self, view):
+        '''
+        Track a memoryview so it can be released before the map is closed
+        '''
+        self.views.append(view)
+        return view
+
+    def __exit__(self, *_):
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        if self.map is not None:
+            self.map.close()
+
+    def records(self, since=None):
+        '''
+        Indexes of the records at or after since (records are appended in
+        time order, near enough, so a binary search finds the start)
+        '''
+        start = 0
+        if since is not None:
+            start = bisect_left(self.times, since)
+        return range(start, self.count)
+
+
+class OmniPingJournal():
+    '''
+    Writes results from the tester's loop thread, replays them
+    into a new report and answers history queries
+    '''
+
+    def __init__(self, path, segment_size=4194304, max_size=67108864):
+        self.path = path
+        self.segment_size = max(len(HEADER) + RECORD.size, int(segment_size))
+        self.max_size = int(max_size)
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.file = None
+        self.file_size = 0
+        self.written = 0
+        os.makedirs(path, exist_ok=True)
+
+    def segments(self):
+        '''
+        Segment paths oldest first
+        '''
+        names = sorted(name for name in os.listdir(self.path) if name.endswith(SUFFIX))
+        return [os.path.join(self.path, name) for name in names]
+
+    def assign(self, states):
+        '''
+        Work out the keys results are journalled under for a new report
+        from the engine's {setup key: test state}
+        '''
+        self.keys = test_keys(states)
+
+    def open_segment(self):
+        '''
+        Continue the newest segment, cutting off any partly written
+        record left by a crash, or start a new one if it is full or
+        in an older format
+        '''
+        segments = self.segments()
+        if (segments and os.path.getsize(segments[-1]) < self.segment_size
+                and MAGIC.startswith(self.read_magic(segments[-1]))):
+            path = segments[-1]
+            size = os.path.getsize(path)
+            torn = (size - len(HEADER)) % RECORD.size if size >= len(HEADER) else size
+            self.file = open(path, 'r+b')
+            if torn or size < len(HEADER):
+                self.file.truncate(size - torn)
+                if size < len(HEADER):
+                    self.file.write(HEADER)
+            self.file.seek(0, os.SEEK_END)
+            self.file_size = self.file.tell()
+            return
+        seq = 1
+        if segments:
+            seq = int(os.path.basename(segments[-1])[:-len(SUFFIX)]) + 1
+        self.file = open(os.path.join(self.path, f'{seq:08d}{SUFFIX}'), 'wb')
+        self.file.write(HEADER)
+        self.file_size = len(HEADER)
+        self.enforce_cap()
+
+    @staticmethod
+    def read_magic(path):
+        '''
+        The format marker at the start of a segment
+        '''
+        with open(path, 'rb') as seg_file:
+            return seg_file.read(len(MAGIC))
+
+    def enforce_cap(self):
+        '''
+        Delete the oldest segments while the journal is over max_size
+        '''
+        segments = self.segments()
+        total = sum(os.path.getsize(path) for path in segments)
+        for path in segments[:-1]:
+            if total <= self.max_size:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def append(self, test, rtt, code, stamp=None):
+        '''
+        Journal a result, called by the engine after every test,
+        stamp is the (wall clock) time of the result
+        '''
+        key = self.keys.get(test.pos)
+        if key is None:
+            return
+        record = RECORD.pack(
+                    time.time() if stamp is None else stamp,
+                    key,
+                    test.pos,
+                    math.nan if rtt is None else rtt,
+                    math.nan if test.dns is None else test.dns,
+                    code,
+                    )
+        with self.lock:
+            if self.file is None or self.file_size + RECORD.size > self.segment_size:
+                self.close_file()
+                self.open_segment()
+            self.file.write(record)
+            self.file_size += RECORD.size
+            self.written += 1
+
+    def flush(self):
+        '''
+        Push buffered records to the OS, called each round
+        '''
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close_file(self):
+        '''
+        Close the segment being written, lock held
+        '''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        '''
+        Flush and close the journal
+        '''
+        with self.lock:
+            self.close_file()
+
+    def clear(self):
+        '''
+        Delete the journal, i.e. when the report is reset
+        '''
+        with self.lock:
+            self.close_file()
+            for path in self.segments():
+                os.remove(path)
+
+    @staticmethod
+    def status(code, test_type):
+        '''
+        The status string for a journalled status code
+        '''
+        if code < 0 or (code == 0 and test_type in ['PING', 'ICMP', 'TCP']):
+            return STATUS_NAMES.get(code, 'Failed')
+        return OmniPingTester.stat_dict.get(code, 'Unknown')
+
+    @staticmethod
+    def tally(segment, end, by_key):
+        '''
+        Add a segment's records before end to the tests' counters without
+        replaying them one at a time, the counting is done by Counter
+        straight off the column views. Returns the number counted
+        '''
+        counts = Counter(zip(segment.keys[:end], segment.codes[:end],
+                             map(NAN_BITS.__ne__, segment.rtt_bits[:end])))
+        for (key, code, good), count in counts.items():
+            test = by_key.get(key)
+            if test is None:
+                continue
+            test.total += count
+            if good:
+                test.total_successes += count
+            elif code == STATUS_CODES['Time Out']:
+                test.total_timeouts += count
+        return end
+
+    def replay(self, tests, history, events=None, since=None):
+        '''
+        Rebuild the tests' counters, last good/bad times and statuses,
+        the history ring buffers and the transition log from the journal.
+        Only results at or after since (wall clock) are replayed one by
+        one, earlier ones are just added to the counters as the history
+        and rollups couldn't hold them anyway
+        '''
+        self.flush()
+        by_key = {self.keys[test.pos]: test for test in tests if test.pos in self.keys}
+        offset = time.time() - time.monotonic()
+        replayed = 0
+        for path in self.segments():
+            with OmniPingSegment(path) as segment:
+                if not segment.count:
+                    continue
+                records = segment.records(since)
+                if records.start:
+                    replayed += self.tally(segment, records.start, by_key)
+                for idx in records:
+                    test = by_key.get(segment.keys[idx])
+                    if test is None:
+                        continue
+                    stamp, code, rtt = segment.times[idx], segment.codes[idx], segment.rtts[idx]
+                    good = rtt == rtt
+                    test.record(self.status(code, test.test), good,
+                                rtt if good else None, stamp - offset)
+                    if test.pos in history:
+                        history[test.pos].append(rtt if good else None, code, stamp)
+                    if events is not None:
+                        events.observe(test, stamp)
+                    replayed += 1
+        return replayed
+
+    def samples(self, pos, seconds=None, now=None):
+        '''
+        [timestamp, rtt (None if failed), code] samples of a test from the journal
+        '''
+        result = []
+        self.scan(pos, seconds, now, lambda segment, idx: result.append([
+            segment.times[idx],
+            segment.rtts[idx] if segment.rtts[idx] == segment.rtts[idx] else None,
+            segment.codes[idx],
+        ]))
+        return result
+
+    def stats(self, pos, seconds=None, now=None):
+        '''
+        The same aggregates as the in memory history, over the journal
+        '''
+        times = []
+        rtts = []
+
+        def collect(segment, idx):
+            times.append(segment.times[idx])
+            rtts.append(segment.rtts[idx])
+        self.scan(pos, seconds, now, collect)
+        return window_stats(rtts, times)
+
+    def scan(self, pos, seconds, now, func):
+        '''
+        Call func(segment, idx) for a test's records within the window
+        '''
+        key = self.keys.get(pos)
+        if key is None:
+            return
+        since = None
+        if seconds is not None:
+            since = (time.time() if now is None else now) - seconds
+        self.flush()
+        for path in self.segments():
+            try:
+                segment = OmniPingSegment(path)
+            except FileNotFoundError:
+                continue
+            with segment:
+                if not segment.count or (since is not None and segment.times[-1] < since):
+                    continue
+                keys = segment.keys
+                for idx in segment.records(since):
+                    if keys[idx] == key:
+                        func(segment, idx)
+
+    def info(self):
+        '''
+        Size of the journal
+        '''
+        segments = self.segments()
+        return {
+            'segments': len(segments),
+            'bytes': sum(os.path.getsize(path) for path in segments),
+            'max_bytes': self.max_size,
+            'written': self.written,
+        }
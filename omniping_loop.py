@@ -0,0 +1,113 @@
+'''
+Long lived asyncio event loop running in its own thread.
+The test engine submits coroutines to it from CherryPy's threads
+'''
+import asyncio
+from concurrent.futures import TimeoutError as FutureTimeout
+import sys
+import threading
+
+
+def log_stderr(message):
+    '''
+    The default log without the web server, i.e. for the CLI, shard
+    processes and consumer, the engine passes cherrypy.log
+    '''
+    print(message, file=sys.stderr)
+
+
+class OmniPingLoop():
+    '''
+    Owns one event loop and the thread driving it.
+    Anything that should persist between rounds (sockets, clients, caches)
+    can live on this loop for as long as the engine is running
+    '''
+
+    def __init__(self, name='omniping-loop'):
+        self.name = name
+        self.loop = False
+        self.thread = False
+
+    @property
+    def running(self):
+        '''
+        True once the loop thread is up and running
+        '''
+        return bool(self.loop) and self.loop.is_running()
+
+    def start(self):
+        '''
+        Create the loop and start the thread, returns once the loop is running
+        '''
+        if self.running:
+            return self.loop
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.call_soon(started.set)
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name=self.name, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self.loop
+
+    def submit(self, coro):
+        '''
+        Schedule a coroutine on the loop from any thread,
+        returns a concurrent.futures.Future for the result
+        '''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, func, *args):
+        '''
+        Thread safe call of a plain function on the loop
+        '''
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def run(self, coro, timeout=None):
+        '''
+        Submit a coroutine and block the calling thread until it completes
+        '''
+        return self.submit(coro).result(timeout)
+
+    async def cancel_tasks(self):
+        '''
+        Cancel everything running on the loop apart from this task
+        '''
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks() if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def cancel(self, timeout=5):
+        '''
+        Cancel all outstanding work but leave the loop running
+        '''
+        if self.running:
+            self.run(self.cancel_tasks(), timeout)
+
+    def stop(self, cleanup=None, timeout=5):
+        '''
+        Cancel outstanding work, run an optional cleanup coroutine function
+        then stop the loop and join the thread
+        '''
+        if not self.loop:
+            return
+        if self.running:
+            try:
+                self.cancel(timeout)
+                if cleanup:
+                    self.run(cleanup(), timeout)
+            except FutureTimeout:
+                pass
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+        if not self.loop.is_running():
+            self.loop.close()
+        self.loop = False
+        self.thread = False
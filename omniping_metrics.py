@@ -0,0 +1,301 @@
+'''
+Prometheus metrics for the tests and the engine itself
+i.e. http://<omniping>/metrics
+Counters are updated in place as results arrive, a scrape only
+formats them and never triggers a test
+'''
+from bisect import bisect_left
+import os
+import time
+
+import cherrypy
+
+# RTT histogram bucket upper bounds in seconds
+RTT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Probe duration (scheduled start to result) bucket upper bounds in seconds,
+# longer than the RTTs as they include pacing and waiting to time out
+DURATION_BUCKETS = RTT_BUCKETS + (5.0, 10.0, 30.0)
+
+
+def label_value(value):
+    '''
+    Escape a label value for the text exposition format
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class OmniPingTestMetrics():
+    '''
+    RTT histogram and up/down transition counts of a single test
+    '''
+
+    __slots__ = ('labels', 'buckets', 'rtt_sum', 'rtt_count', 'up', 'ups', 'downs')
+
+    def __init__(self, test):
+        self.labels = self.make_labels(test)
+        self.buckets = [0] * (len(RTT_BUCKETS) + 1)
+        self.rtt_sum = 0.0
+        self.rtt_count = 0
+        self.up = None
+        self.ups = 0
+        self.downs = 0
+
+    @staticmethod
+    def make_labels(test):
+        '''
+        The series labels of a test state
+        '''
+        return 'pos="{}",host="{}",test="{}",desc="{}"'.format(
+                    test.pos, label_value(test.host), test.test, label_value(test.desc))
+
+    def observe(self, good, rtt):
+        '''
+        Count a result, rtt in ms (None if the test failed)
+        '''
+        if rtt is not None:
+            seconds = rtt / 1000
+            self.buckets[bisect_left(RTT_BUCKETS, seconds)] += 1
+            self.rtt_sum += seconds
+            self.rtt_count += 1
+        if self.up is not None and good != self.up:
+            if good:
+                self.ups += 1
+            else:
+                self.downs += 1
+        self.up = good
+
+
+class OmniPingMetrics():
+    '''
+    Engine side counters, fed by the test engine's callbacks
+    '''
+
+    def __init__(self):
+        self.tests = {}
+        self.rounds = 0
+        self.round_interval = 0.0
+        self.last_round = None
+        self.durations = {}
+        self.render_seconds = 0.0
+        self.renders = 0
+
+    def clear(self):
+        '''
+        Drop the per test metrics when the report is rebuilt
+        '''
+        self.tests = {}
+
+    def add_test(self, test):
+        '''
+        Start metrics for a test state
+        '''
+        self.tests[test.pos] = OmniPingTestMetrics(test)
+
+    def relabel(self, test):
+        '''
+        Update the labels of a modified test, keeping its counts
+        '''
+        metrics = self.tests.get(test.pos)
+        if metrics is None:
+            self.add_test(test)
+        else:
+            metrics.labels = metrics.make_labels(test)
+
+    def observe_result(self, test, rtt, duration=None):
+        '''
+        Called with every test result, duration is the seconds from the
+        test's scheduled start to its result (None if not known)
+        '''
+        metrics = self.tests.get(test.pos)
+        if metrics is not None:
+            metrics.observe(test.good, rtt)
+        if duration is not None:
+            histogram = self.durations.get(test.test)
+            if histogram is None:
+                histogram = self.durations[test.test] = [[0] * (len(DURATION_BUCKETS) + 1), 0.0]
+            histogram[0][bisect_left(DURATION_BUCKETS, duration)] += 1
+            histogram[1] += duration
+
+    def observe_round(self):
+        '''
+        Called on each round tick, times the gap since the last one. Tests
+        run on their own schedules so this is the round interval as kept,
+        how long the probes themselves take is in the duration histogram
+        '''
+        now = time.monotonic()
+        if self.last_round is not None:
+            self.round_interval = now - self.last_round
+        self.last_round = now
+        self.rounds += 1
+
+    def observe_render(self, seconds):
+        '''
+        Called each time the report is actually rendered
+        '''
+        self.render_seconds += seconds
+        self.renders += 1
+
+
+class OmniPingMetricsExport():
+    '''
+    Formats the test engine's metrics in the Prometheus text format
+    '''
+
+    exposed = True
+
+    def __init__(self, test_engine):
+        self.test_engine = test_engine
+
+    @staticmethod
+    def open_fds():
+        '''
+        Count of the process' open file descriptors (sockets, pipes etc), Linux only
+        '''
+        try:
+            return len(os.listdir('/proc/self/fd'))
+        except OSError:
+            return None
+
+    @staticmethod
+    def family(lines, name, kind, help_text, samples):
+        '''
+        Append a metric family, samples is a list of (labels, value)
+        '''
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+
+    def engine_lines(self, lines):
+        '''
+        The engine's own instrumentation
+        '''
+        engine = self.test_engine
+        metrics = engine.metrics
+        stats = engine.tester.stats() if engine.tester else {}
+        scheduler = stats.get('scheduler', {})
+        probes = stats.get('probes', {})
+        http_pool = stats.get('http_pool', {})
+        dns = stats.get('dns', {})
+
+        self.family(lines, 'omniping_running', 'gauge', 'Whether the tests are running',
+                    [('', int(engine.running))])
+        self.family(lines, 'omniping_rounds_total', 'counter', 'Rounds completed',
+                    [('', metrics.rounds)])
+        self.family(lines, 'omniping_round_interval_seconds', 'gauge',
+                    'Time between the last two round ticks',
+                    [('', round(metrics.round_interval, 6))])
+        self.family(lines, 'omniping_scheduler_lag_seconds_max', 'gauge',
+                    'Longest delay dispatching a scheduled test', [('', scheduler.get('max_lag'))])
+        self.family(lines, 'omniping_scheduler_skipped_total', 'counter',
+                    'Scheduled tests skipped as still in progress or overdue',
+                    [('', scheduler.get('skipped'))])
+        self.family(lines, 'omniping_event_loop_lag_seconds', 'gauge',
+                    'Delay running a callback on the tester event loop',
+                    [('', scheduler.get('loop_lag'))])
+        self.family(lines, 'omniping_probes_in_flight', 'gauge', 'Tests in progress',
+                    [('', probes.get('inflight'))])
+        self.family(lines, 'omniping_subprocesses', 'gauge', 'Ping command subprocesses running',
+                    [('', probes.get('subprocesses'))])
+        self.family(lines, 'omniping_icmp_sockets', 'gauge', 'Open ICMP sockets',
+                    [('', probes.get('icmp_sockets'))])
+        self.family(lines, 'omniping_http_open_clients', 'gauge', 'Open keep-alive HTTP clients',
+                    [('', http_pool.get('open_clients'))])
+        self.family(lines, 'omniping_http_requests_total', 'counter', 'HTTP(S) requests made',
+                    [('', http_pool.get('requests'))])
+        self.family(lines, 'omniping_http_connections_total', 'counter', 'TCP connections opened',
+                    [('', http_pool.get('connections'))])
+        self.family(lines, 'omniping_http_handshakes_total', 'counter', 'TLS handshakes',
+                    [('', http_pool.get('handshakes'))])
+        self.family(lines, 'omniping_http_tls_resumed_total', 'counter',
+                    'TLS handshakes resuming a cached session', [('', http_pool.get('resumed'))])
+        self.family(lines, 'omniping_http_full_handshake_seconds_avg', 'gauge',
+                    'Average time of a full TLS handshake',
+                    [('', None if http_pool.get('full_handshake_avg_ms') is None
+                      else round(http_pool['full_handshake_avg_ms'] / 1000, 6))])
+        self.family(lines, 'omniping_http_resumed_handshake_seconds_avg', 'gauge',
+                    'Average time of a resumed TLS handshake',
+                    [('', None if http_pool.get('resumed_handshake_avg_ms') is None
+                      else round(http_pool['resumed_handshake_avg_ms'] / 1000, 6))])
+        self.family(lines, 'omniping_dns_cache_hits_total', 'counter', 'Name lookups from the cache',
+                    [('', dns.get('hits'))])
+        self.family(lines, 'omniping_dns_cache_misses_total', 'counter', 'Name lookups queried',
+                    [('', dns.get('misses'))])
+        self.family(lines, 'omniping_open_fds', 'gauge', 'Open file descriptors',
+                    [('', self.open_fds())])
+        lines.append('# HELP omniping_report_render_seconds Time spent rendering the report')
+        lines.append('# TYPE omniping_report_render_seconds summary')
+        lines.append(f'omniping_report_render_seconds_sum {round(metrics.render_seconds, 6)}')
+        lines.append(f'omniping_report_render_seconds_count {metrics.renders}')
+        lines.append('# HELP omniping_probe_duration_seconds '
+                     'Time from a test\'s scheduled start to its result, by test type')
+        lines.append('# TYPE omniping_probe_duration_seconds histogram')
+        for kind, (buckets, total) in sorted(metrics.durations.items()):
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, buckets):
+                cumulative += count
+                lines.append(f'omniping_probe_duration_seconds_bucket{{test="{kind}",le="{bound}"}} '
+                             f'{cumulative}')
+            cumulative += buckets[-1]
+            lines.append(f'omniping_probe_duration_seconds_bucket{{test="{kind}",le="+Inf"}} '
+                         f'{cumulative}')
+            lines.append(f'omniping_probe_duration_seconds_sum{{test="{kind}"}} {round(total, 6)}')
+            lines.append(f'omniping_probe_duration_seconds_count{{test="{kind}"}} {cumulative}')
+
+    def test_lines(self, lines):
+        '''
+        Per test histograms and counters
+        '''
+        engine = self.test_engine
+        tests = [(test, engine.metrics.tests.get(test.pos)) for test in engine.report['tests']]
+        tests = [(test, metrics) for test, metrics in tests if metrics is not None]
+
+        lines.append('# HELP omniping_probe_rtt_seconds Round trip time of successful tests')
+        lines.append('# TYPE omniping_probe_rtt_seconds histogram')
+        for _, metrics in tests:
+            cumulative = 0
+            for bound, count in zip(RTT_BUCKETS, metrics.buckets):
+                cumulative += count
+                lines.append(f'omniping_probe_rtt_seconds_bucket{{{metrics.labels},le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'omniping_probe_rtt_seconds_bucket{{{metrics.labels},le="+Inf"}} '
+                         f'{metrics.rtt_count}')
+            lines.append(f'omniping_probe_rtt_seconds_sum{{{metrics.labels}}} '
+                         f'{round(metrics.rtt_sum, 6)}')
+            lines.append(f'omniping_probe_rtt_seconds_count{{{metrics.labels}}} {metrics.rtt_count}')
+
+        results = []
+        for test, metrics in tests:
+            results.append((f'{metrics.labels},result="success"', test.total_successes))
+            results.append((f'{metrics.labels},result="timeout"', test.total_timeouts))
+            results.append((f'{metrics.labels},result="failure"',
+                            test.total - test.total_successes - test.total_timeouts))
+        self.family(lines, 'omniping_probe_results_total', 'counter', 'Test results', results)
+
+        self.family(lines, 'omniping_probe_timeout_seconds', 'gauge',
+                    'Timeout of the last test', [(metrics.labels, round(test.timeout, 6))
+                                                 for test, metrics in tests
+                                                 if test.timeout is not None])
+
+        transitions = []
+        for _, metrics in tests:
+            transitions.append((f'{metrics.labels},to="up"', metrics.ups))
+            transitions.append((f'{metrics.labels},to="down"', metrics.downs))
+        self.family(lines, 'omniping_probe_transitions_total', 'counter',
+                    'Changes between good and failed results', transitions)
+
+        self.family(lines, 'omniping_probe_up', 'gauge', 'Whether the last result was good',
+                    [(metrics.labels, int(metrics.up)) for _, metrics in tests
+                     if metrics.up is not None])
+
+    def GET(self):
+        '''
+        Handle Get Requests, the scrape itself
+        '''
+        lines = []
+        self.engine_lines(lines)
+        self.test_lines(lines)
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return ('\n'.join(lines) + '\n').encode()
@@ -0,0 +1,115 @@
+'''
+Paces the tests so a round isn't sent as one burst of packets
+'''
+import asyncio
+import ipaddress
+import random
+import time
+
+
+class OmniPingPacer():
+    '''
+    Works out each test's start offset within its interval:
+     - burst: every test starts together (the original behaviour)
+     - spread: start times evenly spaced across the interval
+     - jitter: random start times, repeatable with a seed
+    and limits how many tests run at once (max_concurrency, 0 for no
+    limit) and how many probes per second are sent to each destination
+    subnet (subnet_rate, 0 for no limit)
+    '''
+
+    modes = ['burst', 'spread', 'jitter']
+
+    def __init__(self, mode='burst', seed=None, max_concurrency=0, subnet_rate=0.0,
+                 subnet_prefix=24, subnet_prefix6=64):
+        self.mode = mode if mode in self.modes else 'burst'
+        self.seed = seed
+        self.max_concurrency = int(max_concurrency or 0)
+        self.subnet_rate = float(subnet_rate or 0)
+        self.subnet_prefix = subnet_prefix
+        self.subnet_prefix6 = subnet_prefix6
+        self.semaphore = None
+        self.subnets = {}
+        self.networks = {}
+        self.queued = 0
+        self.rate_limited = 0
+        self.rate_limit_wait = 0.0
+
+    def offsets(self, tests, interval=None):
+        '''
+        {pos: seconds} start offsets for the tests, spread across
+        interval or each test's own interval if not given
+        '''
+        tests = sorted(tests, key=lambda test: test.pos)
+        if self.mode == 'spread':
+            return {
+                test.pos: (interval or test.interval) * num / len(tests)
+                for num, test in enumerate(tests)
+            }
+        if self.mode == 'jitter':
+            rng = random.Random(self.seed)
+            return {test.pos: rng.uniform(0, interval or test.interval) for test in tests}
+        return {test.pos: 0.0 for test in tests}
+
+    async def acquire(self):
+        '''
+        Wait for a slot under the concurrency cap
+        '''
+        if not self.max_concurrency:
+            return
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self.semaphore.locked():
+            self.queued += 1
+        await self.semaphore.acquire()
+
+    def release(self):
+        '''
+        Give the slot back
+        '''
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    def subnet(self, address):
+        '''
+        The destination subnet an address is rate limited as part of
+        '''
+        network = self.networks.get(address)
+        if network is None:
+            ip = ipaddress.ip_address(address)
+            prefix = self.subnet_prefix if ip.version == 4 else self.subnet_prefix6
+            network = ipaddress.ip_network(f'{address}/{prefix}', strict=False)
+            self.networks[address] = network
+        return network
+
+    async def limit(self, address):
+        '''
+        Wait until the address' subnet may be sent another probe.
+        Each probe reserves the next 1/subnet_rate seconds of its subnet
+        '''
+        if not self.subnet_rate or address is None:
+            return
+        try:
+            network = self.subnet(address)
+        except ValueError:
+            return
+        now = time.monotonic()
+        due = max(now, self.subnets.get(network, 0.0))
+        self.subnets[network] = due + 1 / self.subnet_rate
+        if due > now:
+            self.rate_limited += 1
+            self.rate_limit_wait += due - now
+            await asyncio.sleep(due - now)
+
+    def stats(self):
+        '''
+        Pacing settings and how often tests have been held back
+        '''
+        return {
+            'mode': self.mode,
+            'max_concurrency': self.max_concurrency,
+            'subnet_rate': self.subnet_rate,
+            'queued': self.queued,
+            'rate_limited': self.rate_limited,
+            'rate_limit_wait': round(self.rate_limit_wait, 3),
+        }
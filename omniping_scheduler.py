@@ -0,0 +1,136 @@
+'''
+Heap based scheduler giving each test its own interval and deadline.
+Runs on the tester's persistent event loop
+'''
+import asyncio
+import heapq
+import itertools
+import math
+
+
+class OmniPingJob():
+    '''
+    A single scheduled job, func is called with the job's key and
+    may return a coroutine which is run as a task on the loop
+    '''
+
+    __slots__ = ('key', 'interval', 'func', 'due', 'task', 'runs', 'skipped', 'lag')
+
+    def __init__(self, key, interval, func, due):
+        self.key = key
+        self.interval = interval
+        self.func = func
+        self.due = due
+        self.task = None
+        self.runs = 0
+        self.skipped = 0
+        self.lag = 0.0
+
+
+class OmniPingScheduler():
+    '''
+    Dispatches jobs at their own intervals.
+    Next deadlines are calculated from the previous deadline rather
+    than the dispatch or completion time so the rate does not drift,
+    deadlines missed entirely (e.g. a probe still running when the next
+    one is due) are skipped and counted rather than bunched up
+    '''
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.jobs = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = False
+        self.task = False
+        self.max_lag = 0.0
+
+    def add(self, key, interval, func, delay=0.0):
+        '''
+        Add (or replace) a job, first run after delay seconds
+        '''
+        job = OmniPingJob(key, interval, func, self.loop.time() + delay)
+        self.remove(key)
+        self.jobs[key] = job
+        self.push(job)
+        return job
+
+    def remove(self, key):
+        '''
+        Remove a job, cancelling it if it is in progress.
+        Its heap entry is discarded lazily when it reaches the top
+        '''
+        job = self.jobs.pop(key, None)
+        if job and job.task and not job.task.done():
+            job.task.cancel()
+        return job
+
+    def push(self, job):
+        '''
+        Put the job's next deadline on the heap and wake the runner
+        if it is now the earliest
+        '''
+        heapq.heappush(self.heap, (job.due, next(self.counter), job))
+        if self.wakeup and self.heap[0][2] is job:
+            self.wakeup.set()
+
+    def start(self):
+        '''
+        Start the dispatch task, must be called on the loop
+        '''
+        self.wakeup = asyncio.Event()
+        self.task = self.loop.create_task(self.run())
+        return self.task
+
+    def stop(self):
+        '''
+        Stop dispatching and cancel any jobs in progress
+        '''
+        if self.task:
+            self.task.cancel()
+        for key in list(self.jobs):
+            self.remove(key)
+        self.heap = []
+        self.task = False
+
+    async def run(self):
+        '''
+        Sleep until the earliest deadline then dispatch everything due
+        '''
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            wait = self.heap[0][0] - self.loop.time()
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = self.loop.time()
+            while self.heap and self.heap[0][0] <= now:
+                due, _, job = heapq.heappop(self.heap)
+                if self.jobs.get(job.key) is not job or due != job.due:
+                    continue
+                self.dispatch(job, now)
+
+    def dispatch(self, job, now):
+        '''
+        Run a due job and work out its next deadline
+        '''
+        job.lag = now - job.due
+        self.max_lag = max(self.max_lag, job.lag)
+        if job.task and not job.task.done():
+            job.skipped += 1
+        else:
+            job.runs += 1
+            result = job.func(job.key)
+            if asyncio.iscoroutine(result):
+                job.task = self.loop.create_task(result)
+        missed = max(1, math.ceil((now - job.due) / job.interval))
+        if missed > 1:
+            job.skipped += missed - 1
+        job.due += job.interval * missed
+        self.push(job)
@@ -5,6 +5,10 @@ the omniping probes
 import cherrypy
 from omniping_setup import OmniPingSetUp
 from omniping_test_eng import OmniPingTestEng
+from omniping_test_hist import OmniPingTestHist, OmniPingTestRange
+from omniping_events import OmniPingEventsQuery
+from omniping_metrics import OmniPingMetricsExport
+from omniping_stream import OmniPingStream
 from omniping_page_init import OmniPingPageInit
 
 
@@ -21,6 +25,11 @@ class OmniPingService():
         cherrypy.log(f'[II] Starting OmniPing Version {version}')
         self.setup = OmniPingSetUp(path=path)
         self.test_engine = OmniPingTestEng(self.setup)
+        self.test_hist = OmniPingTestHist(self.test_engine)
+        self.test_range = OmniPingTestRange(self.test_engine)
+        self.events = OmniPingEventsQuery(self.test_engine)
+        self.stream = OmniPingStream(self.test_engine.broadcaster)
+        self.metrics = OmniPingMetricsExport(self.test_engine)
         self.page_init = OmniPingPageInit(
                 version=version,
                 setup=self.setup,
@@ -37,4 +46,14 @@ class OmniPingService():
             return self.setup
         if vpath[0] in ['run', 'engine']:
             return self.test_engine
+        if vpath[0] in ['history']:
+            return self.test_hist
+        if vpath[0] in ['range']:
+            return self.test_range
+        if vpath[0] in ['events']:
+            return self.events
+        if vpath[0] in ['stream']:
+            return self.stream
+        if vpath[0] in ['metrics']:
+            return self.metrics
         return self
@@ -7,8 +7,10 @@ import json
 
 import cherrypy
 
+from omniping_config import OmniPingConfig
 
-class OmniPingSetUp():
+
+class OmniPingSetUp(OmniPingConfig):
     '''
     Handles updates and requests for the setup of OmniPing Including:
     - Saving to local text file
@@ -16,28 +18,6 @@ class OmniPingSetUp():
     '''
 
     exposed = True
-    default_config = {}
-    default_config['tests'] = [{
-            "active": False,
-            "desc": "Useful Description",
-            "host": "192.168.1.205",
-            "test": "PING"
-        },
-        {
-            "active": False,
-            "desc": "Useful Description",
-            "host": "10.255.255.6",
-            "test": "HTTP"
-        }]
-    default_config['heading'] = 'OmniPing'
-    default_config['colour'] = '#FFFFFF'
-    default_config['interval'] = 4.0
-
-    colour_re = r'^\s*(#[0-9a-f]{6})\s*$'
-    desc_re = r'^\s?([0-9a-z\-\_\'\. #]+)\s?$'
-    host_re = r'^\s?([0-9a-z\.:\/]+)\s?$'
-    host_http_re = r'^\s?([0-9a-z\.:\/]+)\s?$'
-    host_ping_re = r'^\s?([0-9a-z\.]+)\s?$'
 
     content = [
         '''Use this page to set up the Omniping Probe. Colour sets the colour of
@@ -65,14 +45,71 @@ class OmniPingSetUp():
         '''The "host" field can be an IP address or domain name and a specific port can be set using
         <span style="font-style: italic;">host:port </span> syntax
         (NOTE: appropriate DNS resolution needs to be considered when running within the container).
-        Acceptable test types are PING | HTTP | HTTPS (NOTE: some additional CPU
-        overhead is anticipated for HTTPS tests)'''
+        Acceptable test types are PING | HTTP | HTTPS | TCP (NOTE: some additional CPU
+        overhead is anticipated for HTTPS tests, reduced by resuming TLS sessions).
+        TCP tests just time connecting to a port, so need the host:port syntax, and
+        are far cheaper than HTTP(S) when all that matters is whether the port is open.''',
+        '''Optional per test settings can be added as a fourth field of space separated
+        <span style="font-style: italic;">name=value</span> pairs ie:''',
+        '''<span style="font-style: italic;">&nbsp;&nbsp;&nbsp;&nbsp;
+        host ; description ; type ; interval=10 </span>''',
+        '''where "interval" runs that test at its own polling interval (seconds)
+        rather than the global one. "reuse=keepalive" sends HTTP(S) tests over
+        pooled keep-alive connections rather than a new connection each time and
+        "resolve=always" looks the host up every time rather than using the cache.''',
+        '''HTTP(S) tests time each phase of the request: DNS, TCP connect, TLS
+        handshake, time to first byte (the response headers) and the body download.
+        "fetch=headers" stops once the headers arrive rather than downloading the body
+        (closing the connection) and "fetch=head" sends a HEAD request instead.
+        HTTPS tests resume the TLS session of the last connection to the host where
+        the server allows it, "tls=full" makes a full handshake every time.''',
+        '''PING tests can send a burst of pings each interval rather than just one:
+        "count" pings "spacing" seconds apart (default 0.2) with "size" bytes of
+        payload (default 56) ie:''',
+        '''<span style="font-style: italic;">&nbsp;&nbsp;&nbsp;&nbsp;
+        host ; description ; PING ; count=10 spacing=0.1 size=1400 </span>''',
+        '''Each burst reports its loss, min/avg/max/mdev RTT, jitter and an estimated
+        MOS (voice call quality, 1 to 4.5) and every ping in it is kept in the history.
+        The burst should fit within the test's interval.''',
+        '''Rather than starting every test at once "dispatch" in hosts.json can be
+        set to "spread" (start times evenly spaced across the interval) or "jitter"
+        (random start times, repeatable by setting "dispatch_seed"). "max_concurrency"
+        caps the tests running at once and "subnet_rate" the probes per second sent
+        to each destination /24 (/64 for IPv6), 0 for no limit.''',
+        '''With a lot of HTTPS tests "http_workers" in hosts.json makes the HTTP(S)
+        requests in that many worker processes, keeping TLS handshakes and response
+        parsing off the loop that times the PING tests so their RTTs stay accurate.
+        0 (the default) runs everything on the one loop, it is ignored with shards.''',
+        '''Tests time out after half their interval, up to 2 seconds. Setting "timeouts"
+        in hosts.json to "adaptive" gives each test a timeout based on the RTTs it has
+        seen (as TCP does), between "timeout_floor" and "timeout_ceiling" seconds
+        (default 0.1 and 2), so a fast local target is declared down far sooner.
+        Time outs are counted separately from other failures.''',
+        '''Besides the last "history_size" results each test keeps 1 minute, 5 minute
+        and 1 hour summaries (count, loss, min/avg/max/p95 RTT) for runs lasting days,
+        "rollup_sizes" being how many of each are kept (default 720, 864 and 336:
+        12 hours, 3 days and 2 weeks, about 60KB per test). The range API returns
+        whichever covers the times asked for in the fewest points ie:''',
+        '''<span style="font-style: italic;">&nbsp;&nbsp;&nbsp;&nbsp;
+        /omniping/range?pos=0&start=2024-06-01T02:00&end=2024-06-01T02:30</span>''',
+        '''Every time a test goes from good to failing or back it is logged (the last
+        "event_log_size" changes, default 10000) with how long the previous state
+        lasted. /omniping/events returns them, "after=n" only those since the last
+        one seen, "since=time" those from a given time and "pos=n" one test's, along
+        with the tests that are down now and when they went down.'''
     ]
 
     def __init__(self, path):
         self.host_file = os.path.join(path, 'hosts.json')
+        self.file_stamp = None
+        self.keys = []
+        self.index = {}
+        self.changes = self.empty_changes()
+        self.config = {}
+        self.saved = set()
+        self.on_change = None
         self.get_setup_from_file()
-        self.pending_changes = False
+        self.take_changes()
 
     @cherrypy.tools.json_out()
     def GET(self):
@@ -133,6 +170,8 @@ class OmniPingSetUp():
         new_tests = self.check_tests(cherrypy.request.json.get('tests', False))
         message = self.update(updated_config, new_tests)
         self.save_setup_to_file()
+        if self.on_change:
+            self.on_change()
         response = self.make_response()
         response['message'] = message
         return response
@@ -154,65 +193,72 @@ class OmniPingSetUp():
     def get_setup_from_file(self):
         '''
         opens up the hosts.txt file and extracts the information required to operate
-        if available
+        if available. The parsed file is cached until its mtime, inode or size
+        changes, tests changed in the file are added to the pending changes
+        and handed to the engine as a change saved from the page would be
         '''
-        self.config = self.default_config.copy()
         try:
-            with open(self.host_file, 'r') as tests_file:
-                self.config = json.load(tests_file)
+            stat = os.stat(self.host_file)
+            stamp = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        except OSError:
+            stamp = None
+        if stamp is not None and stamp == self.file_stamp:
+            return
+
+        config = self.defaults()
+        saved = set()
+        try:
+            from_file = self.read_file(self.host_file)
+            config.update(from_file)
+            saved = set(from_file)
 
         except (PermissionError, FileNotFoundError):
             cherrypy.log('[II] Can\'t find or read configuration file Using defaults !!')
         except json.decoder.JSONDecodeError:
             cherrypy.log('[II] Empty or Invalid configuration file Using defaults !!')
 
+        for message in self.check_settings(config):
+            cherrypy.log(f'[EE] {message}')
+        tests = config['tests'] if isinstance(config['tests'], list) else []
+        config['tests'] = []
+        for test in tests:
+            if self.is_valid_test(test):
+                config['tests'].append(test)
+            else:
+                cherrypy.log(f'[EE] Invalid Test - {test!r} ignored')
+
+        self.file_stamp = stamp
+        changes = self.diff(config['tests'])
+        self.config = config
+        self.saved = saved
+        self.set_tests(config['tests'], changes)
+        if self.on_change and self.has_changed(changes):
+            cherrypy.log('[II] Tests changed in the configuration file')
+            self.on_change()
+
     def save_setup_to_file(self):
         '''
         Updates the hosts.json file with current configuration
-        updated to use json
+        updated to use json. Only the settings the file had or that
+        have been edited are written, the rest stay at their defaults
         '''
+        config = {key: self.config[key] for key in self.saved}
         try:
             with open(self.host_file, 'w') as tests_file:
                 json.dump(
-                        self.config,
+                        config,
                         tests_file,
                         sort_keys=True,
                         indent=4,
                         ensure_ascii=False
                         )
                 cherrypy.log('[II] OmniPing Configuration Saved')
+            stat = os.stat(self.host_file)
+            self.file_stamp = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
 
         except (PermissionError, FileNotFoundError):
             cherrypy.log('[EE] Can\'t save Omniping Config !!')
 
-    def is_valid_test(self, test):
-        '''
-        Validate parameters of each test dictionary
-        '''
-        valid_keys = ['host', 'desc', 'test', 'active']
-        for key in valid_keys:
-            if key not in test.keys():
-                return False
-
-        if test.get('test', '').upper() not in ['PING', 'HTTP', 'HTTPS']:
-            return False
-
-        host_match = re.match(self.host_http_re, test.get('host', '%'), re.IGNORECASE)
-
-        if test.get('test', '').upper() in ['PING']:
-            host_match = re.match(self.host_ping_re, test.get('host', '%'), re.IGNORECASE)
-
-        if not host_match:
-            return False
-
-        desc_match = re.match(self.desc_re, test.get('desc', '%'), re.IGNORECASE)
-        if not desc_match:
-            return False
-
-        if not isinstance(test['active'], bool):
-            return False
-        return True
-
     def check_tests(self, tests):
         '''
         orchestrate checking of each test
@@ -227,22 +273,85 @@ class OmniPingSetUp():
                     mess = f'[EE] Invalid Test - {test_str}'
                     cherrypy.log(mess)
                     raise cherrypy.HTTPError(400, f'{mess}')
-            self.pending_changes = True
             return new_tests
         return self.config['tests']
 
-    def has_changed(self, new_tests):
+    @staticmethod
+    def empty_changes():
         '''
-        checks if test configurations have changed
+        A changeset with nothing in it
         '''
-        if len(new_tests) != len(self.config['tests']):
-            return True
+        return {'added': [], 'removed': [], 'modified': [], 'reordered': False}
 
-        for pos, test in enumerate(new_tests):
-            for key in test.keys():
-                if test[key] != self.config['tests'][pos][key]:
-                    return True
-        return False
+    def diff(self, new_tests):
+        '''
+        The changeset between the current tests and new_tests
+        '''
+        new_keys = self.make_keys(new_tests)
+        new_index = dict(zip(new_keys, new_tests))
+        changes = self.empty_changes()
+        changes['added'] = [key for key in new_keys if key not in self.index]
+        changes['removed'] = [key for key in self.keys if key not in new_index]
+        changes['modified'] = [
+            key for key in new_keys
+            if key in self.index and self.index[key] != new_index[key]
+        ]
+        kept = [key for key in self.keys if key in new_index]
+        changes['reordered'] = kept != [key for key in new_keys if key in self.index]
+        return changes
+
+    def has_changed(self, changes):
+        '''
+        checks if a changeset changes anything
+        '''
+        return any(changes.values())
+
+    def set_tests(self, tests, changes):
+        '''
+        Make tests the current tests, re-indexing them and adding
+        the changes to those pending for the test engine
+        '''
+        self.config['tests'] = tests
+        self.keys = self.make_keys(tests)
+        self.index = dict(zip(self.keys, tests))
+        pending = self.changes
+        for key in changes['added']:
+            if key in pending['removed']:
+                pending['removed'].remove(key)
+                pending['modified'].append(key)
+            else:
+                pending['added'].append(key)
+        for key in changes['removed']:
+            if key in pending['added']:
+                pending['added'].remove(key)
+                continue
+            if key in pending['modified']:
+                pending['modified'].remove(key)
+            pending['removed'].append(key)
+        for key in changes['modified']:
+            if key not in pending['added'] and key not in pending['modified']:
+                pending['modified'].append(key)
+        pending['reordered'] = pending['reordered'] or changes['reordered']
+
+    @property
+    def pending_changes(self):
+        '''
+        True if the tests have changed since the engine last took the changes
+        '''
+        return self.has_changed(self.changes)
+
+    def lookup(self, key):
+        '''
+        The configuration of a test by its key
+        '''
+        return self.index.get(key)
+
+    def take_changes(self):
+        '''
+        Hand the pending changeset to the engine
+        '''
+        changes, self.changes = self.changes, self.empty_changes()
+        return changes
 
     def update(self, updated_config, new_tests):
         '''
@@ -250,8 +359,10 @@ class OmniPingSetUp():
         '''
         mess_list = []
         mess_prepend = ''
-        if self.has_changed(new_tests):
-            self.config['tests'] = new_tests
+        changes = self.diff(new_tests)
+        if self.has_changed(changes):
+            self.set_tests(new_tests, changes)
+            self.saved.add('tests')
             mess_list.append('Tests')
 
         valid_keys = ['heading', 'colour', 'interval']
@@ -259,6 +370,8 @@ class OmniPingSetUp():
             if updated_config.get(key, '') != self.config[key]:
                 mess_list.append(key.capitalize())
                 self.config[key] = updated_config.get(key, self.config[key])
+                if key in updated_config:
+                    self.saved.add(key)
 
         if not self.config['tests']:
             mess_prepend = ("- 0 tests Defined !!")
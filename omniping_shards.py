@@ -0,0 +1,318 @@
+'''
+Multi-process test engine for very large test lists.
+The tests are sharded across worker processes, each running its own
+OmniPingTester and event loop, results are sent back in batches of
+compact tuples and merged into the single report the engine serves
+'''
+from datetime import datetime
+import multiprocessing
+import threading
+import time
+
+from omniping_http import handshake_averages
+from omniping_loop import OmniPingLoop
+from omniping_scheduler import OmniPingScheduler
+from omniping_state import OmniPingTestState
+from omniping_tester import OmniPingTester
+
+# Results are batched for up to this long before being sent to the parent
+FLUSH_DELAY = 0.05
+
+
+def shard_main(conn, tests, interval, options, tester_kwargs):
+    '''
+    Entry point of a shard process. tests is a list of (pos, test config)
+    Sends ('results', [(pos, status, good, rtt, dns, code, scheduled, sent, burst, packets,
+    timings, timeout), ...]) and ('health', {...}) messages until told to stop or the pipe closes.
+    Receives ('update', [(pos, test config), ...], [removed pos, ...], interval)
+    to change its tests without restarting
+    '''
+    report = {}
+    report['started'] = False
+    report['time'] = False
+    report['count'] = 0
+    report['duration'] = 0
+    report['tests'] = [OmniPingTestState(test, pos, interval, options) for pos, test in tests]
+
+    tester = OmniPingTester(interval=interval, **tester_kwargs)
+    batch = []
+    health = {'results': 0, 'cpu': time.process_time(), 'wall': time.monotonic()}
+
+    def flush():
+        if batch:
+            conn.send(('results', batch[:]))
+            batch.clear()
+
+    def on_result(test, rtt, code):
+        if not batch:
+            tester.loop.loop.call_later(FLUSH_DELAY, flush)
+        batch.append((test.pos, test.status, test.good, rtt, test.dns, code,
+                      test.scheduled, test.sent, test.burst, test.packets, test.timings,
+                      test.timeout))
+        health['results'] += 1
+
+    def on_round():
+        flush()
+        cpu, wall = time.process_time(), time.monotonic()
+        shard_health = tester.stats()
+        shard_health['results'] = health['results']
+        shard_health['load_percent'] = round(
+                                        (cpu - health['cpu']) / max(wall - health['wall'], 1e-6) * 100,
+                                        1)
+        health['cpu'], health['wall'] = cpu, wall
+        conn.send(('health', shard_health))
+
+    def update(added, removed, interval):
+        states = []
+        for pos, test in added:
+            state = OmniPingTestState(test, pos, interval or tester.interval, options)
+            old = tester.tests.get(pos)
+            if old is not None:
+                state.carry_over(old)
+            states.append(state)
+        positions = set(removed) | {state.pos for state in states}
+        report['tests'] = [test for test in report['tests'] if test.pos not in positions] + states
+        tester.apply_update(states, removed, interval)
+
+    tester.start(report, on_round=on_round, on_result=on_result)
+    try:
+        while True:
+            message = conn.recv()
+            if message == 'stop':
+                break
+            if message[0] == 'update':
+                tester.loop.call(update, *message[1:])
+    except (EOFError, OSError, KeyboardInterrupt):
+        pass
+    finally:
+        tester.stop()
+        conn.close()
+
+
+class OmniPingShardedTester():
+    '''
+    Presents the same start/stop/stats interface as OmniPingTester.
+    Shard results are read on a local event loop thread, so the engine's
+    callbacks run on one thread just as with the single process tester
+    '''
+
+    def __init__(self, shards=2, interval=2, options=None, **tester_kwargs):
+        self.shard_count = max(1, int(shards))
+        self.interval = interval
+        self.options = options or []
+        self.tester_kwargs = tester_kwargs
+        self.loop = OmniPingLoop(name='omniping-shards')
+        self.context = multiprocessing.get_context('spawn')
+        self.scheduler = False
+        self.shards = []
+        self.tests = {}
+        self.report = False
+        self.on_round = None
+        self.on_result = None
+        self.lock = threading.Lock()
+
+    def start(self, report, on_round=None, on_result=None):
+        '''
+        Start a process per shard, tests are dealt out by position
+        '''
+        self.report = report
+        self.on_round = on_round
+        self.on_result = on_result
+        self.tests = {test.pos: test for test in report['tests']}
+        if not report['started']:
+            report['started'] = datetime.now()
+
+        self.loop.start()
+        for num in range(self.shard_count):
+            tests = [
+                (pos, test.config()) for pos, test in self.tests.items()
+                if pos % self.shard_count == num
+            ]
+            if tests:
+                self.shards.append(self.spawn(num, tests))
+        self.loop.run(self.schedule())
+
+    def spawn(self, num, tests):
+        '''
+        Start shard num's process with its (pos, test config) tests
+        '''
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+                    target=shard_main,
+                    args=(child_conn, tests, self.interval, self.options, self.tester_kwargs),
+                    name=f'omniping-shard-{num}',
+                    daemon=True,
+                    )
+        process.start()
+        child_conn.close()
+        return {'num': num, 'process': process, 'conn': parent_conn,
+                'positions': {pos for pos, _ in tests}, 'results': 0,
+                'last_seen': time.monotonic(), 'health': {}}
+
+    async def schedule(self):
+        '''
+        Watch the shard pipes and tick over the report's rounds
+        '''
+        for shard in self.shards:
+            self.loop.loop.add_reader(shard['conn'].fileno(), self.receive, shard)
+        self.scheduler = OmniPingScheduler(self.loop.loop)
+        self.scheduler.add('round', self.interval, self.round_tick, delay=self.interval)
+        self.scheduler.start()
+
+    def receive(self, shard):
+        '''
+        Reader callback, merges result batches into the report
+        '''
+        try:
+            while shard['conn'].poll():
+                kind, payload = shard['conn'].recv()
+                shard['last_seen'] = time.monotonic()
+                if kind == 'health':
+                    shard['health'] = payload
+                    continue
+                for (pos, status, good, rtt, dns, code, scheduled, sent, burst, packets,
+                     timings, timeout) in payload:
+                    test = self.tests.get(pos)
+                    if test is None:
+                        continue
+                    test.begin()
+                    test.dns = dns
+                    test.scheduled = scheduled
+                    test.sent = sent
+                    test.burst = burst
+                    test.packets = packets
+                    test.timings = timings
+                    test.timeout = timeout
+                    test.record(status, good, rtt)
+                    shard['results'] += 1
+                    if self.on_result:
+                        self.on_result(test, rtt, code)
+        except (EOFError, OSError):
+            self.loop.loop.remove_reader(shard['conn'].fileno())
+
+    def round_tick(self, _):
+        '''
+        Update the report's round counters, called by the scheduler
+        '''
+        report = self.report
+        report['count'] += 1
+        report['time'] = datetime.now()
+        report['duration'] = report['time'] - report['started']
+        if self.on_round:
+            self.on_round()
+
+    def update(self, added, removed, interval=None):
+        '''
+        Live reconfiguration: each added (or modified) and removed test is
+        sent to the shard its position deals it to, the other tests carry
+        on untouched. A shard that had no tests, or has died, is started
+        with every test dealt to it
+        '''
+        with self.lock:
+            if not self.loop.running:
+                if interval:
+                    self.interval = interval
+                return
+            if interval == self.interval:
+                interval = None
+            elif interval:
+                self.interval = interval
+            self.loop.call(self.apply_update, added, removed, interval)
+            shards = {shard['num']: shard for shard in self.shards}
+            for num in range(self.shard_count):
+                shard_added = [(test.pos, test.config()) for test in added
+                               if test.pos % self.shard_count == num]
+                shard_removed = [pos for pos in removed if pos % self.shard_count == num]
+                if not shard_added and not shard_removed:
+                    continue
+                shard = shards.get(num)
+                if shard is None or not shard['process'].is_alive():
+                    tests = {pos: test for pos, test in list(self.tests.items())
+                             if pos % self.shard_count == num and pos not in shard_removed}
+                    tests.update({test.pos: test for test in added
+                                  if test.pos % self.shard_count == num})
+                    if not tests:
+                        continue
+                    shard = self.spawn(num, [(pos, test.config()) for pos, test in tests.items()])
+                    self.shards = [old for old in self.shards if old['num'] != num] + [shard]
+                    self.loop.call(self.loop.loop.add_reader, shard['conn'].fileno(),
+                                   self.receive, shard)
+                    continue
+                try:
+                    shard['conn'].send(('update', shard_added, shard_removed, interval))
+                except OSError:
+                    continue
+                shard['positions'].difference_update(shard_removed)
+                shard['positions'].update(pos for pos, _ in shard_added)
+
+    def apply_update(self, added, removed, interval=None):
+        '''
+        Swap the tests results are merged into and change the
+        round interval, run on the loop
+        '''
+        for pos in removed:
+            self.tests.pop(pos, None)
+        for test in added:
+            self.tests[test.pos] = test
+        if interval and self.scheduler:
+            self.scheduler.add('round', interval, self.round_tick, delay=interval)
+
+    def stop(self):
+        '''
+        Ask the shards to stop, terminating any that don't
+        '''
+        with self.lock:
+            for shard in self.shards:
+                try:
+                    shard['conn'].send('stop')
+                except OSError:
+                    pass
+            for shard in self.shards:
+                shard['process'].join(5)
+                if shard['process'].is_alive():
+                    shard['process'].terminate()
+            self.loop.stop(cleanup=self.close)
+            self.shards = []
+
+    async def close(self):
+        '''
+        Clean up run on the loop itself prior to it stopping
+        '''
+        if self.scheduler:
+            self.scheduler.stop()
+        for shard in self.shards:
+            try:
+                self.loop.loop.remove_reader(shard['conn'].fileno())
+            except (OSError, ValueError):
+                pass
+            shard['conn'].close()
+
+    def stats(self):
+        '''
+        Per shard health and load plus the shards' engine stats summed
+        '''
+        now = time.monotonic()
+        stats = {'shards': []}
+        for shard in self.shards:
+            health = {}
+            health['shard'] = shard['num']
+            health['pid'] = shard['process'].pid
+            health['alive'] = shard['process'].is_alive()
+            health['tests'] = len(shard['positions'])
+            health['results'] = shard['results']
+            health['last_seen'] = round(now - shard['last_seen'], 3)
+            health['load_percent'] = shard['health'].get('load_percent')
+            stats['shards'].append(health)
+            for section in ('http_pool', 'dns', 'scheduler', 'probes', 'pacing', 'timeouts'):
+                for key, value in shard['health'].get(section, {}).items():
+                    total = stats.setdefault(section, {})
+                    if key in ('max_lag', 'loop_lag'):
+                        total[key] = max(total.get(key, 0), value)
+                    elif key in ('ttl', 'negative_ttl', 'idle_timeout', 'max_concurrency',
+                                 'subnet_rate', 'mode', 'floor', 'ceiling'):
+                        total[key] = value
+                    elif isinstance(value, (int, float)):
+                        total[key] = total.get(key, 0) + value
+        if 'http_pool' in stats:
+            handshake_averages(stats['http_pool'])
+        return stats
@@ -0,0 +1,191 @@
+'''
+Compact per test state records used by the tester and the report.
+Results are stored as raw numbers and monotonic timestamps, the
+strings the UI shows are only built when a report is rendered
+'''
+from datetime import datetime
+import time
+
+
+def sucPer(total_trys, successes):
+    '''
+    This is just a function to work out pecentage success
+    and cope with the Zero division
+    '''
+    try:
+        totp = "{0:.2f} %".format(successes/total_trys * 100)
+    except ZeroDivisionError:
+        totp = "0.00 %"
+    return totp
+
+
+class OmniPingTestState():
+    '''
+    The configuration and running totals of a single test
+    '''
+
+    # The results and counters a modified test keeps from the state it replaces
+    CARRIED = (
+        'good', 'status', 'last_stat', 'rtt', 'dns', 'total', 'total_successes',
+        'total_timeouts', 'last_good', 'last_bad', 'last_bad_status', 'scheduled', 'sent',
+        'last_scheduled', 'last_sent', 'burst', 'packets', 'timings', 'timeout', 'rto',
+    )
+
+    __slots__ = (
+        'pos', 'host', 'desc', 'test', 'interval', 'options',
+        'good', 'status', 'last_stat', 'rtt', 'dns', 'total', 'total_successes',
+        'total_timeouts', 'last_good', 'last_bad', 'last_bad_status', 'scheduled', 'sent',
+        'last_scheduled', 'last_sent', 'burst', 'packets', 'timings', 'timeout', 'rto', 'version',
+    )
+
+    def __init__(self, test, pos, interval, options=None):
+        self.pos = pos
+        self.host = test['host']
+        self.desc = test['desc']
+        self.test = test['test'].upper()
+        self.interval = test.get('interval', interval)
+        self.options = {}
+        for key in options or []:
+            if key in test:
+                self.options[key] = test[key]
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        '''
+        Reset the results and counters
+        '''
+        self.good = False
+        self.status = '--'
+        self.last_stat = '--'
+        self.rtt = None
+        self.dns = None
+        self.total = 0
+        self.total_successes = 0
+        self.total_timeouts = 0
+        self.last_good = None
+        self.last_bad = None
+        self.last_bad_status = '--'
+        self.scheduled = None
+        self.sent = None
+        self.last_scheduled = None
+        self.last_sent = None
+        self.burst = None
+        self.packets = None
+        self.timings = None
+        self.timeout = None
+        self.rto = None
+        self.version += 1
+
+    def carry_over(self, old):
+        '''
+        Take the results and counters of the state this one replaces
+        '''
+        for name in self.CARRIED:
+            setattr(self, name, getattr(old, name))
+        self.version = old.version + 1
+
+    def snapshot(self):
+        '''
+        A copy of the state as it is now, to hand a result to another
+        thread while the test carries on
+        '''
+        copy = OmniPingTestState.__new__(OmniPingTestState)
+        for name in self.__slots__:
+            setattr(copy, name, getattr(self, name))
+        return copy
+
+    def config(self):
+        '''
+        The test's configuration as it would appear in hosts.json
+        '''
+        config = {}
+        config['host'] = self.host
+        config['desc'] = self.desc
+        config['test'] = self.test
+        config['active'] = True
+        config['interval'] = self.interval
+        config.update(self.options)
+        return config
+
+    def begin(self):
+        '''
+        Mark the test as in progress
+        '''
+        self.last_stat = self.status
+        self.status = 'Incomplete'
+        self.good = False
+        self.rtt = None
+        self.dns = None
+        self.sent = None
+        self.burst = None
+        self.packets = None
+        self.timings = None
+        self.version += 1
+
+    def record(self, status, good, rtt=None, stamp=None):
+        '''
+        Record the result of a completed test, stamp is the monotonic
+        time of the result (now unless replaying the journal). The probe's
+        scheduled and send times are kept as the last completed ones, as
+        the next dispatch resets them before the report is rendered
+        '''
+        stamp = time.monotonic() if stamp is None else stamp
+        self.last_scheduled = self.scheduled
+        self.last_sent = self.sent
+        self.total += 1
+        self.status = status
+        self.good = good
+        if good:
+            self.total_successes += 1
+            self.last_good = stamp
+            self.rtt = rtt
+        else:
+            self.last_bad = stamp
+            self.last_bad_status = status
+            if status == 'Time Out':
+                self.total_timeouts += 1
+        self.version += 1
+
+    def render(self, offset=None):
+        '''
+        Build the dictionary the UI expects. offset converts monotonic
+        timestamps to wall clock ones (time.time() - time.monotonic())
+        '''
+        if offset is None:
+            offset = time.time() - time.monotonic()
+
+        def when(stamp, fmt='%a %H:%M:%S'):
+            if stamp is None:
+                return '--'
+            return datetime.fromtimestamp(stamp + offset).strftime(fmt)
+
+        test_dict = {}
+        test_dict['host'] = self.host
+        test_dict['desc'] = self.desc
+        test_dict['test'] = self.test
+        test_dict['interval'] = self.interval
+        test_dict.update(self.options)
+        test_dict['good'] = self.good
+        test_dict['last_stat'] = self.last_stat
+        test_dict['status'] = self.status
+        test_dict['rtt'] = '--' if self.rtt is None else f'{self.rtt:.3f} ms'
+        test_dict['dns'] = '--' if self.dns is None else f'{self.dns:.3f} ms'
+        test_dict['total'] = self.total
+        test_dict['total_successes'] = self.total_successes
+        test_dict['total_timeouts'] = self.total_timeouts
+        test_dict['total_failures'] = self.total - self.total_successes - self.total_timeouts
+        test_dict['success_percent'] = sucPer(self.total, self.total_successes)
+        test_dict['last_good'] = when(self.last_good)
+        test_dict['last_bad'] = when(self.last_bad)
+        test_dict['last_bad_status'] = self.last_bad_status
+        test_dict['scheduled'] = when(self.last_scheduled, '%H:%M:%S.%f')[:12]
+        test_dict['sent'] = when(self.last_sent, '%H:%M:%S.%f')[:12]
+        test_dict['send_lag'] = '--'
+        if self.last_scheduled is not None and self.last_sent is not None:
+            test_dict['send_lag'] = f'{(self.last_sent - self.last_scheduled) * 1000:.3f} ms'
+        test_dict['burst'] = self.burst
+        test_dict['timings'] = self.timings
+        test_dict['timeout'] = '--' if self.timeout is None else f'{self.timeout * 1000:.1f} ms'
+        test_dict['pos'] = self.pos
+        return test_dict
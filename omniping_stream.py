@@ -0,0 +1,140 @@
+'''
+Server-Sent Events stream of test results and completed rounds
+i.e. http://<omniping>/omniping/stream
+'''
+from collections import deque
+import threading
+
+import cherrypy
+
+
+class OmniPingSubscriber():
+    '''
+    A bounded queue of encoded events for one client. When a slow
+    client's queue is full the oldest events are dropped (and counted)
+    rather than holding up the engine or the other clients
+    '''
+
+    def __init__(self, limit):
+        self.events = deque(maxlen=limit)
+        self.ready = threading.Condition()
+        self.dropped = 0
+
+    def put(self, event):
+        '''
+        Queue an event, called from the engine's loop thread
+        '''
+        with self.ready:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self.ready.notify()
+
+    def get(self, timeout):
+        '''
+        Wait up to timeout seconds for the next event, None if there isn't one
+        '''
+        with self.ready:
+            if not self.events:
+                self.ready.wait(timeout)
+            if self.events:
+                return self.events.popleft()
+        return None
+
+
+class OmniPingBroadcaster():
+    '''
+    Fans each event out to every subscriber, events are encoded
+    once however many clients are listening
+    '''
+
+    def __init__(self, max_clients=4, queue_limit=256):
+        self.max_clients = max_clients
+        self.queue_limit = queue_limit
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    @property
+    def listening(self):
+        '''
+        True if anyone is subscribed, lets publishers skip rendering
+        '''
+        return bool(self.subscribers)
+
+    def subscribe(self):
+        '''
+        Returns a new subscriber or None if the client limit is reached
+        '''
+        with self.lock:
+            if len(self.subscribers) >= self.max_clients:
+                return None
+            subscriber = OmniPingSubscriber(self.queue_limit)
+            self.subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        '''
+        Remove a subscriber when its client goes away
+        '''
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event, data):
+        '''
+        Encode an event (data is a JSON string or bytes) and queue it for everyone
+        '''
+        if not self.subscribers:
+            return
+        if isinstance(data, bytes):
+            data = data.decode()
+        message = f'event: {event}\ndata: {data}\n\n'.encode()
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+
+class OmniPingStream():
+    '''
+    Streams events to the client as they are published:
+     - result: a test's rendered state each time it completes
+     - round: the full rendered report each time a round completes
+     - transition: a test going down or coming back up, see OmniPingEvents
+    Each client holds a CherryPy worker thread for as long as it is
+    connected, hence the client limit
+    '''
+
+    exposed = True
+    _cp_config = {'response.stream': True}
+    keepalive = 15.0
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+
+    def GET(self):
+        '''
+        Handle Get Requests, returns a generator CherryPy streams from
+        '''
+        subscriber = self.broadcaster.subscribe()
+        if subscriber is None:
+            mess = 'Too many stream clients'
+            cherrypy.log(f'[EE] {mess}')
+            raise cherrypy.HTTPError(503, f'{mess}')
+
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        cherrypy.response.headers['X-Accel-Buffering'] = 'no'
+
+        def stream():
+            try:
+                yield b'retry: 3000\n\n'
+                while True:
+                    event = subscriber.get(self.keepalive)
+                    if event is None:
+                        yield f': dropped {subscriber.dropped}\n\n'.encode()
+                    else:
+                        yield event
+            finally:
+                self.broadcaster.unsubscribe(subscriber)
+
+        return stream()
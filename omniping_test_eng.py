@@ -2,11 +2,21 @@
 Manages the test engine, i.e. get reports and starts and stops the background process
 '''
 from datetime import datetime
+import json
+import os
+import threading
 import time
 
 import cherrypy
-from cherrypy.process.plugins import BackgroundTask
 
+from omniping_consumer import OmniPingConsumer
+from omniping_events import OmniPingEvents
+from omniping_history import OmniPingHistory, ROLLUP_TIERS
+from omniping_journal import OmniPingJournal
+from omniping_metrics import OmniPingMetrics
+from omniping_state import OmniPingTestState
+from omniping_stream import OmniPingBroadcaster
+from omniping_shards import OmniPingShardedTester
 from omniping_tester import OmniPingTester
 
 
@@ -28,9 +38,10 @@ class OmniPingTestEng():
         any outstanding tests to complete. If you find too many incomplete tasks
         you could try and reduce the interval between tests. Or try running less
         tests if possible.''',
-        '''The Client Auto-refresh runs every 3 Seconds, so if you are polling
-        devices every second you are more likely to ask for a report when some
-        tests have not completed.''',
+        '''The Client Auto-refresh is pushed the report by the server as each
+        round completes (every polling interval) falling back to requesting it
+        every 3 Seconds if the browser can't stream. Tests with their own interval
+        may still be in progress when a round completes.''',
         '''When Running HTTP and HTTPS tests it is not obvious how best to treat
         any given HTTP error code, for example a 401 or 403 might be expected and
         hence be a good result showing the server is available. As such any HTTP
@@ -41,21 +52,104 @@ class OmniPingTestEng():
 
     def __init__(self, setup):
         self.setup = setup
+        self.setup.on_change = self.apply_changes
         self.running = False
-        self.bgtask = False
         self.tester = False
+        self.history = {}
+        self.states = {}
+        self.next_pos = 0
+        self.generation = 0
+        # Random per process and per start so an ETag isn't reused
+        # once the counters start again from nothing
+        self.nonce = os.urandom(4).hex()
+        self.render_lock = threading.Lock()
+        self.rendered = {'key': None, 'etag': '', 'body': b''}
+        self.rendered_tests = {}
+        self.metrics = OmniPingMetrics()
+        self.consumer = OmniPingConsumer(log=cherrypy.log)
+        self.broadcaster = OmniPingBroadcaster(
+                                max_clients=setup.config['stream_clients'],
+                                queue_limit=setup.config['stream_queue'],
+                                )
+        self.journal = False
+        if setup.config['journal']:
+            self.journal = OmniPingJournal(
+                                os.path.join(os.path.dirname(setup.host_file), 'journal'),
+                                segment_size=setup.config['journal_segment_size'],
+                                max_size=setup.config['journal_max_size'],
+                                )
+        self.events = OmniPingEvents(setup.config['event_log_size'])
         self.report = self.make_initial_report()
+        self.consumer.put(self.restore)
 
-    @cherrypy.tools.json_out()
-    def GET(self):
+    def GET(self, since=None):
         '''
         Handle Get Requests for the Report page
+        The report is rendered once per round and served from the cache
+        with an ETag (304 if unchanged). since=<count> returns only the
+        tests which have changed since that poll count
         '''
-        report = self.make_jsonable_report()
-        count = report.get('count', 'Error')
-        report['message'] = f'Retrieved report ({count})'
+        etag, body = self.render_report()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                mess = f'Invalid poll count - {since}'
+                cherrypy.log(f'[EE] {mess}')
+                raise cherrypy.HTTPError(400, f'{mess}')
+            return json.dumps(self.make_delta_report(since)).encode()
+
+        cherrypy.response.headers['ETag'] = etag
+        if cherrypy.request.headers.get('If-None-Match') == etag:
+            cherrypy.response.status = 304
+            return b''
+        return body
+
+    def render_report(self):
+        '''
+        Render the full report to JSON bytes unless the cached copy is
+        still current, i.e. no round has completed since it was built.
+        Returns (etag, body)
+        '''
+        with self.render_lock:
+            key = (self.nonce, self.generation, self.report['count'], self.running)
+            if self.rendered['key'] != key:
+                start = time.perf_counter()
+                report = self.make_jsonable_report()
+                report['message'] = f'Retrieved report ({report["count"]})'
+                report['running'] = self.running
+                report['content'] = self.content
+                if self.tester:
+                    report.update(self.tester.stats())
+                report['consumer'] = self.consumer.stats()
+                if self.journal:
+                    report['journal'] = self.journal.info()
+                report['events'] = self.events.info()
+                self.rendered['key'] = key
+                self.rendered['etag'] = '"{}-{}-{}-{}"'.format(*key)
+                self.rendered['body'] = json.dumps(report).encode()
+                self.metrics.observe_render(time.perf_counter() - start)
+            return self.rendered['etag'], self.rendered['body']
+
+    def make_delta_report(self, since):
+        '''
+        The tests whose rendered state changed after poll count since
+        '''
+        with self.render_lock:
+            tests = [
+                rendered for _, changed, rendered in self.rendered_tests.values()
+                if changed > since
+            ]
+        report = {}
+        report['count'] = self.report['count']
+        report['since'] = since
+        report['generation'] = self.generation
         report['running'] = self.running
-        report['content'] = self.content
+        report['tests'] = tests
+        report['message'] = f'Retrieved {len(tests)} changes since {since}'
         return report
 
     @cherrypy.tools.json_in()
@@ -76,11 +170,14 @@ class OmniPingTestEng():
             raise cherrypy.HTTPError(400, f'{mess}')
 
         update = 'No change'
+        if action in ['start', 'reset', 'clear']:
+            # The journal is replayed on the consumer thread at start up,
+            # let it finish before the report is touched
+            self.consumer.wait()
         if action == 'start' and not self.running:
             if self.setup.pending_changes:
-                self.report = self.make_initial_report()
-                self.setup.pending_changes = False
-            if len(self.report['tests']) != 1:
+                self.apply_changes()
+            if self.report['tests']:
                 self.start()
                 update = f'Started Polling ({self.setup.config["interval"]} secs)'
             else:
@@ -93,19 +190,16 @@ class OmniPingTestEng():
             if self.running:
                 self.stop()
                 update = "Report Cleared and Polling Stopped"
+            if self.journal:
+                self.journal.clear()
             self.report = self.make_initial_report()
         if action == 'clear':
-            restart = False
-            if self.running:
-                self.stop()
-                restart = True
-                time.sleep(self.setup.config['interval'])
-            self.report = self.make_initial_report()
-            if restart:
-                self.start()
+            if self.journal:
+                self.journal.clear()
+            self.clear_counters()
             update = "Report Counters Cleared"
         if action == 'restart_cp':
-            self.stop()
+            self.stop(wait=True)
             update = "Restarting CherryPy Server"
             cherrypy.engine.restart()
 
@@ -117,66 +211,252 @@ class OmniPingTestEng():
 
     def testerCall(self):
         '''
-        the function refrenced by the CherryPy background task to update the report
+        the function refrenced by the tester each time a round of the
+        engine's interval completes. It runs on the tester's loop, which
+        times the probes, so the round is only noted here and the report
+        rendered on the consumer thread
         '''
-        self.report = self.tester.run_once(self.report)
-        cherrypy.log(f'[II] Poll Count: {self.report["count"]} - Time {self.report["duration"]}')
+        self.metrics.observe_round()
+        self.consumer.put(self.publish_round, self.report['count'], self.report['duration'])
+
+    def publish_round(self, count, duration):
+        '''
+        Render the report so GET requests are served from the cache
+        and push it to the stream, run on the consumer thread
+        '''
+        cherrypy.log(f'[II] Poll Count: {count} - Time {duration}')
+        if self.journal:
+            self.journal.flush()
+        _, body = self.render_report()
+        self.broadcaster.publish('round', body)
+
+    def record_result(self, test, rtt, code):
+        '''
+        the function refrenced by the tester after each test completes.
+        It runs on the tester's loop so the result is only queued, with
+        a copy of the test's state, for the consumer thread to record
+        '''
+        self.consumer.put(self.consume_result, test.snapshot(), rtt, code, time.time(),
+                          time.monotonic())
+
+    def consume_result(self, test, rtt, code, stamp, done):
+        '''
+        Add a result to the history, metrics, journal and event log and
+        push it to the stream, run on the consumer thread. done is the
+        (monotonic) time the result arrived
+        '''
+        history = self.history.get(test.pos)
+        if history is not None:
+            if test.packets:
+                for sent, packet_rtt, packet_code in test.packets:
+                    history.append(packet_rtt, packet_code, sent)
+            else:
+                history.append(rtt, code, stamp, phases=test.timings)
+        self.metrics.observe_result(test, rtt, done - test.scheduled if test.scheduled else None)
+        if self.journal:
+            self.journal.append(test, rtt, code, stamp)
+        event = self.events.observe(test, stamp)
+        if event is not None and self.broadcaster.listening:
+            self.broadcaster.publish('transition', json.dumps(event))
+        if self.broadcaster.listening:
+            self.broadcaster.publish('result', json.dumps(test.render()))
 
     def start(self):
         '''
-        Starts Polling by initialising the CherryPy background task and the
-        tester Class and
+        Starts Polling by initialising the tester Class which schedules
+        each test at its own interval on its event loop thread.
+        With shards configured the tests are split across worker processes
         '''
-        self.tester = OmniPingTester(interval=self.setup.config['interval'])
-        actual_interval = self.tester.interval - self.tester.timeout
-        self.bgtask = BackgroundTask(actual_interval, self.testerCall, bus=cherrypy.engine)
-        self.bgtask.start()
+        tester_kwargs = {}
+        tester_kwargs['http_pool_size'] = self.setup.config['http_pool_size']
+        tester_kwargs['http_idle_timeout'] = self.setup.config['http_idle_timeout']
+        tester_kwargs['dns_ttl'] = self.setup.config['dns_ttl']
+        tester_kwargs['dns_negative_ttl'] = self.setup.config['dns_negative_ttl']
+        tester_kwargs['dispatch'] = self.setup.config['dispatch']
+        tester_kwargs['dispatch_seed'] = self.setup.config['dispatch_seed']
+        tester_kwargs['max_concurrency'] = self.setup.config['max_concurrency']
+        tester_kwargs['subnet_rate'] = self.setup.config['subnet_rate']
+        tester_kwargs['timeouts'] = self.setup.config['timeouts']
+        tester_kwargs['timeout_floor'] = self.setup.config['timeout_floor']
+        tester_kwargs['timeout_ceiling'] = self.setup.config['timeout_ceiling']
+        if self.setup.config['shards'] > 1:
+            self.tester = OmniPingShardedTester(
+                            shards=self.setup.config['shards'],
+                            interval=self.setup.config['interval'],
+                            options=list(self.setup.test_options),
+                            **tester_kwargs
+                            )
+        else:
+            self.tester = OmniPingTester(
+                            interval=self.setup.config['interval'],
+                            http_workers=self.setup.config['http_workers'],
+                            log=cherrypy.log,
+                            **tester_kwargs
+                            )
+        self.nonce = os.urandom(4).hex()
+        self.tester.start(self.report, on_round=self.testerCall, on_result=self.record_result)
         self.running = True
 
-    def stop(self):
+    def stop(self, wait=False):
         '''
-        Stops Polling by deleting the CherryPy background task
-        and the tester. just to keep things clean (hopefully)
+        Stops Polling by stopping and deleting the tester.
+        The tester is shut down on its own thread so the request
+        doesn't wait for outstanding tests to be cancelled
         '''
-        if self.bgtask:
-            self.bgtask.cancel()
-        self.bgtask = False
-        self.tester = False
+        tester, self.tester = self.tester, False
         self.running = False
+        if not tester:
+            return
+        if wait:
+            self.shutdown(tester)
+        else:
+            threading.Thread(target=self.shutdown, args=(tester,),
+                             name='omniping-stop', daemon=True).start()
+
+    def shutdown(self, tester):
+        '''
+        Stop a tester and flush the journal
+        '''
+        tester.stop()
+        self.consumer.wait()
+        if self.journal:
+            self.journal.flush()
+
+    def make_state(self, test, pos):
+        '''
+        A new test state along with its history and metrics
+        '''
+        state = OmniPingTestState(test, pos, self.setup.config['interval'], self.setup.test_options)
+        self.history[pos] = self.make_history()
+        self.metrics.add_test(state)
+        return state
+
+    def make_history(self):
+        '''
+        An empty history, with its rollups, for a test
+        '''
+        return OmniPingHistory(self.setup.config['history_size'], self.setup.config['rollup_sizes'])
+
+    def apply_changes(self):
+        '''
+        Bring the report into line with the setup's tests without resetting it.
+        Unchanged tests keep their state, counters and history, modified tests
+        keep their counters and history, added tests start straight away and
+        removed tests are cancelled. Tests are matched by the setup's keys
+        '''
+        changes = self.setup.take_changes()
+        interval = self.setup.config['interval']
+        tests = []
+        states = {}
+        scheduled = []
+        for key, test in zip(self.setup.keys, self.setup.config['tests']):
+            if not test['active']:
+                continue
+            old = self.states.get(key)
+            if old is None:
+                state = self.make_state(test, self.next_pos)
+                self.next_pos += 1
+                scheduled.append(state)
+            else:
+                state = OmniPingTestState(test, old.pos, interval, self.setup.test_options)
+                if state.config() == old.config():
+                    state = old
+                else:
+                    state.carry_over(old)
+                    self.metrics.relabel(state)
+                    scheduled.append(state)
+            tests.append(state)
+            states[key] = state
+
+        removed = [state.pos for key, state in self.states.items() if key not in states]
+        with self.render_lock:
+            for pos in removed:
+                self.history.pop(pos, None)
+                self.events.remove(pos)
+                self.metrics.tests.pop(pos, None)
+                self.rendered_tests.pop(pos, None)
+            self.states = states
+            self.report['tests'] = tests
+            self.generation += 1
+        if self.journal:
+            self.journal.assign(states)
+        if self.tester:
+            self.tester.update(scheduled, removed, interval)
+        cherrypy.log('[II] Test changes applied: {} added, {} removed, {} modified'.format(
+                len(changes['added']), len(changes['removed']), len(changes['modified'])))
+
+    def clear_counters(self):
+        '''
+        Zero every test's counters and history in place, the tests
+        carry on running
+        '''
+        with self.render_lock:
+            for test in self.report['tests']:
+                test.clear()
+                self.history[test.pos] = self.make_history()
+                self.metrics.add_test(test)
+            self.events.clear()
+            self.report['count'] = 0
+            self.report['time'] = False
+            self.report['duration'] = 0
+            self.report['started'] = datetime.now() if self.running else False
+            self.generation += 1
+            self.rendered_tests = {}
+
+    def replay_window(self):
+        '''
+        Seconds of results the history and rollups can hold at most,
+        so older journalled results only need counting
+        '''
+        config = self.setup.config
+        spans = [seconds * size
+                 for (_, seconds), size in zip(ROLLUP_TIERS, config['rollup_sizes'])]
+        intervals = [test.interval for test in self.report['tests']] or [config['interval']]
+        spans.append(config['history_size'] * max(intervals))
+        return max(spans)
+
+    def restore(self):
+        '''
+        Rebuild the report's counters and history from the journal,
+        queued to the consumer thread so it doesn't hold up start up
+        '''
+        if not self.journal:
+            return
+        try:
+            replayed = self.journal.replay(self.report['tests'], self.history, self.events,
+                                           since=time.time() - self.replay_window())
+        except OSError as e:
+            cherrypy.log(f'[EE] Unable to read the journal - {e}')
+            return
+        if replayed:
+            self.generation += 1
+            cherrypy.log(f'[II] Restored {replayed} results from the journal')
 
     def make_initial_report(self):
         '''
         Construct the report dictionary prior to tests running.
+        A new report invalidates any cached renders
         '''
-        def make_test_dictionary(test, pos):
-            test_dict = {}
-            test_dict['host'] = test['host']
-            test_dict['desc'] = test['desc']
-            test_dict['test'] = test['test'].upper()
-            test_dict['good'] = False
-            test_dict['last_stat'] = '--'
-            test_dict['status'] = '--'
-            test_dict['rtt'] = '--'
-            test_dict['total'] = 0
-            test_dict['total_successes'] = 0
-            test_dict['success_percent'] = "0.00 %"
-            test_dict['last_good'] = '--'
-            test_dict['last_bad'] = '--'
-            test_dict['last_bad_status'] = '--'
-            test_dict['pos'] = pos
-            return test_dict
-
+        self.generation += 1
+        self.rendered_tests = {}
         report = {}
         report['started'] = False
         report['time'] = False
         report['count'] = 0
         report['duration'] = 0
-        report['tests'] = [False]
-        pos = 0
-        for test in self.setup.config['tests']:
+        report['tests'] = []
+        self.history = {}
+        self.events.clear()
+        self.states = {}
+        self.metrics.clear()
+        for key, test in zip(self.setup.keys, self.setup.config['tests']):
             if test['active']:
-                report['tests'].append(make_test_dictionary(test, pos))
-                pos += 1
+                pos = len(report['tests'])
+                self.states[key] = self.make_state(test, pos)
+                report['tests'].append(self.states[key])
+        self.next_pos = len(report['tests'])
+        if self.journal:
+            self.journal.assign(self.states)
 
         return report
 
@@ -184,7 +464,8 @@ class OmniPingTestEng():
         '''
         make sure all elements of the report dictionary are JSON serializable.
         prior to putting in the response.
-        Also does some formating/ordering
+        Also does some formating, the test states are rendered here
+        but only those that have changed since they were last rendered
         '''
         response = self.report.copy()
         if response['duration'] != 0:
@@ -194,10 +475,13 @@ class OmniPingTestEng():
         if isinstance(response['time'], datetime):
             response['time'] = response['time'].strftime('%a %d %b %Y %I:%M:%S %p')
 
-        new_tests = [{}] * (len(response['tests']) - 1)
+        offset = time.time() - time.monotonic()
+        tests = []
         for test in response['tests']:
-            if not test:
-                continue
-            new_tests[test['pos']] = test
-        response['tests'] = new_tests
+            cached = self.rendered_tests.get(test.pos)
+            if cached is None or cached[0] != test.version:
+                cached = (test.version, response['count'], test.render(offset))
+                self.rendered_tests[test.pos] = cached
+            tests.append(cached[2])
+        response['tests'] = tests
         return response
@@ -0,0 +1,158 @@
+'''
+Returns the recent history and windowed statistics of the tests
+i.e. http://<omniping>/omniping/history?window=300&pos=0&samples=1
+and their results between two times from the raw samples or rollups
+i.e. http://<omniping>/omniping/range?pos=0&start=2024-06-01T02:00&end=2024-06-01T02:30
+'''
+from datetime import datetime
+import time
+
+import cherrypy
+
+
+class OmniPingTestHist():
+    '''
+    Reads the per test history ring buffers kept by the test engine
+    '''
+
+    exposed = True
+
+    def __init__(self, test_engine):
+        self.test_engine = test_engine
+
+    @cherrypy.tools.json_out()
+    def GET(self, pos=None, window=300, samples=False, journal=False):
+        '''
+        Handle Get Requests for history
+         - pos: a single test (default all)
+         - window: seconds of history to aggregate (0 for all of it)
+         - samples: include the raw samples
+         - journal: read the journal rather than the in memory history,
+           slower but covers much longer windows
+        '''
+        try:
+            window = float(window) or None
+            if pos is not None:
+                pos = int(pos)
+        except ValueError:
+            mess = 'Invalid window or test position'
+            cherrypy.log(f'[EE] {mess}')
+            raise cherrypy.HTTPError(400, f'{mess}')
+
+        history = self.test_engine.history
+        if pos is not None and pos not in history:
+            mess = f'No history for test {pos}'
+            cherrypy.log(f'[EE] {mess}')
+            raise cherrypy.HTTPError(404, f'{mess}')
+
+        source = history
+        if journal and journal not in ('0', 'false'):
+            source = self.test_engine.journal
+            if not source:
+                mess = 'The journal is disabled'
+                cherrypy.log(f'[EE] {mess}')
+                raise cherrypy.HTTPError(404, f'{mess}')
+
+        tests = []
+        for test in self.test_engine.report['tests']:
+            if pos is not None and test.pos != pos:
+                continue
+            test_hist = {}
+            test_hist['pos'] = test.pos
+            test_hist['host'] = test.host
+            test_hist['desc'] = test.desc
+            test_hist['test'] = test.test
+            if source is history:
+                test_hist['stats'] = history[test.pos].stats(window)
+            else:
+                test_hist['stats'] = source.stats(test.pos, window)
+            if samples and samples not in ('0', 'false'):
+                if source is history:
+                    test_hist['samples'] = history[test.pos].samples(window)
+                else:
+                    test_hist['samples'] = source.samples(test.pos, window)
+            tests.append(test_hist)
+
+        response = {}
+        response['window'] = window
+        response['tests'] = sorted(tests, key=lambda test: test['pos'])
+        response['message'] = f'Retrieved history ({len(tests)} tests)'
+        return response
+
+
+class OmniPingTestRange():
+    '''
+    Reads a time range of the tests' history, from the raw samples
+    or whichever rollup tier suits the range
+    '''
+
+    exposed = True
+
+    def __init__(self, test_engine):
+        self.test_engine = test_engine
+
+    @staticmethod
+    def parse_time(value, now):
+        '''
+        A wall clock time from epoch seconds, seconds before now
+        (zero or negative) or an ISO 8601 date and time
+        '''
+        try:
+            stamp = float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+        return now + stamp if stamp <= 0 else stamp
+
+    @cherrypy.tools.json_out()
+    def GET(self, pos=None, start=None, end=None, tier='auto', points=1000):
+        '''
+        Handle Get Requests for a range
+         - pos: a single test (default all)
+         - start, end: the range, epoch seconds, ISO 8601 or seconds
+           before now if zero or negative (default the last hour)
+         - tier: raw, 1m, 5m, 1h or auto (default) for the finest one
+           holding the range in no more than "points" points
+        '''
+        now = time.time()
+        try:
+            end = now if end is None else self.parse_time(end, now)
+            start = end - 3600 if start is None else self.parse_time(start, now)
+            points = max(1, int(points))
+            if pos is not None:
+                pos = int(pos)
+        except ValueError:
+            mess = 'Invalid range, test position or point count'
+            cherrypy.log(f'[EE] {mess}')
+            raise cherrypy.HTTPError(400, f'{mess}')
+        if start >= end:
+            mess = 'The range must start before it ends'
+            cherrypy.log(f'[EE] {mess}')
+            raise cherrypy.HTTPError(400, f'{mess}')
+
+        history = self.test_engine.history
+        if pos is not None and pos not in history:
+            mess = f'No history for test {pos}'
+            cherrypy.log(f'[EE] {mess}')
+            raise cherrypy.HTTPError(404, f'{mess}')
+
+        tests = []
+        for test in self.test_engine.report['tests']:
+            if test.pos not in history or (pos is not None and test.pos != pos):
+                continue
+            test_range = history[test.pos].range(start, end, tier, points)
+            if test_range is None:
+                mess = f'Unknown or disabled tier {tier}'
+                cherrypy.log(f'[EE] {mess}')
+                raise cherrypy.HTTPError(400, f'{mess}')
+            test_range['pos'] = test.pos
+            test_range['host'] = test.host
+            test_range['desc'] = test.desc
+            test_range['test'] = test.test
+            tests.append(test_range)
+
+        response = {}
+        response['start'] = start
+        response['end'] = end
+        response['tests'] = sorted(tests, key=lambda test: test['pos'])
+        response['message'] = f'Retrieved range ({len(tests)} tests)'
+        return response
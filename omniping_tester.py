@@ -6,8 +6,19 @@ import time
 import socket
 import re
 import asyncio
+from urllib.parse import urlsplit
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeout
 import http3
-import cherrypy
+
+from omniping_dns import OmniPingResolver
+from omniping_history import HTTP_PHASES, burst_stats, status_code
+from omniping_http import OmniPingHttpPool
+from omniping_icmp import OmniPingIcmp, OmniPingIcmpUnavailable
+from omniping_loop import OmniPingLoop, log_stderr
+from omniping_pacing import OmniPingPacer
+from omniping_scheduler import OmniPingScheduler
+from omniping_timeouts import OmniPingTimeouts
+from omniping_workers import OmniPingHttpWorkers
 
 
 class OmniPingTester():
@@ -28,177 +39,556 @@ class OmniPingTester():
     stat_dict[403] = 'Forbidden (403)'
     stat_dict[404] = 'Not Found (404)'
 
-    def __init__(self, interval=2):
+    def __init__(self, interval=2, http_pool_size=4, http_idle_timeout=60.0,
+                 dns_ttl=60.0, dns_negative_ttl=10.0, dispatch='burst', dispatch_seed=None,
+                 max_concurrency=0, subnet_rate=0.0, http_workers=0,
+                 timeouts='fixed', timeout_floor=0.1, timeout_ceiling=2.0, log=log_stderr):
         '''
         time out and Interval values are calculated on instantiation
-        based on desired interval. The interval the CherryPy
-        Background process uses is calculated by refrenceing these
+        based on desired interval. Tests with their own interval
+        get their own timeout, see test_timeout.
+        With http_workers the HTTP(S) requests are made by that many
+        worker processes rather than on the tester's own loop.
+        timeouts='adaptive' times each test out according to its
+        own RTT, see OmniPingTimeouts. log is called with the tester's
+        messages, the web server passes cherrypy.log
         '''
-        self.timeout = 2.0
         self.interval = interval
-        if self.interval <= 4.0:
-            self.timeout = self.interval / 2
-        self.loop = False
+        self.log = log
+        self.resolver = OmniPingResolver(ttl=dns_ttl, negative_ttl=dns_negative_ttl)
+        self.http_pool = OmniPingHttpPool(
+                            size=http_pool_size,
+                            idle_timeout=http_idle_timeout,
+                            resolver=self.resolver
+                            )
+        self.workers = None
+        if http_workers:
+            self.workers = OmniPingHttpWorkers(
+                                workers=http_workers,
+                                http_pool_size=http_pool_size,
+                                http_idle_timeout=http_idle_timeout,
+                                dns_ttl=dns_ttl,
+                                dns_negative_ttl=dns_negative_ttl,
+                                )
+        self.pacer = OmniPingPacer(
+                        mode=dispatch,
+                        seed=dispatch_seed,
+                        max_concurrency=max_concurrency,
+                        subnet_rate=subnet_rate,
+                        )
+        self.timeouts = OmniPingTimeouts(
+                            mode=timeouts,
+                            floor=timeout_floor,
+                            ceiling=timeout_ceiling,
+                            )
+        self.timeout = self.timeout_for(interval)
+        self.loop = OmniPingLoop()
+        self.scheduler = False
+        self.report = False
+        self.tests = {}
+        self.on_round = None
+        self.on_result = None
+        self.icmp = False
+        self.native_icmp = True
+        self.inflight = 0
+        self.subprocesses = 0
+        self.loop_lag = 0.0
+
+    @staticmethod
+    def timeout_for(interval):
+        '''
+        Half the interval up to a maximum of 2 seconds
+        '''
+        if interval <= 4.0:
+            return interval / 2
+        return 2.0
+
+    def test_timeout(self, test_info):
+        '''
+        the timeout to use for a given test, noted on the test
+        '''
+        test_info.timeout = self.timeouts.timeout(test_info, self.timeout_for(test_info.interval))
+        return test_info.timeout
+
+    def start(self, report=False, on_round=None, on_result=None):
+        '''
+        Start the persistent event loop thread and the
+        resources that live on it. If a report is passed its
+        tests are scheduled, each at its own interval.
+        on_result is called with (test, rtt_ms, code) after every test
+        '''
+        self.on_result = on_result
+        self.loop.start()
+        if self.workers:
+            self.workers.start(self.loop)
+        self.icmp = OmniPingIcmp(loop=self.loop.loop)
+        if report:
+            self.loop.run(self.schedule(report, on_round))
+
+    def stop(self):
+        '''
+        Cancel anything outstanding, release the sockets
+        and stop the event loop thread (and the HTTP workers)
+        '''
+        self.loop.stop(cleanup=self.close)
+        if self.workers:
+            self.workers.stop()
+
+    async def close(self):
+        '''
+        Clean up run on the loop itself prior to it stopping
+        '''
+        if self.scheduler:
+            self.scheduler.stop()
+        if self.icmp:
+            self.icmp.close()
+        if self.workers:
+            self.workers.close()
+        await self.http_pool.close()
+
+    async def schedule(self, report, on_round=None):
+        '''
+        Hand every test to the scheduler along with a job ticking
+        over the report's round count at the engine's interval
+        '''
+        self.report = report
+        self.on_round = on_round
+        if not report['started']:
+            report['started'] = datetime.now()
+        self.scheduler = OmniPingScheduler(self.loop.loop)
+        self.tests = {}
+        offsets = self.pacer.offsets(report['tests'])
+        for test in report['tests']:
+            self.tests[test.pos] = test
+            self.scheduler.add(test.pos, test.interval, self.run_test, delay=offsets[test.pos])
+        self.scheduler.add('round', self.interval, self.round_tick, delay=self.interval)
+        self.scheduler.add('loop_lag', 1.0, self.measure_loop_lag)
+        self.scheduler.add(
+                    'http_pool',
+                    self.http_pool.idle_timeout,
+                    lambda _: self.http_pool.evict_idle(),
+                    delay=self.http_pool.idle_timeout
+                    )
+        self.scheduler.start()
+
+    def update(self, added, removed, interval=None):
+        '''
+        Thread safe live reconfiguration: schedule the added (or modified)
+        tests, cancel the removed ones (by position) and change the
+        round interval
+        '''
+        if self.loop.running:
+            self.loop.call(self.apply_update, added, removed, interval)
+
+    def apply_update(self, added, removed, interval=None):
+        '''
+        Reconfigure the scheduler, run on the loop
+        '''
+        if not self.scheduler:
+            return
+        for pos in removed:
+            self.tests.pop(pos, None)
+            self.scheduler.remove(pos)
+        offsets = self.pacer.offsets(added)
+        for test in added:
+            self.tests[test.pos] = test
+            self.scheduler.add(test.pos, test.interval, self.run_test, delay=offsets[test.pos])
+        if interval and interval != self.interval:
+            self.interval = interval
+            self.timeout = self.timeout_for(interval)
+            self.scheduler.add('round', interval, self.round_tick, delay=interval)
+
+    def stats(self):
+        '''
+        Engine internals returned with the report
+        '''
+        stats = {}
+        stats['http_pool'] = (self.workers or self.http_pool).stats()
+        stats['dns'] = self.resolver.stats()
+        if self.scheduler:
+            jobs = list(self.scheduler.jobs.values())
+            stats['scheduler'] = {
+                'jobs': len(self.scheduler.jobs),
+                'max_lag': self.scheduler.max_lag,
+                'skipped': sum(job.skipped for job in jobs),
+                'loop_lag': self.loop_lag,
+            }
+        stats['probes'] = {
+            'inflight': self.inflight,
+            'subprocesses': self.subprocesses,
+            'icmp_sockets': len(self.icmp.sockets) if self.icmp else 0,
+        }
+        stats['pacing'] = self.pacer.stats()
+        stats['timeouts'] = self.timeouts.stats()
+        return stats
+
+    def measure_loop_lag(self, _):
+        '''
+        Time how long a callback waits to be run on the loop, called by the scheduler
+        '''
+        start = time.perf_counter()
+
+        def measured():
+            self.loop_lag = time.perf_counter() - start
+        self.loop.loop.call_soon(measured)
+
+    def round_tick(self, _):
+        '''
+        Update the report's round counters, called by the scheduler
+        '''
+        report = self.report
+        report['count'] += 1
+        report['time'] = datetime.now()
+        report['duration'] = report['time'] - report['started']
+        if self.on_round:
+            self.on_round()
+
+    def run_test(self, pos):
+        '''
+        Return the coroutine for a scheduled test, the loop's
+        clock is monotonic so the job's deadline is its scheduled time
+        '''
+        self.tests[pos].scheduled = self.scheduler.jobs[pos].due
+        self.tests[pos].sent = None
+        return self.test_func(self.tests[pos])
+
+    def test_func(self, test):
+        '''
+        pick the coroutine for a test type
+        '''
+        if test.test in ['ICMP', 'PING']:
+            return self.track(self.ping_tester(test))
+        if test.test == 'TCP':
+            return self.track(self.tcp_tester(test))
+        return self.track(self.http_tester(test))
+
+    async def track(self, probe):
+        '''
+        Count the tests in progress, holding them back
+        if the concurrency cap has been reached
+        '''
+        await self.pacer.acquire()
+        self.inflight += 1
+        try:
+            return await probe
+        finally:
+            self.inflight -= 1
+            self.pacer.release()
+
+    async def pace(self, test_info, address):
+        '''
+        Apply the destination subnet rate limit and note the actual send time
+        '''
+        await self.pacer.limit(address)
+        test_info.sent = time.monotonic()
 
     def run_once(self, input_report):
         '''
-        This Orchestrates the testing based on the passin report
-        It creates a new asyncio event loop each time as this
-        suffered less errors
+        Run every test in the report once on the loop, i.e. a one off
+        round rather than the scheduled operation. This just waits
+        (with a margin over the longest timeout and the pacing) for the round to
+        finish, which it does as soon as the last test is answered or times out
         '''
+        if not self.loop.running:
+            return input_report
+        timeout = self.timeout_for(1000) * 4
+        if self.pacer.mode != 'burst':
+            timeout += self.interval
+        try:
+            return self.loop.run(self.run_round(input_report), timeout)
+        except FutureTimeout:
+            self.log('[EE] Test round overran, cancelling outstanding tests')
+            self.loop.cancel()
+        except CancelledError:
+            self.log('[II] Test round cancelled')
+        except OSError as e:
+            self.log(f'[EE] {e}')
+        return input_report
 
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
+    async def run_round(self, input_report):
+        '''
+        Run every test in the report once on the loop
+        '''
         if not input_report['started']:
             input_report['started'] = datetime.now()
 
         input_report['count'] += 1
-        self.loop.create_task(self.dummy_fail())
-        for test in input_report['tests']:
-            if not test:
-                continue
-            if test['test'] in ['ICMP', 'PING']:
-                test_func = self.ping_tester
-            elif test['test'] in ['HTTP', 'HTTPS']:
-                test_func = self.http_tester
-            self.loop.create_task(test_func(test))
+        offsets = self.pacer.offsets(input_report['tests'], self.interval)
+        start = time.monotonic()
+        await asyncio.gather(*[
+            self.delayed(test, start + offsets[test.pos]) for test in input_report['tests']
+        ])
+        input_report['time'] = datetime.now()
+        input_report['duration'] = input_report['time'] - input_report['started']
+        return input_report
 
-        try:
-            group = asyncio.gather(*asyncio.all_tasks(loop=self.loop))
-            results = self.loop.run_until_complete(group)
-            input_report['tests'] = results
-            input_report['time'] = datetime.now()
-            input_report['duration'] = input_report['time'] - input_report['started']
-            return input_report
-        except OSError as e:
-            cherrypy.log(f'[EE] {e}')
+    async def delayed(self, test, scheduled):
+        '''
+        Start a test at its scheduled (monotonic) time
+        '''
+        test.scheduled = scheduled
+        test.sent = None
+        if scheduled > time.monotonic():
+            await asyncio.sleep(scheduled - time.monotonic())
+        return await self.test_func(test)
 
-    async def dummy_fail(self):
+    async def resolve(self, test_info):
         '''
-        This is here to simulate a timed out test in order to
-        allow for consistent intervals between good (quick) tests and
-        failed (timedout) tests
+        Resolve the test's host through the shared cache (or every time
+        if the test has resolve=always) recording the time taken
         '''
-        await asyncio.sleep(self.timeout - 0.12)
-        return False
+        host = test_info.host
+        if test_info.test in ['HTTP', 'HTTPS', 'TCP']:
+            host = urlsplit(f'//{host}').hostname
+        fresh = test_info.options.get('resolve') == 'always'
+        _, address, test_info.dns = await self.resolver.resolve(host, fresh)
+        return address
 
     async def ping_tester(self, test_info):
         '''
         Method to test using PING
+        uses the native ICMP engine, falling back to the ping
+        command if no ICMP socket can be opened.
+        Tests with count=n send a burst of n pings spacing seconds apart
+        '''
+        if not self.native_icmp:
+            return await self.ping_cmd_tester(test_info)
+        test_info.begin()
+        count = test_info.options.get('count', 1)
+        size = test_info.options.get('size')
+        try:
+            address = await self.resolve(test_info)
+            await self.pace(test_info, address)
+            if count > 1:
+                status, results = await self.icmp.burst(
+                                        address,
+                                        count,
+                                        test_info.options.get('spacing', 0.2),
+                                        self.test_timeout(test_info),
+                                        size,
+                                        )
+                return self.finish_burst(test_info, status, results)
+            status, rtt = await self.icmp.ping(address, self.test_timeout(test_info), size)
+        except socket.gaierror:
+            return self.finish(test_info, 'Bad Address', False)
+        except OmniPingIcmpUnavailable as e:
+            self.log(f'[EE] {e} - falling back to the ping command')
+            self.native_icmp = False
+            test_info.status = test_info.last_stat
+            return await self.ping_cmd_tester(test_info)
+        except asyncio.CancelledError:
+            self.log('[II] Test cancelled')
+            return test_info
+        except OSError as e:
+            self.log(f'[EE] {test_info.host} - {e}')
+            return self.finish(test_info, 'Failed', False)
+
+        return self.finish(test_info, status, status == 'Good', rtt)
+
+    async def ping_cmd_tester(self, test_info):
+        '''
+        Method to test using the PING command
         uses Asyncio's subprocesses
         '''
+        test_info.begin()
+        rtt = None
+        count = test_info.options.get('count', 1)
+        spacing = test_info.options.get('spacing', 0.2)
+        args = f'-c {count} -W {round(self.test_timeout(test_info), 3)}'
+        if count > 1:
+            args += f' -i {spacing}'
+        if 'size' in test_info.options:
+            args += f' -s {test_info.options["size"]}'
+        self.subprocesses += 1
         try:
-            test_info['rtt'] = '--'
-            test_info['good'] = False
-            test_info['last_stat'] = test_info['status']
-            test_info['status'] = 'Incomplete'
+            sent = time.time()
             proc = await asyncio.create_subprocess_shell(
-                f'ping -c 1 -W {self.timeout} -n {test_info["host"]}',
+                f'ping {args} -n {test_info.host}',
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE)
             stdout, _ = await proc.communicate()
-            test_info['total'] += 1
-            if proc.returncode == 0:
-                test_info['total_successes'] += 1
-                test_info['last_good'] = datetime.now().strftime('%a %H:%M:%S')
-                test_info['good'] = True
-                test_info['status'] = 'Good'
-                rtt_line_re = r'[64]+\sbytes\sfrom\s[0-9\.:a-f]+:\sicmp_seq=1\sttl=[0-9]+\s' \
-                              r'time=([0-9\.]+)\sms'
-                if stdout:
-                    for line in stdout.decode().split('\n'):
-                        match = re.match(rtt_line_re, line)
-                        if match:
-                            test_info['rtt'] = f'{match.group(1)} ms'
-                            break
-            else:
-                test_info['status'] = 'Time Out'
-                test_info['last_bad'] = datetime.now().strftime('%a %H:%M:%S')
-                test_info['good'] = False
-                unreach_line_re = r'^From\s[0-9\.:a-f]+\sicmp_seq=1\s([0-9a-zA-Z\ ]+)$'
-                if stdout:
-                    for line in stdout.decode().split('\n'):
-                        match = re.match(unreach_line_re, line)
-                        if match:
-                            test_info['status'] = 'Unreachable'
-                            break
-                test_info['last_bad_status'] = test_info['status']
         except asyncio.CancelledError:
-            print('Cancelled !!')
-        test_info['success_percent'] = sucPer(
-                                            test_info['total'],
-                                            test_info['total_successes']
-                                            )
-        return test_info
+            self.log('[II] Test cancelled')
+            return test_info
+        finally:
+            self.subprocesses -= 1
+
+        if count > 1:
+            status, results = self.parse_ping_burst(stdout, count, spacing, sent)
+            return self.finish_burst(test_info, status, results)
+
+        if proc.returncode == 0:
+            status = 'Good'
+            rtt_line_re = r'[0-9]+\sbytes\sfrom\s[0-9\.:a-f]+:\sicmp_seq=1\sttl=[0-9]+\s' \
+                          r'time=([0-9\.]+)\sms'
+            if stdout:
+                for line in stdout.decode().split('\n'):
+                    match = re.match(rtt_line_re, line)
+                    if match:
+                        rtt = float(match.group(1))
+                        break
+        else:
+            status = 'Time Out'
+            unreach_line_re = r'^From\s[0-9\.:a-f]+\sicmp_seq=1\s([0-9a-zA-Z\ ]+)$'
+            if stdout:
+                for line in stdout.decode().split('\n'):
+                    match = re.match(unreach_line_re, line)
+                    if match:
+                        status = 'Unreachable'
+                        break
+        return self.finish(test_info, status, status == 'Good', rtt)
+
+    @staticmethod
+    def parse_ping_burst(stdout, count, spacing, sent):
+        '''
+        Per packet results of a ping -c n run in the same form as
+        the ICMP engine's burst(), send times are estimated from the spacing
+        '''
+        statuses = ['Time Out'] * count
+        rtts = [None] * count
+        reply_re = r'.*icmp_seq=([0-9]+)\sttl=[0-9]+\stime=([0-9\.]+)\sms'
+        unreach_re = r'^From\s[0-9\.:a-f]+\sicmp_seq=([0-9]+)\s'
+        for line in (stdout or b'').decode().split('\n'):
+            match = re.match(reply_re, line)
+            if match and 0 < int(match.group(1)) <= count:
+                statuses[int(match.group(1)) - 1] = 'Good'
+                rtts[int(match.group(1)) - 1] = float(match.group(2))
+                continue
+            match = re.match(unreach_re, line)
+            if match and 0 < int(match.group(1)) <= count:
+                statuses[int(match.group(1)) - 1] = 'Unreachable'
+        status = 'Good' if 'Good' in statuses else statuses[0]
+        results = [(sent + num * spacing, statuses[num], rtts[num]) for num in range(count)]
+        return status, results
+
+    async def tcp_tester(self, test_info):
+        '''
+        Method to test a TCP port, times the connection being
+        established and closes it straight away
+        '''
+        test_info.begin()
+        good = False
+        rtt = None
+        try:
+            address = await self.resolve(test_info)
+            await self.pace(test_info, address)
+            port = urlsplit(f'//{test_info.host}').port
+            timeout = self.test_timeout(test_info)
+            start = time.perf_counter()
+            _, writer = await asyncio.wait_for(
+                                asyncio.open_connection(address, port),
+                                timeout
+                                )
+            rtt = (time.perf_counter() - start) * 1000
+            writer.close()
+            try:
+                # The connection is timed, a slow or failed close
+                # shouldn't fail the test, just not leave it open
+                await asyncio.wait_for(writer.wait_closed(), timeout)
+            except (asyncio.TimeoutError, OSError):
+                pass
+            good = True
+            status = 'Good'
+
+        except asyncio.TimeoutError:
+            status = 'Time Out'
+
+        except socket.gaierror:
+            status = 'Bad Address'
+
+        except ConnectionRefusedError:
+            status = 'Refused'
+
+        except OSError:
+            status = 'Unreachable'
+
+        except asyncio.CancelledError:
+            self.log('[II] Test cancelled')
+            return test_info
+
+        return self.finish(test_info, status, good, rtt)
 
     async def http_tester(self, test_info):
         '''
         Method to test using HTTP or HTTPS using HTTP3 Library
-        HTTP3 has async capabilities
+        HTTP3 has async capabilities. The RTT is the whole request,
+        the time taken by each phase is kept in the test's timings
         '''
-        test_info['last_stat'] = test_info['status']
-        test_info['rtt'] = '--'
-        test_info['good'] = False
-        test_info['status'] = 'Incomplete'
+        test_info.begin()
+        good = False
+        rtt = None
+        code = None
+        timings = {}
         try:
-            client = http3.AsyncClient()
-            start = time.time()
-            if test_info['test'] == 'HTTP':
-                url = f'http://{test_info["host"]}'
-                resp = await client.get(url, timeout=self.timeout)
-            if test_info['test'] == 'HTTPS':
-                url = f'https://{test_info["host"]}'
-                resp = await client.get(url, timeout=self.timeout, verify=False)
-            test_info['good'] = True
-            test_info['status'] = self.stat_dict.get(resp.status_code, 'Unknown')
+            address = await self.resolve(test_info)
+            await self.pace(test_info, address)
+            url = f'{test_info.test.lower()}://{test_info.host}'
+            resp = await (self.workers or self.http_pool).get(
+                                url,
+                                timeout=self.test_timeout(test_info),
+                                reuse=test_info.options.get('reuse', 'fresh'),
+                                fetch=test_info.options.get('fetch', 'body'),
+                                timings=timings,
+                                resume=test_info.options.get('tls', 'resume') != 'full'
+                                )
+            good = True
+            status = self.stat_dict.get(resp.status_code, 'Unknown')
+            code = resp.status_code
+            rtt = timings['total']
 
         except http3.exceptions.RedirectLoop:
-            test_info['good'] = False
-            test_info['status'] = 'Redirect Loop'
+            status = 'Redirect Loop'
 
         except http3.exceptions.ConnectTimeout:
-            test_info['good'] = False
-            test_info['status'] = 'Time Out'
+            status = 'Time Out'
 
         except http3.exceptions.ReadTimeout:
-            test_info['good'] = False
-            test_info['status'] = 'Time Out'
+            status = 'Time Out'
 
         except socket.gaierror:
-            test_info['good'] = False
-            test_info['status'] = 'Bad Address'
+            status = 'Bad Address'
 
         except OSError:
-            test_info['good'] = False
-            test_info['status'] = 'Unreachable'
+            status = 'Unreachable'
 
         except asyncio.CancelledError:
-            print('Cancelled !!')
-
-        test_info['total'] += 1
+            self.log('[II] Test cancelled')
+            return test_info
 
-        if not test_info['good']:
-            test_info['last_bad'] = datetime.now().strftime('%a %H:%M:%S')
-            test_info['last_bad_status'] = test_info['status']
-        else:
-            test_info['last_good'] = datetime.now().strftime('%a %H:%M:%S')
-            test_info['total_successes'] += 1
-            test_info['rtt'] = '{:.2f} ms'.format((time.time() - start) * 1000)
-
-        test_info['success_percent'] = sucPer(
-                                            test_info['total'],
-                                            test_info['total_successes']
-                                            )
-        return test_info
+        timings['dns'] = test_info.dns
+        test_info.timings = {
+            phase: None if timings.get(phase) is None else round(timings[phase], 3)
+            for phase in HTTP_PHASES
+        }
+        return self.finish(test_info, status, good, rtt, code)
 
+    def finish_burst(self, test_info, status, results):
+        '''
+        End of a burst of pings, the test's RTT is the burst's average
+        and the packets are kept so each one is added to the history
+        '''
+        rtts = [rtt for _, _, rtt in results]
+        test_info.burst = burst_stats(rtts)
+        test_info.packets = [
+            (sent, rtt, status_code(packet_status)) for sent, packet_status, rtt in results
+        ]
+        return self.finish(test_info, status, status == 'Good', test_info.burst['avg'], rtts=rtts)
 
-def sucPer(total_trys, successes):
-    '''
-    This is just a function to work out pecentage success
-    and cope with the Zero division
-    '''
-    try:
-        totp = "{0:.2f} %".format(successes/total_trys * 100)
-    except ZeroDivisionError:
-        totp = "0.00 %"
-    return totp
+    def finish(self, test_info, status, good, rtt=None, code=None, rtts=None):
+        '''
+        Common end of every test, records the result on the test's state,
+        updates the test's RTT estimate (from each ping of a burst, rtts)
+        and passes the numeric result on to the on_result callback
+        '''
+        self.timeouts.observe(
+                test_info,
+                status,
+                [rtt if good else None] if rtts is None else rtts,
+                self.timeout_for(test_info.interval),
+                )
+        test_info.record(status, good, rtt)
+        if self.on_result:
+            if code is None:
+                code = status_code(status)
+            self.on_result(test_info, rtt if good else None, code)
+        return test_info
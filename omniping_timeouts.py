@@ -0,0 +1,130 @@
+'''
+Per test timeouts that adapt to each target's observed RTT.
+Each test keeps a smoothed RTT and RTT variation worked out the way
+TCP works out its retransmission timeout (RFC 6298), the timeout is
+the smoothed RTT plus four times the variation, kept between a floor
+and a ceiling. A target answering in well under a millisecond is then
+declared down after the floor rather than after half the interval
+'''
+
+# RFC 6298's gains for the smoothed RTT and RTT variation and the
+# multiple of the variation added to the smoothed RTT
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+# Smallest variation term (seconds), so a target that always answers
+# in exactly the same time still gets some slack
+GRANULARITY = 0.001
+
+
+class OmniPingRto():
+    '''
+    RTT estimate of a single test, in seconds. Each time out doubles
+    the timeout (as TCP backs off) until an answer comes back, so a
+    path that has become much slower is picked up again rather than
+    timing out every time
+    '''
+
+    __slots__ = ('srtt', 'rttvar', 'backoff')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 0
+
+    def sample(self, rtt):
+        '''
+        Fold a measured RTT into the estimate
+        '''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.backoff = 0
+
+    def expired(self):
+        '''
+        The test timed out
+        '''
+        self.backoff = min(self.backoff + 1, 16)
+
+    def rto(self):
+        '''
+        The timeout before any floor or ceiling, None until the first answer
+        '''
+        if self.srtt is None:
+            return None
+        return (self.srtt + max(GRANULARITY, K * self.rttvar)) * 2 ** self.backoff
+
+
+class OmniPingTimeouts():
+    '''
+    Works out the timeout for each test:
+     - fixed: the tester's timeout for the test's interval (the original behaviour)
+     - adaptive: the test's own RTO between floor and ceiling, the ceiling
+       never being more than the fixed timeout. Tests that haven't
+       been answered yet get the ceiling
+    and counts how many tests timed out and how many failed outright
+    (unreachable, refused, bad address...) so the two can be told apart
+    '''
+
+    modes = ['fixed', 'adaptive']
+
+    def __init__(self, mode='fixed', floor=0.1, ceiling=2.0):
+        self.mode = mode if mode in self.modes else 'fixed'
+        self.floor = float(floor)
+        self.ceiling = max(float(ceiling), self.floor)
+        self.timed_out = 0
+        self.failed = 0
+        self.answered = 0
+        self.saved = 0.0
+
+    def timeout(self, test, fixed):
+        '''
+        The timeout (seconds) for the test's next probe, fixed is
+        what the test would get without adaptive timeouts
+        '''
+        if self.mode == 'fixed':
+            return fixed
+        ceiling = min(self.ceiling, fixed)
+        rto = test.rto.rto() if test.rto is not None else None
+        if rto is None:
+            return ceiling
+        return min(max(rto, self.floor), ceiling)
+
+    def observe(self, test, status, rtts, fixed):
+        '''
+        Update the test's estimate with a result, rtts are the ms RTTs
+        of its answers (several for a burst of pings)
+        '''
+        if test.rto is None:
+            test.rto = OmniPingRto()
+        answers = [rtt for rtt in rtts if rtt is not None]
+        for rtt in answers:
+            test.rto.sample(rtt / 1000)
+        if answers:
+            self.answered += 1
+        elif status == 'Time Out':
+            test.rto.expired()
+            self.timed_out += 1
+            if test.timeout is not None:
+                self.saved += max(fixed - test.timeout, 0)
+        else:
+            self.failed += 1
+
+    def stats(self):
+        '''
+        Settings and counts returned with the engine stats, saved is
+        the waiting (seconds) adaptive timeouts cut off the time outs
+        '''
+        return {
+            'mode': self.mode,
+            'floor': self.floor,
+            'ceiling': self.ceiling,
+            'answered': self.answered,
+            'timed_out': self.timed_out,
+            'failed': self.failed,
+            'saved': round(self.saved, 3),
+        }
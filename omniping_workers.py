@@ -0,0 +1,282 @@
+'''
+Worker processes for the HTTP and HTTPS tests.
+Each worker runs its own event loop with its own HTTP pool and resolver
+cache, so TLS handshakes and response parsing don't hold up (or compete
+for the interpreter lock with) the tester's loop which times the ICMP
+probes. Tests are still started, paced and recorded on the tester's loop,
+only the request itself is handed over and its status code, phase
+timings or exception are sent back
+'''
+import asyncio
+import itertools
+import multiprocessing
+import os
+import time
+
+from omniping_dns import OmniPingResolver
+from omniping_http import OmniPingHttpPool, handshake_averages
+
+# Workers send their pool stats this often (seconds)
+STATS_INTERVAL = 1.0
+# Workers run at a lower priority so the tester's process is scheduled as
+# soon as an ICMP reply arrives, even with fewer cores than busy processes
+WORKER_NICE = 10
+
+
+class OmniPingWorkerResponse():
+    '''
+    What the tester needs of a response made in a worker
+    '''
+
+    __slots__ = ('status_code',)
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def worker_main(conn, pool_kwargs, resolver_kwargs):
+    '''
+    Entry point of a worker process. Receives ('get', id, request args),
+    ('cancel', id) and ('stats',) messages, sends ('result', id, status code,
+    timings), ('error', id, exception class, args, timings) and ('stats', {...})
+    until told to stop or the pipe closes. The stats include the worker's
+    own CPU time, which the tester's process can't see
+    '''
+    try:
+        os.nice(WORKER_NICE)
+    except (AttributeError, OSError):
+        pass
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pool = OmniPingHttpPool(resolver=OmniPingResolver(**resolver_kwargs), **pool_kwargs)
+    tasks = {}
+
+    async def request(ident, args):
+        url, timeout, reuse, fetch, resume = args
+        timings = {}
+        try:
+            resp = await pool.get(url, timeout, reuse, fetch, timings, resume)
+            conn.send(('result', ident, resp.status_code, timings))
+        except asyncio.CancelledError:
+            pass
+        except Exception as err:
+            try:
+                conn.send(('error', ident, type(err), err.args, timings))
+            except Exception:
+                conn.send(('error', ident, OSError, (str(err),), timings))
+        finally:
+            tasks.pop(ident, None)
+
+    def receive():
+        try:
+            while conn.poll():
+                message = conn.recv()
+                if message[0] == 'get':
+                    tasks[message[1]] = loop.create_task(request(message[1], message[2]))
+                elif message[0] == 'cancel' and message[1] in tasks:
+                    tasks[message[1]].cancel()
+                elif message == ('stats',):
+                    conn.send(('stats', stats()))
+                elif message == ('stop',):
+                    loop.stop()
+                    return
+        except (EOFError, OSError):
+            loop.stop()
+
+    def stats():
+        worker_stats = pool.stats()
+        worker_stats['cpu_sec'] = time.process_time()
+        return worker_stats
+
+    def send_stats():
+        try:
+            conn.send(('stats', stats()))
+        except OSError:
+            return
+        loop.call_later(STATS_INTERVAL, send_stats)
+
+    async def evict_idle():
+        while True:
+            await asyncio.sleep(pool.idle_timeout)
+            await pool.evict_idle()
+
+    loop.add_reader(conn.fileno(), receive)
+    loop.call_soon(send_stats)
+    evict = loop.create_task(evict_idle())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        evict.cancel()
+        for task in list(tasks.values()):
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(evict, *tasks.values(), return_exceptions=True))
+        loop.run_until_complete(pool.close())
+        loop.close()
+        conn.close()
+
+
+class OmniPingHttpWorkers():
+    '''
+    A fixed number of worker processes the requests are dealt out to in turn.
+    get() has the same signature as OmniPingHttpPool.get so the tester
+    can use either, the replies are read on the tester's loop
+    '''
+
+    def __init__(self, workers=2, http_pool_size=4, http_idle_timeout=60.0,
+                 dns_ttl=60.0, dns_negative_ttl=10.0):
+        self.count = max(1, int(workers))
+        self.pool_kwargs = {'size': http_pool_size, 'idle_timeout': http_idle_timeout}
+        self.resolver_kwargs = {'ttl': dns_ttl, 'negative_ttl': dns_negative_ttl}
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.next_worker = None
+        self.ident = itertools.count()
+        self.pending = {}
+        self.loop = None
+
+    def start(self, loop):
+        '''
+        Start the worker processes, their replies are read on loop (an OmniPingLoop)
+        '''
+        self.loop = loop
+        for num in range(self.count):
+            parent_conn, child_conn = self.context.Pipe()
+            process = self.context.Process(
+                        target=worker_main,
+                        args=(child_conn, self.pool_kwargs, self.resolver_kwargs),
+                        name=f'omniping-http-{num}',
+                        daemon=True,
+                        )
+            process.start()
+            child_conn.close()
+            self.workers.append({'num': num, 'process': process, 'conn': parent_conn,
+                                 'requests': 0, 'inflight': 0, 'stats': {}, 'reports': 0,
+                                 'last_seen': time.monotonic()})
+        self.next_worker = itertools.cycle(self.workers)
+        for worker in self.workers:
+            loop.call(loop.loop.add_reader, worker['conn'].fileno(), self.receive, worker)
+
+    def receive(self, worker):
+        '''
+        Reader callback, completes the waiting requests
+        '''
+        try:
+            while worker['conn'].poll():
+                message = worker['conn'].recv()
+                worker['last_seen'] = time.monotonic()
+                if message[0] == 'stats':
+                    worker['stats'] = message[1]
+                    worker['reports'] += 1
+                    continue
+                entry = self.pending.pop(message[1], None)
+                if entry is None or entry[0].done():
+                    continue
+                waiter, timings = entry
+                timings.update(message[-1])
+                if message[0] == 'result':
+                    waiter.set_result(OmniPingWorkerResponse(message[2]))
+                else:
+                    waiter.set_exception(message[2](*message[3]))
+        except (EOFError, OSError):
+            self.loop.loop.remove_reader(worker['conn'].fileno())
+            self.fail(worker)
+
+    def fail(self, worker):
+        '''
+        A worker has gone, its outstanding requests fail
+        '''
+        for ident, (waiter, _) in list(self.pending.items()):
+            if ident[0] == worker['num'] and not waiter.done():
+                waiter.set_exception(OSError('HTTP worker stopped'))
+                del self.pending[ident]
+
+    async def get(self, url, timeout, reuse='fresh', fetch='body', timings=None, resume=True):
+        '''
+        Make the request on the next worker and wait for the reply,
+        cancelling the wait cancels the request
+        '''
+        worker = next(self.next_worker)
+        ident = (worker['num'], next(self.ident))
+        waiter = asyncio.get_running_loop().create_future()
+        self.pending[ident] = (waiter, {} if timings is None else timings)
+        worker['requests'] += 1
+        worker['inflight'] += 1
+        try:
+            worker['conn'].send(('get', ident, (url, timeout, reuse, fetch, resume)))
+            return await waiter
+        except asyncio.CancelledError:
+            try:
+                worker['conn'].send(('cancel', ident))
+            except OSError:
+                pass
+            raise
+        finally:
+            worker['inflight'] -= 1
+            self.pending.pop(ident, None)
+
+    async def refresh_stats(self, timeout=2.0):
+        '''
+        Ask every worker for its stats now rather than waiting for the
+        next ones sent, i.e. to read their CPU time at a given point
+        '''
+        reports = {worker['num']: worker['reports'] for worker in self.workers}
+        for worker in self.workers:
+            try:
+                worker['conn'].send(('stats',))
+            except OSError:
+                reports.pop(worker['num'])
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(
+                worker['reports'] == reports.get(worker['num']) for worker in self.workers):
+            await asyncio.sleep(0.005)
+
+    def close(self):
+        '''
+        Stop reading the workers' replies, run on the tester's loop
+        '''
+        for worker in self.workers:
+            try:
+                self.loop.loop.remove_reader(worker['conn'].fileno())
+            except (OSError, ValueError):
+                pass
+        for waiter, _ in self.pending.values():
+            if not waiter.done():
+                waiter.cancel()
+        self.pending = {}
+
+    def stop(self):
+        '''
+        Ask the workers to stop, terminating any that don't
+        '''
+        for worker in self.workers:
+            try:
+                worker['conn'].send(('stop',))
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker['process'].join(5)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+            worker['conn'].close()
+        self.workers = []
+
+    def stats(self):
+        '''
+        The workers' pool stats summed, in the same form as a single pool's,
+        cpu_sec being the CPU time used by all the workers
+        '''
+        stats = {}
+        for worker in self.workers:
+            for key, value in worker['stats'].items():
+                if key == 'idle_timeout':
+                    stats[key] = value
+                elif key.endswith('_avg_ms'):
+                    continue
+                elif isinstance(value, (int, float)):
+                    stats[key] = stats.get(key, 0) + value
+        stats['requests'] = sum(worker['requests'] for worker in self.workers)
+        stats['workers'] = len(self.workers)
+        stats['worker_inflight'] = sum(worker['inflight'] for worker in self.workers)
+        return handshake_averages(stats)
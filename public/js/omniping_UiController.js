@@ -151,7 +151,20 @@ const UICtrl = (function(client){
   }
 
   const startAutoReport = (e) => {
-    interval = setInterval(getNewReport, autoRefreshInterval);
+    if (window.EventSource){
+      // The server pushes the report as each round completes
+      interval = new EventSource("/omniping/stream");
+      interval.addEventListener('round', (event) => {
+        updateReport(JSON.parse(event.data));
+      });
+      interval.onerror = () => {
+        if (interval instanceof EventSource && interval.readyState === EventSource.CLOSED){
+          interval = setInterval(getNewReport, autoRefreshInterval);
+        }
+      };
+    }else{
+      interval = setInterval(getNewReport, autoRefreshInterval);
+    }
     getNewReport();
     if (e !== undefined){
       e.preventDefault();   
@@ -159,7 +172,12 @@ const UICtrl = (function(client){
   }
 
   const stopAutoReport = (e) => {
-    interval = clearInterval(interval);
+    if (interval instanceof EventSource){
+      interval.close();
+      interval = undefined;
+    }else{
+      interval = clearInterval(interval);
+    }
     if (e !== undefined){
       getNewReport();
       e.preventDefault();   
@@ -644,13 +662,21 @@ const UICtrl = (function(client){
         active = false
       }
       test = test.replace('#', '').split(/ :|;|: /g);
-      if (test.length == 3) {
+      if (test.length == 3 || test.length == 4) {
         newTest = {
           'host': test[0].trim(),
           'desc': test[1].trim(),
           'test': test[2].toUpperCase().trim(),
           'active': active
         }
+        if (test.length == 4){
+          test[3].trim().split(/\s+/).forEach((option) => {
+            option = option.split('=');
+            if (option.length == 2){
+              newTest[option[0].trim()] = option[1].trim();
+            }
+          });
+        }
         tests.push(newTest);
       }
     });
@@ -667,7 +693,17 @@ const UICtrl = (function(client){
       if (test['active']){
         hash = '';
       }
-      testConfig += `${hash}${test['host']} ; ${test['desc']} ; ${test['test']}\n`;
+      let options = [];
+      for (let key in test){
+        if (!['host', 'desc', 'test', 'active'].includes(key)){
+          options.push(`${key}=${test[key]}`);
+        }
+      }
+      let optionStr = '';
+      if (options.length){
+        optionStr = ` ; ${options.join(' ')}`;
+      }
+      testConfig += `${hash}${test['host']} ; ${test['desc']} ; ${test['test']}${optionStr}\n`;
     })
     return testConfig;
   }
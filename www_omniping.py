@@ -72,6 +72,10 @@ if __name__ == '__main__':
         'tools.response_headers.on': True,
         'tools.response_headers.headers': [('Content-Type', 'application/json')],
       },
+      '/metrics': {
+        'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+        'request.show_tracebacks': False,
+      },
       '/static': {
         'tools.staticdir.on': True,
         'tools.staticdir.root': os.path.abspath(cwd),
@@ -82,4 +86,5 @@ if __name__ == '__main__':
     # set the Version number and start the page and application
     op = OmniPingPage(path=cwd)
     op.omniping = OmniPingService(version='0.16', path=cwd)
+    op.metrics = op.omniping.metrics
     cherrypy.quickstart(op, '/', conf)